@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import time # Para simular trabajo o esperar
+_MODULE_LOAD_START = time.perf_counter() # Origen del tiempo hasta interactivo (ver App._mark_interactive)
 
 import customtkinter as ctk
 import tkinter as tk
@@ -6,18 +8,38 @@ from tkinter import filedialog, messagebox, ttk
 from tkcalendar import DateEntry
 import os
 import subprocess
+import signal # Terminar soffice y sus hijos al cancelar
 import sys
 import threading # Para hilos
-import time # Para simular trabajo o esperar
+import multiprocessing
 import traceback # Para imprimir errores completos
 import json # Para leer/escribir config.json
+import csv # Manifiestos de lotes
+import argparse # Modo consola (lotes)
+import io # Buffers en memoria (imágenes y DOCX)
+import queue # Respuestas del conversor persistente
+import socket # Puerto libre para el listener de LibreOffice
+import tempfile
+import shutil
+import atexit
+import hashlib
+import re
+import zipfile # Lectura de DOCX (conversor simulado)
+import zlib # Contenido comprimido del motor PDF nativo
+import html
+import random
+import platform
+import bisect
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
-from docxtpl import DocxTemplate, InlineImage
-from docx.shared import Mm, Inches
-from datetime import datetime
+from contextlib import contextmanager, nullcontext, redirect_stdout
+from datetime import datetime, timedelta
 import sqlite3
 import uuid
-from PIL import Image as PILImage
+from PIL import Image as PILImage, ImageOps
 import webbrowser
 from urllib.parse import quote
 
@@ -28,6 +50,24 @@ DB_FILENAME = "registros_cirugias.db"
 LIBREOFFICE_PATH = "C:/Program Files/LibreOffice/program/soffice.exe" # Ajusta si es necesario
 MAX_IMAGES_ALLOWED = 100
 CONVERT_TIMEOUT = 300 # 5 minutos
+CANCEL_POLL_S = 0.2 # Cada cuánto se comprueba la cancelación mientras se espera al conversor
+PROGRESS_REFRESH_MS = 100 # Refresco máximo de la barra de estado durante la generación
+OFFICE_DAEMON_START_TIMEOUT = 90 # Arranque en frío del LibreOffice persistente
+WORKDIR_PREFIX = "generador_pdf_" # Directorios temporales privados para la conversión
+CONVERT_BATCH_SIZE = 20 # DOCX por invocación de soffice en conversiones múltiples
+DB_BUSY_TIMEOUT = 10 # Segundos de espera si la BD está bloqueada
+DB_CACHED_STATEMENTS = 128 # Sentencias preparadas que sqlite3 mantiene compiladas
+DB_CACHE_SIZE_KB = 16384 # PRAGMA cache_size (KiB)
+DB_MMAP_SIZE_MB = 128 # PRAGMA mmap_size
+DB_SLOW_QUERY_S = 0.5 # Umbral para avisar de consultas lentas
+STATS_PAGE_SIZE = 200 # Filas por página en la ventana de registros
+STATS_DIMENSIONS = {'Enc. Preparación': 'encargado_preparacion', 'Médico': 'medico', 'Lugar': 'lugar', 'Tipo Cx': 'tipo_cirugia'} # Desgloses de stats_mensuales
+SEARCH_RESULT_LIMIT = 500 # Resultados máximos de la búsqueda de texto
+# Columnas indexadas en cirugias_fts y su peso en el ranking bm25
+FTS_COLUMNS = {'paciente': 10.0, 'medico': 6.0, 'cliente': 4.0, 'tecnico': 2.0, 'tipo_cirugia': 2.0, 'lugar': 2.0, 'encargado_preparacion': 2.0, 'encargado_logistica': 2.0, 'coordinador_cx': 2.0, 'observaciones_generales': 1.0, 'observaciones_logistica': 1.0}
+SUGGESTION_FIELDS = ['cliente', 'medico', 'tecnico', 'tipo_cirugia', 'lugar', 'encargado_preparacion', 'encargado_logistica', 'coordinador_cx']
+SUGGESTION_LIMIT = 30 # Valores mostrados por combobox
+SUGGESTION_HALF_LIFE_DAYS = 90 # Vida media del peso de un uso en el orden de sugerencias
 
 # --- Constantes de Calidad/Layout ---
 IMG_QUALITY_HIGH = 90
@@ -35,14 +75,47 @@ IMG_QUALITY_MEDIUM = 75
 IMG_QUALITY_LOW = 60
 # VOLVIENDO A 2 COLUMNAS
 LAYOUT_2_PER_ROW_WIDTH_MM = 79  # Ancho para 2 imágenes por fila (Ajustar según márgenes)
+IMAGES_PER_TEMPLATE_ROW = 3 # Celdas apiladas por grupo del bucle image_rows de template.docx (row[0], row[1], row[2])
 
 # --- Claves para config.json ---
 CONFIG_KEY_IMG_DIR = "default_image_dir"
 CONFIG_KEY_OUTPUT_DIR = "default_output_dir"
+CONFIG_KEY_OFFICE_DAEMON = "office_daemon" # True: LibreOffice persistente; False: un soffice por PDF
+CONFIG_KEY_IMG_WORKERS = "image_workers" # Procesos de compresión de imágenes (0 = todos los núcleos)
+CONFIG_KEY_IMG_CACHE_ENABLED = "image_cache_enabled" # Caché persistente de imágenes comprimidas
+CONFIG_KEY_IMG_CACHE_DIR = "image_cache_dir" # Vacío = 'cache_imagenes' junto a la BD
+CONFIG_KEY_IMG_CACHE_MAX_MB = "image_cache_max_mb" # Tope de tamaño (LRU)
+CONFIG_KEY_FAST_DECODE = "fast_decode" # Decodificar JPEG a escala reducida antes del redimensionado final
+CONFIG_KEY_DECODE_BUDGET_MB = "decode_memory_budget_mb" # Memoria máxima para decodificaciones simultáneas
+CONFIG_KEY_IN_MEMORY = "in_memory_pipeline" # Imágenes y DOCX en memoria; solo el conversor y el PDF final tocan disco
+CONFIG_KEY_CONVERT_BATCH_SIZE = "convert_batch_size" # DOCX por invocación del conversor en lotes
+CONFIG_KEY_IMG_ARCHIVE_ENABLED = "image_archive_enabled" # Guardar las imágenes comprimidas de cada reporte (para regenerar con fotos)
+CONFIG_KEY_IMG_ARCHIVE_DIR = "image_archive_dir" # Vacío = 'archivo_imagenes' junto a la BD
+CONFIG_KEY_RENDER_CACHE_ENABLED = "render_cache_enabled" # Reutilizar el PDF si plantilla, datos e imágenes no cambiaron
+CONFIG_KEY_METRICS_ENABLED = "metrics_enabled" # Guardar tiempos por etapa en generation_metrics
+CONFIG_KEY_PDF_CONVERTER = "pdf_converter" # 'libreoffice' o un conversor registrado (ver PDF_CONVERTERS)
+CONFIG_KEY_QUEUE_WORKERS = "queue_workers" # Reportes de la cola que se generan a la vez
+CONFIG_KEY_RENDER_ENGINE = "render_engine" # 'docx' (plantilla + conversor), 'nativo' (PDF directo) o 'hibrido' (ver RENDER_ENGINES)
+CONFIG_KEY_TEXT_CACHE_DIR = "text_pdf_cache_dir" # Vacío = 'cache_texto_pdf' junto a la BD (partes de texto del motor híbrido)
 
 # --- Variables Globales para Comunicación de Errores entre Hilos ---
 last_conversion_error = ""
 last_db_error = ""
+fts_available = False # init_db: SQLite con FTS5 y cirugias_fts lista
+_soffice_path_cache = None # Resultado de find_libreoffice()
+office_daemon = None # Instancia de OfficeConverterDaemon (si está activo)
+active_pdf_converter = "libreoffice" # Conversor en uso (ver set_pdf_converter)
+_image_pool = None; _image_pool_workers = 0; _image_pool_budget = None; _image_pool_lock = threading.Lock() # Pool de compresión reutilizable
+_image_archive = None # ImageArchive compartido (ver get_image_archive)
+_image_cache = None # Instancia de CompressedImageCache
+_decode_budget = None # DecodeMemoryBudget compartido por el proceso principal y el pool
+_db = None; _db_lock = threading.Lock() # DatabaseManager compartido (ver get_db)
+_suggestion_index = None; _suggestion_index_lock = threading.Lock() # SuggestionIndex compartido
+_render_cache_stats = {'hits': 0, 'misses': 0}; _render_cache_lock = threading.Lock() # Contadores de la caché de render
+_template_caches = {}; _template_caches_lock = threading.Lock() # Ruta plantilla -> TemplateCache
+# docxtpl/python-docx/jinja2: se importan al generar o en la precarga de la App (ver ensure_generation_stack)
+DocxTemplate = InlineImage = Mm = None
+_CompiledTemplateEnvironment = _CachedDocxTemplate = None; _generation_stack_lock = threading.Lock()
 
 # --- Funciones Auxiliares ---
 
@@ -51,7 +124,24 @@ def load_config():
     config_path = Path(CONFIG_FILENAME)
     defaults = {
         CONFIG_KEY_IMG_DIR: str(Path.home() / "Pictures"),
-        CONFIG_KEY_OUTPUT_DIR: str(Path.home() / "Documents")
+        CONFIG_KEY_OUTPUT_DIR: str(Path.home() / "Documents"),
+        CONFIG_KEY_OFFICE_DAEMON: True,
+        CONFIG_KEY_IMG_WORKERS: 0,
+        CONFIG_KEY_IMG_CACHE_ENABLED: True,
+        CONFIG_KEY_IMG_CACHE_DIR: "",
+        CONFIG_KEY_IMG_CACHE_MAX_MB: 500,
+        CONFIG_KEY_FAST_DECODE: True,
+        CONFIG_KEY_DECODE_BUDGET_MB: 512,
+        CONFIG_KEY_IN_MEMORY: True,
+        CONFIG_KEY_CONVERT_BATCH_SIZE: CONVERT_BATCH_SIZE,
+        CONFIG_KEY_IMG_ARCHIVE_ENABLED: True,
+        CONFIG_KEY_IMG_ARCHIVE_DIR: "",
+        CONFIG_KEY_RENDER_CACHE_ENABLED: True,
+        CONFIG_KEY_METRICS_ENABLED: True,
+        CONFIG_KEY_PDF_CONVERTER: "libreoffice",
+        CONFIG_KEY_QUEUE_WORKERS: 1,
+        CONFIG_KEY_RENDER_ENGINE: "docx",
+        CONFIG_KEY_TEXT_CACHE_DIR: ""
     }
     if config_path.exists():
         try:
@@ -68,22 +158,275 @@ def save_config(config_data):
         print(f"INFO: Configuración guardada en {config_path.resolve()}"); return True
     except IOError as e: print(f"ERROR: No se pudo guardar config en {config_path}: {e}"); return False
 
-def compress_image(img_path, target_width_mm, quality):
-    """Comprime y redimensiona imágenes. Devuelve Path del archivo temporal o None si falla."""
+def compress_image(img_path, target_width_mm, quality, output_path=None, fast_decode=True, in_memory=False):
+    """Comprime y redimensiona imágenes. Devuelve Path del archivo temporal (u output_path) o None si falla.
+    Sin output_path y con in_memory devuelve los bytes JPEG sin escribir nada a disco.
+    Con fast_decode los JPEG se decodifican a 1/2, 1/4 u 1/8 de escala antes del redimensionado final."""
     try:
         img_path = Path(img_path); print(f"Comprimiendo: {img_path.name} (Q: {quality}, W: {target_width_mm}mm)")
         img = PILImage.open(img_path)
-        if img.mode in ('RGBA', 'P'): img = img.convert('RGB')
         target_width_px = int(target_width_mm / 25.4 * 200)
-        if img.width > target_width_px:
-            ratio = target_width_px / img.width; target_height_px = int(img.height * ratio)
-            print(f"  - Redimensionando a {target_width_px}x{target_height_px}"); img = img.resize((target_width_px, target_height_px), PILImage.LANCZOS)
+        rotated = img.getexif().get(0x0112, 1) in (5, 6, 7, 8) # Orientación EXIF con giro de 90°: el ancho final es el alto almacenado
+        if fast_decode and img.format == "JPEG":
+            img.draft("RGB" if img.mode == "RGB" else None, (1, target_width_px) if rotated else (target_width_px, 1))
+            print(f"  - Decodificación reducida: {img.size[0]}x{img.size[1]}")
+        estimated_bytes = img.width * img.height * max(len(img.getbands()), 3) * 2 # Decodificada + copia girada/convertida
+        with (_decode_budget.reserve(estimated_bytes) if _decode_budget else nullcontext()):
+            img.load(); img = ImageOps.exif_transpose(img)
+            if img.mode in ('RGBA', 'P'): img = img.convert('RGB')
+            if img.width > target_width_px:
+                ratio = target_width_px / img.width; target_height_px = int(img.height * ratio)
+                print(f"  - Redimensionando a {target_width_px}x{target_height_px}"); img = img.resize((target_width_px, target_height_px), PILImage.LANCZOS)
+        if output_path: # Escritura atómica (p.ej. entrada de caché)
+            output_path = Path(output_path); partial_path = output_path.with_name(f"{output_path.stem}.{uuid.uuid4().hex[:8]}.part")
+            img.save(partial_path, "JPEG", quality=quality, optimize=True, progressive=True); os.replace(partial_path, output_path); print(f"  - Guardado: {output_path.name}"); return output_path
+        if in_memory:
+            buffer = io.BytesIO(); img.save(buffer, "JPEG", quality=quality, optimize=True, progressive=True); print(f"  - En memoria: {buffer.tell() // 1024} KB"); return buffer.getvalue()
         temp_suffix = f"_comp_{uuid.uuid4().hex[:8]}.jpg"; temp_path = img_path.with_name(img_path.stem + temp_suffix)
         img.save(temp_path, "JPEG", quality=quality, optimize=True, progressive=True); print(f"  - Guardado temp: {temp_path.name}"); return temp_path
     except FileNotFoundError: print(f"ERROR compress: Imagen no encontrada {img_path}"); return None
     except Exception as e: print(f"ERROR compress: {img_path.name}: {e}"); return None
 
+class DecodeMemoryBudget:
+    """Presupuesto global de memoria para decodificaciones simultáneas, compartido con los procesos del pool."""
+    def __init__(self, max_bytes):
+        self.max_bytes = max(1, int(max_bytes)); self._used = multiprocessing.Value('q', 0, lock=False); self._cond = multiprocessing.Condition()
+
+    @contextmanager
+    def reserve(self, nbytes):
+        """Bloquea hasta que haya nbytes libres (una imagen mayor que el total espera a estar sola)."""
+        nbytes = max(0, min(int(nbytes), self.max_bytes))
+        with self._cond:
+            while self._used.value + nbytes > self.max_bytes: self._cond.wait(timeout=1.0)
+            self._used.value += nbytes
+        try: yield
+        finally:
+            with self._cond: self._used.value -= nbytes; self._cond.notify_all()
+
+def _init_image_worker(budget):
+    """Inicializador de los procesos del pool: comparte el presupuesto de memoria del proceso principal."""
+    global _decode_budget
+    _decode_budget = budget
+
+def configure_decode_budget(max_mb):
+    """Crea (o reutiliza) el presupuesto de memoria de decodificación del proceso principal."""
+    global _decode_budget
+    max_bytes = int(float(max_mb) * 1024 * 1024)
+    if _decode_budget is None or _decode_budget.max_bytes != max_bytes: _decode_budget = DecodeMemoryBudget(max_bytes)
+    return _decode_budget
+
+def resolve_image_workers(configured):
+    """Número de procesos de compresión: 0/None = núcleos disponibles."""
+    try: configured = int(configured or 0)
+    except (TypeError, ValueError): configured = 0
+    return max(1, configured if configured > 0 else (os.cpu_count() or 1))
+
+def get_image_pool(workers):
+    """Devuelve el pool de procesos de compresión (se crea una vez y se reutiliza).
+    Los procesos comparten el presupuesto de memoria de decodificación vigente."""
+    global _image_pool, _image_pool_workers, _image_pool_budget
+    with _image_pool_lock:
+        if _image_pool is None or _image_pool_workers != workers or _image_pool_budget is not _decode_budget:
+            if _image_pool: _image_pool.shutdown(wait=False, cancel_futures=True)
+            print(f"INFO: Creando pool de compresión con {workers} procesos.")
+            _image_pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_image_worker, initargs=(_decode_budget,)); _image_pool_workers = workers; _image_pool_budget = _decode_budget
+        return _image_pool
+
+def shutdown_image_pool(reset_budget=False):
+    """Cierra el pool de compresión si existe. reset_budget descarta el presupuesto de memoria
+    (tras la muerte de un proceso que pudo quedar con memoria reservada)."""
+    global _image_pool, _decode_budget
+    with _image_pool_lock:
+        if _image_pool: _image_pool.shutdown(wait=False, cancel_futures=True); _image_pool = None
+        if reset_budget and _decode_budget: _decode_budget = DecodeMemoryBudget(_decode_budget.max_bytes)
+
+atexit.register(shutdown_image_pool)
+
+def compress_images(image_paths, target_width_mm, quality, workers=1, progress_cb=None, cache=None, fast_decode=True, in_memory=False, cancel_event=None):
+    """Comprime varias imágenes en paralelo (pool de procesos), reutilizando la caché si se indica.
+    Devuelve una lista alineada con image_paths (Path comprimido, bytes si in_memory y sin caché, o None si falla/no existe).
+    progress_cb(hechas, total, nombre) se llama al terminar cada imagen, en orden de finalización.
+    Si se activa cancel_event no se empiezan más imágenes (las que ya están en curso terminan y se descartan)."""
+    paths = [Path(str(p).strip()) for p in image_paths]; total = len(paths); results = [None] * total; done = 0
+    cancelled = lambda: cancel_event is not None and cancel_event.is_set()
+    pending = []; outputs = {}; keys = {}
+    for i, img_path in enumerate(paths):
+        if not img_path.exists():
+            print(f"WARN: Imagen no encontrada: {img_path}"); done += 1
+            if progress_cb: progress_cb(done, total, img_path.name)
+            continue
+        if cache:
+            try: keys[i] = cache.key_for(img_path, target_width_mm, quality, fast_decode)
+            except OSError as e: print(f"WARN: Sin caché para {img_path.name}: {e}")
+            cached_path = cache.get(keys[i]) if i in keys else None
+            if cached_path:
+                results[i] = cached_path; done += 1; print(f"Caché: {img_path.name} -> {cached_path.name}")
+                if progress_cb: progress_cb(done, total, img_path.name)
+                continue
+            if i in keys: outputs[i] = cache.path_for(keys[i])
+        pending.append(i)
+    def _store(i, result):
+        results[i] = result
+        if result and i in outputs: cache.add(keys[i], protect=keys.values())
+    def _adopt(i, fut): # Terminó después de cancelar: la entrada ya está escrita y se registra para que el LRU la cuente y desaloje
+        if not fut.cancelled() and fut.exception() is None and fut.result(): cache.add(keys[i])
+    if workers <= 1 or len(pending) <= 1:
+        for i in pending:
+            if cancelled(): break
+            _store(i, compress_image(paths[i], target_width_mm, quality, outputs.get(i), fast_decode, in_memory)); done += 1
+            if progress_cb: progress_cb(done, total, paths[i].name)
+        pending = []
+    for attempt in (1, 2): # Un reintento si un proceso del pool muere (p.ej. sin memoria)
+        if not pending or cancelled(): break
+        pool = get_image_pool(workers); futures = {pool.submit(compress_image, paths[i], target_width_mm, quality, outputs.get(i), fast_decode, in_memory): i for i in pending}; broken = []
+        for fut in as_completed(futures):
+            if cancelled():
+                for other, j in futures.items():
+                    if not other.cancel() and j in outputs: other.add_done_callback(lambda f, j=j: _adopt(j, f)) # Las que ya empezaron terminan igual
+                print("INFO: Compresión cancelada."); break
+            i = futures[fut]
+            try: _store(i, fut.result())
+            except BrokenProcessPool: broken.append(i); continue
+            except Exception as e: print(f"ERROR compress (pool): {paths[i].name}: {e}")
+            done += 1
+            if progress_cb: progress_cb(done, total, paths[i].name)
+        pending = sorted(broken) if not cancelled() else []
+        if pending: print(f"WARN: Pool de compresión roto ({len(pending)} imágenes pendientes). Reintento {attempt}/1..."); shutdown_image_pool(reset_budget=True)
+    for i in pending:
+        print(f"ERROR compress: {paths[i].name}: proceso de compresión terminado inesperadamente"); done += 1
+        if progress_cb: progress_cb(done, total, paths[i].name)
+    if cache: cache.flush(); print(f"Caché imágenes: {cache.stats()}")
+    return results
+
+class CompressedImageCache:
+    """Caché persistente de imágenes comprimidas, direccionada por contenido, con desalojo LRU.
+    Clave = hash del contenido original + ancho (mm) + calidad JPEG. El LRU usa el mtime de cada entrada."""
+    VERSION = "v2" # Cambiar si cambia el algoritmo de compresión (invalida entradas viejas)
+    PARTIAL_MAX_AGE_S = 3600 # Un .part más viejo que esto es de una escritura interrumpida (no de otra instancia en curso)
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = Path(cache_dir); self.max_bytes = max(0, int(max_bytes)); self.lock = threading.Lock()
+        self.hits = 0; self.misses = 0; self.evictions = 0
+        self.cache_dir.mkdir(parents=True, exist_ok=True); self._hash_index_path = self.cache_dir / "hashes.json"
+        try: self._hash_index = json.loads(self._hash_index_path.read_text(encoding='utf-8'))
+        except (OSError, ValueError): self._hash_index = {}
+        self._hash_index_dirty = False
+        for partial in self.cache_dir.glob("*.part"): # Restos de procesos del pool terminados a mitad de escritura
+            try:
+                if time.time() - partial.stat().st_mtime > self.PARTIAL_MAX_AGE_S: partial.unlink()
+            except OSError: pass
+        entries = []
+        for f in self.cache_dir.glob("*.jpg"):
+            try: st = f.stat(); entries.append((st.st_mtime, f.stem, st.st_size))
+            except OSError: pass
+        entries.sort(); self._entries = OrderedDict((k, size) for _, k, size in entries) # Más antiguo primero
+        self.total_bytes = sum(self._entries.values())
+
+    def content_hash(self, img_path):
+        """Hash SHA-1 del archivo original; memorizado por (ruta, tamaño, mtime) para no releerlo."""
+        img_path = Path(img_path).resolve(); st = img_path.stat(); memo_key = f"{img_path}|{st.st_size}|{st.st_mtime_ns}"
+        with self.lock: cached = self._hash_index.get(memo_key)
+        if cached: return cached
+        h = hashlib.sha1()
+        with open(img_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""): h.update(chunk)
+        digest = h.hexdigest()
+        with self.lock: self._hash_index[memo_key] = digest; self._hash_index_dirty = True
+        return digest
+
+    def key_for(self, img_path, target_width_mm, quality, fast_decode=True):
+        return hashlib.sha1(f"{self.VERSION}|{self.content_hash(img_path)}|{target_width_mm}|{quality}|{int(bool(fast_decode))}".encode()).hexdigest()
+
+    def path_for(self, key): return self.cache_dir / f"{key}.jpg"
+
+    def owns(self, path): return Path(path).parent == self.cache_dir
+
+    def get(self, key):
+        """Devuelve el Path cacheado (y lo marca como usado) o None."""
+        path = self.path_for(key)
+        with self.lock:
+            if key in self._entries and path.exists():
+                try: os.utime(path, None)
+                except OSError: pass
+                self._entries.move_to_end(key); self.hits += 1; return path
+            if key in self._entries: self.total_bytes -= self._entries.pop(key) # Borrada desde fuera
+            self.misses += 1; return None
+
+    def add(self, key, protect=()):
+        """Registra una entrada ya escrita en path_for(key) y desaloja lo menos usado si se supera el tope.
+        Las claves en protect (las del reporte en curso) no se desalojan."""
+        path = self.path_for(key)
+        try: size = path.stat().st_size
+        except OSError: return
+        with self.lock:
+            self.total_bytes += size - self._entries.pop(key, 0); self._entries[key] = size
+            protect = set(protect); protect.add(key)
+            for old_key in [k for k in self._entries if k not in protect]: # Más antiguo primero
+                if self.total_bytes <= self.max_bytes: break
+                self.total_bytes -= self._entries.pop(old_key); self.evictions += 1
+                try: self.path_for(old_key).unlink()
+                except OSError as e: print(f"WARN: No eliminar entrada caché {old_key}: {e}")
+
+    def flush(self):
+        """Persiste el índice de hashes (ruta/tamaño/mtime -> hash)."""
+        with self.lock:
+            if not self._hash_index_dirty: return
+            live = {k: v for k, v in self._hash_index.items() if Path(k.rsplit('|', 2)[0]).exists()} # Poda de originales borrados
+            data = json.dumps(live); self._hash_index_dirty = False
+        tmp = self._hash_index_path.with_suffix(f".{uuid.uuid4().hex[:8]}.tmp")
+        try: tmp.write_text(data, encoding='utf-8'); os.replace(tmp, self._hash_index_path)
+        except OSError as e: print(f"WARN: No guardar índice de caché: {e}")
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': (self.hits / total) if total else 0.0, 'evictions': self.evictions, 'entries': len(self._entries), 'bytes': self.total_bytes, 'max_bytes': self.max_bytes}
+
+def get_image_cache(config):
+    """Devuelve la caché de imágenes comprimidas según config (None si está desactivada)."""
+    global _image_cache
+    if not config.get(CONFIG_KEY_IMG_CACHE_ENABLED, True): return None
+    cache_dir = Path(config.get(CONFIG_KEY_IMG_CACHE_DIR) or (Path(DB_FILENAME).resolve().parent / "cache_imagenes")).resolve()
+    max_bytes = int(float(config.get(CONFIG_KEY_IMG_CACHE_MAX_MB, 500)) * 1024 * 1024)
+    with _image_pool_lock:
+        if _image_cache is None or _image_cache.cache_dir != cache_dir or _image_cache.max_bytes != max_bytes:
+            try: _image_cache = CompressedImageCache(cache_dir, max_bytes)
+            except OSError as e: print(f"WARN: Caché de imágenes no disponible ({cache_dir}): {e}"); return None
+        return _image_cache
+
+class ImageArchive:
+    """Archivo permanente de las imágenes ya comprimidas usadas en cada reporte, direccionado por el SHA-1 del JPEG.
+    Una foto idéntica se guarda una sola vez aunque aparezca en muchos reportes (<raíz>/<hash[:2]>/<hash>.jpg)."""
+    def __init__(self, root):
+        self.root = Path(root); self.root.mkdir(parents=True, exist_ok=True)
+
+    def path_for(self, digest): return self.root / digest[:2] / f"{digest}.jpg"
+
+    def store(self, data):
+        """Guarda los bytes (JPEG comprimido, o la foto original que la cola retiene hasta generar) si no existen ya. Devuelve el hash."""
+        digest = hashlib.sha1(data).hexdigest(); path = self.path_for(digest)
+        if not path.exists():
+            path.parent.mkdir(exist_ok=True); tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex[:8]}.part")
+            tmp_path.write_bytes(data); os.replace(tmp_path, path)
+        return digest
+
+def get_image_archive(config):
+    """Devuelve el archivo de imágenes según config (None si está desactivado o no se puede crear)."""
+    global _image_archive
+    if not config.get(CONFIG_KEY_IMG_ARCHIVE_ENABLED, True): return None
+    root = Path(config.get(CONFIG_KEY_IMG_ARCHIVE_DIR) or (Path(DB_FILENAME).resolve().parent / "archivo_imagenes")).resolve()
+    with _image_pool_lock:
+        if _image_archive is None or _image_archive.root != root:
+            try: _image_archive = ImageArchive(root)
+            except OSError as e: print(f"WARN: Archivo de imágenes no disponible ({root}): {e}"); return None
+        return _image_archive
+
 def find_libreoffice():
+    """Devuelve el ejecutable de LibreOffice (búsqueda cacheada tras la primera llamada)."""
+    global _soffice_path_cache
+    if _soffice_path_cache is None: _soffice_path_cache = _locate_libreoffice()
+    return _soffice_path_cache
+
+def _locate_libreoffice():
     """Busca el ejecutable de LibreOffice."""
     manual_path = Path(LIBREOFFICE_PATH);
     if manual_path.is_file() and manual_path.name.lower().startswith("soffice"): return str(manual_path)
@@ -91,8 +434,9 @@ def find_libreoffice():
         for name in ["soffice.exe", "soffice"]:
             if (manual_path / name).exists(): found_path = manual_path / name; print(f"Usando ejecutable en dir config: {found_path}"); return str(found_path)
     print(f"WARN: Ruta '{LIBREOFFICE_PATH}' no válida. Buscando..."); paths_to_check = []
-    if sys.platform == "win32": paths_to_check = [Path("C:/Program Files/LibreOffice/program/soffice.exe"), Path("C:/Program Files (x86)/LibreOffice/program/soffice.exe")]; lo_env = os.getenv("LIBREOFFICE_PROGRAM_PATH");
-    if lo_env: paths_to_check.insert(0, Path(lo_env) / "soffice.exe")
+    if sys.platform == "win32":
+        paths_to_check = [Path("C:/Program Files/LibreOffice/program/soffice.exe"), Path("C:/Program Files (x86)/LibreOffice/program/soffice.exe")]; lo_env = os.getenv("LIBREOFFICE_PROGRAM_PATH")
+        if lo_env: paths_to_check.insert(0, Path(lo_env) / "soffice.exe")
     elif sys.platform == "darwin": paths_to_check = [Path("/Applications/LibreOffice.app/Contents/MacOS/soffice")]
     else: paths_to_check = [Path("/usr/bin/soffice"), Path("/usr/local/bin/soffice"), Path("/snap/bin/libreoffice.soffice"), Path("/opt/libreoffice/program/soffice")]
     for path in paths_to_check:
@@ -109,108 +453,1904 @@ def find_libreoffice():
 def show_error_safe(title, message): messagebox.showerror(title, message)
 def show_info_safe(title, message): messagebox.showinfo(title, message)
 
+# --- Conversor LibreOffice persistente ---
+# Script puente que corre con un Python que tenga el módulo 'uno' (el de LibreOffice).
+# Protocolo por stdin/stdout: una línea JSON por pedido {"src", "dst"} y una por respuesta {"ok", "error"}.
+_UNO_BRIDGE_SCRIPT = r'''
+import sys, json, time
+import uno
+from com.sun.star.beans import PropertyValue
+
+def prop(name, value):
+    p = PropertyValue(); p.Name = name; p.Value = value; return p
+
+port = int(sys.argv[1]); deadline = time.time() + float(sys.argv[2])
+local_ctx = uno.getComponentContext()
+resolver = local_ctx.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", local_ctx)
+ctx = None
+while ctx is None:
+    try: ctx = resolver.resolve(f"uno:socket,host=127.0.0.1,port={port};urp;StarOffice.ComponentContext")
+    except Exception:
+        if time.time() > deadline: print(json.dumps({"ready": False, "error": "LibreOffice no responde en el socket"}), flush=True); sys.exit(1)
+        time.sleep(0.25)
+desktop = ctx.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", ctx)
+print(json.dumps({"ready": True}), flush=True)
+for line in sys.stdin:
+    try:
+        req = json.loads(line); doc = desktop.loadComponentFromURL(uno.systemPathToFileUrl(req["src"]), "_blank", 0, (prop("Hidden", True),))
+        if doc is None: raise RuntimeError("No se pudo abrir el documento")
+        try: doc.storeToURL(uno.systemPathToFileUrl(req["dst"]), (prop("FilterName", "writer_pdf_Export"),))
+        finally: doc.close(True)
+        resp = {"ok": True}
+    except Exception as e: resp = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+    print(json.dumps(resp), flush=True)
+'''
+
+def _python_has_uno(python_exe):
+    """Comprueba si un intérprete Python puede importar 'uno'."""
+    try: return subprocess.run([python_exe, "-c", "import uno"], capture_output=True, timeout=20).returncode == 0
+    except (OSError, subprocess.TimeoutExpired): return False
+
+def find_office_python(soffice_cmd_path):
+    """Busca un Python con bindings UNO: el incluido con LibreOffice o el del sistema."""
+    soffice_resolved = shutil.which(soffice_cmd_path) or soffice_cmd_path; program_dir = Path(soffice_resolved).resolve().parent
+    candidates = [program_dir / "python.exe", program_dir / "python", program_dir.parent / "Resources" / "python"] # Windows / Linux (tar oficial) / macOS
+    if sys.platform != "win32": candidates += [Path("/usr/bin/python3"), Path(sys.executable)]
+    for cand in candidates:
+        if cand.is_file() and _python_has_uno(str(cand)): print(f"INFO: Python con UNO: {cand}"); return str(cand)
+    return None
+
+def _free_local_port():
+    """Pide al SO un puerto TCP libre en localhost."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s: s.bind(("127.0.0.1", 0)); return s.getsockname()[1]
+
+class OfficeConverterDaemon:
+    """LibreOffice headless de larga vida escuchando en un socket UNO, supervisado y reiniciable."""
+    def __init__(self, soffice_cmd_path):
+        self.soffice_cmd_path = soffice_cmd_path; self.office_python = None
+        self.office_proc = None; self.bridge_proc = None; self.profile_dir = None; self.port = None
+        self.responses = None; self.lock = threading.Lock(); self.ready = False; self.restarts = 0
+
+    def start(self):
+        """Arranca soffice con --accept y el proceso puente. Lanza RuntimeError si no es posible."""
+        if self.office_python is None: self.office_python = find_office_python(self.soffice_cmd_path)
+        if not self.office_python: raise RuntimeError("No hay Python con módulo 'uno' (LibreOffice).")
+        start_t = time.time(); self.port = _free_local_port(); self.profile_dir = Path(tempfile.mkdtemp(prefix="generador_lo_"))
+        accept = f"socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext"
+        cmd = [self.soffice_cmd_path, f"-env:UserInstallation={self.profile_dir.as_uri()}", "--headless", "--invisible", "--nologo", "--norestore", "--nodefault", "--nolockcheck", f"--accept={accept}"]
+        print(f"Iniciando LibreOffice persistente (puerto {self.port})...")
+        self.office_proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        script_path = self.profile_dir / "uno_bridge.py"; script_path.write_text(_UNO_BRIDGE_SCRIPT, encoding='utf-8')
+        self.bridge_proc = subprocess.Popen([self.office_python, str(script_path), str(self.port), str(OFFICE_DAEMON_START_TIMEOUT)], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, encoding='utf-8', errors='ignore', bufsize=1)
+        self.responses = queue.Queue(); threading.Thread(target=self._read_responses, args=(self.bridge_proc, self.responses), daemon=True).start()
+        try: hello = self.responses.get(timeout=OFFICE_DAEMON_START_TIMEOUT + 5)
+        except queue.Empty: hello = {"ready": False, "error": "Timeout de arranque"}
+        if not hello or not hello.get("ready"): self.stop(); raise RuntimeError(f"LibreOffice persistente no arrancó: {(hello or {}).get('error', 'puente terminado')}")
+        self.ready = True; print(f"LibreOffice persistente listo en {time.time() - start_t:.2f}s.")
+
+    @staticmethod
+    def _read_responses(proc, responses):
+        """Hilo lector: pasa cada línea JSON del puente a la cola (None si el puente muere)."""
+        for line in proc.stdout:
+            try: responses.put(json.loads(line))
+            except json.JSONDecodeError: print(f"WARN: Respuesta puente UNO inválida: {line.strip()[:200]}")
+        responses.put(None)
+
+    def is_alive(self):
+        return bool(self.ready and self.office_proc and self.office_proc.poll() is None and self.bridge_proc and self.bridge_proc.poll() is None)
+
+    def convert(self, docx_path, pdf_path, timeout_duration=CONVERT_TIMEOUT, cancel_event=None):
+        """Convierte un DOCX a PDF en el proceso persistente. Devuelve (ok, mensaje_error).
+        Si se activa cancel_event durante la espera, mata LibreOffice (se reinicia en segundo plano) y devuelve (False, "Cancelado.")."""
+        with self.lock:
+            if not self.is_alive():
+                print("WARN: LibreOffice persistente caído. Reiniciando...")
+                try: self._restart()
+                except RuntimeError as e: return False, str(e)
+            start_t = time.time()
+            try: self.bridge_proc.stdin.write(json.dumps({"src": str(docx_path), "dst": str(pdf_path)}) + "\n"); self.bridge_proc.stdin.flush()
+            except OSError as e: print(f"ERROR DAEMON: Puente UNO no disponible ({e}). Reiniciando LibreOffice persistente..."); self._kill_and_restart(); return False, f"Puente UNO no disponible: {e}"
+            deadline = time.monotonic() + timeout_duration
+            while True:
+                try: resp = self.responses.get(timeout=max(0.0, min(deadline - time.monotonic(), CANCEL_POLL_S))); break
+                except queue.Empty:
+                    if cancel_event is not None and cancel_event.is_set():
+                        print("INFO: Conversión cancelada. Reiniciando LibreOffice persistente...")
+                        self._kill_and_restart(); return False, "Cancelado."
+                    if time.monotonic() < deadline: continue
+                    print(f"ERROR DAEMON: Conversión colgada ({timeout_duration}s). Reiniciando LibreOffice persistente...")
+                    self._kill_and_restart()
+                    return False, f"Timeout ({timeout_duration}s) convirtiendo '{Path(docx_path).name}' (LibreOffice reiniciado)."
+            print(f"DEBUG: Conversión (daemon) completada en {time.time() - start_t:.2f} segundos.")
+            if resp is None: print("ERROR DAEMON: El puente UNO terminó inesperadamente. Reiniciando LibreOffice persistente..."); self._kill_and_restart(); return False, "El puente UNO terminó inesperadamente."
+            return bool(resp.get("ok")), resp.get("error", "")
+
+    def _restart(self):
+        self._kill(); self.restarts += 1; self.start()
+
+    def _restart_quietly(self):
+        with self.lock:
+            if self.is_alive(): return # Ya lo reinició una conversión que tomó el lock antes
+            try: self._restart()
+            except (RuntimeError, OSError) as e: print(f"ERROR DAEMON: {e}")
+
+    def _kill_and_restart(self):
+        """Mata el proceso actual y lo vuelve a arrancar en segundo plano (espera al lock de convert)."""
+        self._kill(); threading.Thread(target=self._restart_quietly, daemon=True).start()
+
+    def _kill(self):
+        """Mata puente y soffice, y borra el perfil temporal."""
+        self.ready = False
+        for proc in (self.bridge_proc, self.office_proc):
+            if proc and proc.poll() is None:
+                try: proc.kill(); proc.wait(timeout=10)
+                except (OSError, subprocess.TimeoutExpired) as e: print(f"WARN: No se pudo terminar proceso {proc.pid}: {e}")
+        self.bridge_proc = None; self.office_proc = None
+        if self.profile_dir: shutil.rmtree(self.profile_dir, ignore_errors=True); self.profile_dir = None
+
+    def stop(self):
+        print("Deteniendo LibreOffice persistente..."); self._kill()
+
+def start_office_daemon():
+    """Arranca el conversor persistente (llamar una vez al iniciar la app). Devuelve True/False."""
+    global office_daemon
+    if office_daemon and office_daemon.is_alive(): return True
+    soffice_cmd_path = find_libreoffice()
+    if not (Path(soffice_cmd_path).is_file() or soffice_cmd_path.lower() == "soffice"): print("WARN: Sin LibreOffice; conversor persistente desactivado."); return False
+    daemon = OfficeConverterDaemon(soffice_cmd_path)
+    try: daemon.start()
+    except (RuntimeError, OSError) as e: print(f"WARN: {e} Se usará un proceso soffice por PDF."); return False
+    office_daemon = daemon; return True
+
+def stop_office_daemon():
+    """Detiene el conversor persistente si está activo."""
+    global office_daemon
+    if office_daemon: office_daemon.stop(); office_daemon = None
+
+atexit.register(stop_office_daemon)
+
+def _kill_process_tree(proc):
+    """Mata un proceso y sus hijos (soffice deja soffice.bin como proceso aparte)."""
+    try:
+        if sys.platform == "win32": subprocess.run(["taskkill", "/F", "/T", "/PID", str(proc.pid)], capture_output=True, timeout=10)
+        else: os.killpg(proc.pid, signal.SIGKILL)
+    except (OSError, subprocess.TimeoutExpired): pass
+    try: proc.kill()
+    except OSError: pass
+
+def _run_converter_process(cmd, timeout_duration, cancel_event=None):
+    """Como subprocess.run(capture_output=True, text=True), pero mata el proceso (y sus hijos) en cuanto se activa cancel_event.
+    Devuelve subprocess.CompletedProcess, o None si se canceló. Lanza subprocess.TimeoutExpired al agotar timeout_duration."""
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8', errors='ignore', start_new_session=(sys.platform != "win32"))
+    deadline = time.monotonic() + timeout_duration
+    while True:
+        remaining = deadline - time.monotonic()
+        try: stdout, stderr = proc.communicate(timeout=max(0.0, min(remaining, CANCEL_POLL_S) if cancel_event is not None else remaining)); return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+        except subprocess.TimeoutExpired:
+            cancelled = cancel_event is not None and cancel_event.is_set()
+            if not cancelled and time.monotonic() < deadline: continue
+            _kill_process_tree(proc)
+            try: proc.communicate(timeout=5) # Un nieto vivo podría mantener abiertas las tuberías
+            except subprocess.TimeoutExpired: print(f"WARN: El proceso {proc.pid} no liberó su salida tras terminarlo.")
+            if cancelled: print(f"INFO: Conversión cancelada; proceso {proc.pid} terminado."); return None
+            raise subprocess.TimeoutExpired(cmd, timeout_duration) from None
+
 def convert_to_pdf(docx_path, output_dir, timeout_duration=CONVERT_TIMEOUT):
     """Convierte DOCX a PDF. Devuelve True/False. Guarda error en global."""
-    global last_conversion_error; last_conversion_error = ""
+    global last_conversion_error
+    ok, last_conversion_error = _convert_to_pdf(docx_path, output_dir, timeout_duration); return ok
+
+def _convert_to_pdf(docx_path, output_dir, timeout_duration=CONVERT_TIMEOUT, cancel_event=None):
+    """Convierte DOCX a PDF (daemon si está activo, si no un soffice por archivo). Devuelve (ok, mensaje_error).
+    Con cancel_event, el soffice o el daemon en curso se terminan al cancelar y se devuelve (False, "Cancelado.")."""
+    if cancel_event is not None and cancel_event.is_set(): return False, "Cancelado."
+    if active_pdf_converter in PDF_CONVERTERS: return _convert_registered(docx_path, output_dir, timeout_duration, cancel_event)
+    if office_daemon and office_daemon.ready:
+        docx_abs = Path(docx_path).resolve(); pdf_abs = Path(output_dir).resolve() / docx_abs.with_suffix('.pdf').name
+        print(f"Convirtiendo '{docx_abs}' con LibreOffice persistente (Timeout: {timeout_duration}s)...")
+        ok, err = office_daemon.convert(docx_abs, pdf_abs, timeout_duration, cancel_event)
+        if ok and pdf_abs.exists(): print(f"Conversión PDF OK: {pdf_abs}"); return True, ""
+        if err == "Cancelado.": return False, err
+        error_msg = f"Fallo conversión PDF '{docx_abs.name}' (daemon). {err}"; print(f"ERROR CONVERT: {error_msg}")
+        if err.startswith("Timeout"): return False, error_msg
+        print("WARN: Reintentando con un proceso soffice independiente...")
     soffice_cmd_path = find_libreoffice(); soffice_executable = Path(soffice_cmd_path); can_execute = (soffice_executable.is_file() or soffice_cmd_path.lower() == "soffice")
-    if not can_execute: last_conversion_error = f"Ejecutable LO no encontrado/inválido: '{soffice_cmd_path}'"; print(f"ERROR CONVERT: {last_conversion_error}"); return False
+    if not can_execute: error_msg = f"Ejecutable LO no encontrado/inválido: '{soffice_cmd_path}'"; print(f"ERROR CONVERT: {error_msg}"); return False, error_msg
     docx_abs_path = str(Path(docx_path).resolve()); output_dir_abs_path = str(Path(output_dir).resolve())
     try:
         print(f"Convirtiendo '{docx_abs_path}' a PDF en '{output_dir_abs_path}' (Timeout: {timeout_duration}s)...")
         cmd = [ soffice_cmd_path, '--headless', '--convert-to', 'pdf', '--outdir', output_dir_abs_path, docx_abs_path ]; print(f"Comando: {' '.join(cmd)}")
-        start_t = time.time(); result = subprocess.run(cmd, capture_output=True, text=True, check=False, encoding='utf-8', errors='ignore', timeout=timeout_duration); end_t = time.time()
+        start_t = time.time(); result = _run_converter_process(cmd, timeout_duration, cancel_event); end_t = time.time()
+        if result is None: return False, "Cancelado."
         print(f"DEBUG: subprocess.run completado en {end_t - start_t:.2f} segundos."); print(f"LO Return Code: {result.returncode}")
         pdf_filename = Path(docx_path).with_suffix('.pdf').name; expected_pdf_path = Path(output_dir_abs_path) / pdf_filename
-        if result.returncode == 0 and expected_pdf_path.exists(): print(f"Conversión PDF OK: {expected_pdf_path}"); return True
+        if result.returncode == 0 and expected_pdf_path.exists(): print(f"Conversión PDF OK: {expected_pdf_path}"); return True, ""
         else:
             error_msg = f"Fallo conversión PDF '{Path(docx_path).name}'. ";
             if not expected_pdf_path.exists(): error_msg += f"PDF no encontrado: {expected_pdf_path}. "
             if result.returncode != 0: error_msg += f"LO Code: {result.returncode}. "
             if result.stderr: error_msg += f"LO Err: {result.stderr[:250]}..."
-            last_conversion_error = error_msg; print(f"ERROR CONVERT: {error_msg}"); return False
-    except subprocess.TimeoutExpired: end_t = time.time(); print(f"DEBUG: subprocess.run TIMEOUT después de {end_t - start_t:.2f} segundos."); last_conversion_error = f"Timeout ({timeout_duration}s) convirtiendo '{Path(docx_path).name}'."; print(f"ERROR CONVERT: {last_conversion_error}"); return False
-    except FileNotFoundError: last_conversion_error = f"Comando '{soffice_cmd_path}' no encontrado."; print(f"ERROR CONVERT: {last_conversion_error}"); return False
-    except Exception as e: last_conversion_error = f"Error inesperado conversión: {type(e).__name__}: {e}"; print(f"ERROR CONVERT: {last_conversion_error}\n{traceback.format_exc()}"); return False
+            print(f"ERROR CONVERT: {error_msg}"); return False, error_msg
+    except subprocess.TimeoutExpired: end_t = time.time(); print(f"DEBUG: subprocess.run TIMEOUT después de {end_t - start_t:.2f} segundos."); error_msg = f"Timeout ({timeout_duration}s) convirtiendo '{Path(docx_path).name}'."; print(f"ERROR CONVERT: {error_msg}"); return False, error_msg
+    except FileNotFoundError: error_msg = f"Comando '{soffice_cmd_path}' no encontrado."; print(f"ERROR CONVERT: {error_msg}"); return False, error_msg
+    except Exception as e: error_msg = f"Error inesperado conversión: {type(e).__name__}: {e}"; print(f"ERROR CONVERT: {error_msg}\n{traceback.format_exc()}"); return False, error_msg
+
+def convert_docx_bytes_to_pdf(docx_bytes, output_pdf_path, stem="reporte", timeout_duration=CONVERT_TIMEOUT, cancel_event=None):
+    """Convierte un DOCX en memoria: lo deja en un directorio temporal privado, convierte allí
+    y mueve el PDF a output_pdf_path. Devuelve (ok, mensaje_error)."""
+    work_dir = Path(tempfile.mkdtemp(prefix=WORKDIR_PREFIX)); output_pdf_path = Path(output_pdf_path)
+    try:
+        docx_path = work_dir / f"{stem}.docx"; docx_path.write_bytes(docx_bytes)
+        ok, err = _convert_to_pdf(docx_path, work_dir, timeout_duration, cancel_event)
+        if not ok: return False, err
+        return _move_pdf(docx_path.with_suffix('.pdf'), output_pdf_path)
+    finally: shutil.rmtree(work_dir, ignore_errors=True)
+
+def convert_many_to_pdf(items, output_dir, batch_size=CONVERT_BATCH_SIZE, timeout_duration=CONVERT_TIMEOUT, cancel_event=None):
+    """Convierte varios DOCX con el mínimo de invocaciones del conversor (varios archivos por soffice).
+    items: lista de (clave, docx_path). Devuelve {clave: {'pdf': Path o None, 'error': str}} con el error de cada archivo.
+    Al activarse cancel_event se termina el soffice en curso y el resto queda con error "Cancelado."."""
+    output_dir = Path(output_dir).resolve(); results = {}
+    if (office_daemon and office_daemon.ready) or active_pdf_converter in PDF_CONVERTERS: # Proceso ya caliente o conversor en proceso: no hay arranque que amortizar
+        for key, docx_path in items:
+            ok, err = _convert_to_pdf(docx_path, output_dir, timeout_duration, cancel_event)
+            results[key] = {'pdf': output_dir / f"{Path(docx_path).stem}.pdf" if ok else None, 'error': err}
+        return results
+    soffice_cmd_path = find_libreoffice()
+    if not (Path(soffice_cmd_path).is_file() or soffice_cmd_path.lower() == "soffice"):
+        error_msg = f"Ejecutable LO no encontrado/inválido: '{soffice_cmd_path}'"; print(f"ERROR CONVERT: {error_msg}")
+        return {key: {'pdf': None, 'error': error_msg} for key, _ in items}
+    batches = []; current = []; stems = set() # La salida se nombra por el stem del DOCX: sin repetidos dentro de un lote
+    for key, docx_path in items:
+        docx_path = Path(docx_path).resolve(); stem = docx_path.stem.lower()
+        if current and (len(current) >= max(1, batch_size) or stem in stems): batches.append(current); current = []; stems = set()
+        current.append((key, docx_path)); stems.add(stem)
+    if current: batches.append(current)
+    for n, batch in enumerate(batches, start=1):
+        if cancel_event is not None and cancel_event.is_set():
+            for key, _ in batch: results[key] = {'pdf': None, 'error': "Cancelado."}
+            continue
+        for _, docx_path in batch:
+            stale_pdf = output_dir / f"{docx_path.stem}.pdf"
+            if stale_pdf.exists(): stale_pdf.unlink()
+        batch_timeout = timeout_duration + 30 * (len(batch) - 1); proc_error = ""
+        cmd = [soffice_cmd_path, '--headless', '--convert-to', 'pdf', '--outdir', str(output_dir)] + [str(p) for _, p in batch]
+        print(f"Convirtiendo lote {n}/{len(batches)} ({len(batch)} DOCX) en una invocación (Timeout: {batch_timeout}s)...")
+        start_t = time.time()
+        try:
+            res = _run_converter_process(cmd, batch_timeout, cancel_event)
+            if res is None: proc_error = "Cancelado."
+            elif res.returncode != 0: proc_error = f"LO Code: {res.returncode}. " + (f"LO Err: {res.stderr[:250]}..." if res.stderr else "")
+        except subprocess.TimeoutExpired: proc_error = f"Timeout ({batch_timeout}s) en lote de {len(batch)} archivos."
+        except OSError as e: proc_error = f"Comando '{soffice_cmd_path}' no ejecutable: {e}"
+        print(f"DEBUG: Lote {n} completado en {time.time() - start_t:.2f} segundos.")
+        for key, docx_path in batch:
+            pdf_path = output_dir / f"{docx_path.stem}.pdf"
+            if pdf_path.exists(): results[key] = {'pdf': pdf_path, 'error': ""}
+            elif proc_error == "Cancelado.": results[key] = {'pdf': None, 'error': proc_error}
+            else: results[key] = {'pdf': None, 'error': f"Fallo conversión PDF '{docx_path.name}'. PDF no encontrado. {proc_error}".strip()}; print(f"ERROR CONVERT: {results[key]['error']}")
+    return results
+
+def cleanup_stale_workdirs(max_age_s=24 * 3600):
+    """Borra directorios temporales de conversión abandonados (p.ej. tras un cierre inesperado)."""
+    removed = 0
+    for d in Path(tempfile.gettempdir()).glob(f"{WORKDIR_PREFIX}*"):
+        try:
+            if d.is_dir() and time.time() - d.stat().st_mtime > max_age_s: shutil.rmtree(d, ignore_errors=True); removed += 1
+        except OSError: pass
+    if removed: print(f"INFO: {removed} directorios temporales antiguos eliminados.")
+
+# --- Conversores PDF Intercambiables ---
+PDF_CONVERTERS = {} # nombre -> función(docx_path, pdf_path, timeout_duration) -> (ok, mensaje_error); 'libreoffice' es el conversor interno
+
+def register_pdf_converter(name, convert_func):
+    """Registra un conversor alternativo a LibreOffice (se activa con set_pdf_converter / config 'pdf_converter')."""
+    PDF_CONVERTERS[name] = convert_func
+
+def set_pdf_converter(name):
+    """Selecciona el conversor activo. Un nombre desconocido vuelve a 'libreoffice'. Devuelve el nombre activo."""
+    global active_pdf_converter
+    name = name or "libreoffice"
+    if name != "libreoffice" and name not in PDF_CONVERTERS: print(f"WARN: Conversor PDF desconocido '{name}' (disponibles: libreoffice, {', '.join(sorted(PDF_CONVERTERS))}). Se usa LibreOffice."); name = "libreoffice"
+    if name != active_pdf_converter: print(f"INFO: Conversor PDF: {name}")
+    active_pdf_converter = name; return name
+
+def _convert_registered(docx_path, output_dir, timeout_duration=CONVERT_TIMEOUT, cancel_event=None):
+    """Convierte con el conversor registrado activo, con la misma convención de nombres que soffice. Devuelve (ok, mensaje_error).
+    Un conversor en proceso no se puede matar: con cancel_event corre en un hilo aparte y, al cancelar, se deja de esperar,
+    se devuelve (False, "Cancelado.") y su resultado se descarta."""
+    converter = active_pdf_converter; docx_abs = Path(docx_path).resolve(); pdf_abs = Path(output_dir).resolve() / docx_abs.with_suffix('.pdf').name; outcome = {}
+    def _run():
+        try: outcome['result'] = PDF_CONVERTERS[converter](docx_abs, pdf_abs, timeout_duration)
+        except Exception as e: outcome['result'] = (False, f"{type(e).__name__}: {e}")
+    if cancel_event is None: _run()
+    else:
+        worker = threading.Thread(target=_run, daemon=True); worker.start()
+        while worker.is_alive():
+            worker.join(CANCEL_POLL_S)
+            if cancel_event.is_set() and worker.is_alive(): print(f"INFO: Conversión cancelada; el conversor '{converter}' no se puede interrumpir y su resultado se descartará."); return False, "Cancelado."
+    ok, err = outcome['result']
+    if ok and pdf_abs.exists(): return True, ""
+    error_msg = f"Fallo conversión PDF '{docx_abs.name}' ({converter}). {err}".strip(); print(f"ERROR CONVERT: {error_msg}"); return False, error_msg
+
+def _pdf_string(text):
+    """Texto para un literal (...) de PDF en WinAnsi (cp1252), con los caracteres especiales escapados."""
+    return str(text).encode('cp1252', 'replace').replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)')
+
+def _serialize_pdf(objects):
+    """Bytes de un PDF con esos objetos (numerados desde 1; el 1 es el catálogo), su tabla xref y el trailer."""
+    out = bytearray(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"); offsets = []
+    for n, obj in enumerate(objects, start=1): offsets.append(len(out)); out += b"%d 0 obj\n" % n + obj + b"\nendobj\n"
+    xref_offset = len(out); out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1) + b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref_offset)
+    return bytes(out)
+
+def write_simple_pdf(pdf_path, lines):
+    """Escribe un PDF válido de una página A4 con las líneas en Helvetica (lo que no cabe se descarta)."""
+    stream = b"BT /F1 9 Tf 11 TL 40 800 Td " + b"".join(b"(" + _pdf_string(line[:110]) + b") Tj T* " for line in lines[:70]) + b"ET"
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+               b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 4 0 R >> >> /Contents 5 0 R >>",
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>",
+               b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream"]
+    Path(pdf_path).write_bytes(_serialize_pdf(objects))
+
+def convert_simulated(docx_path, pdf_path, timeout_duration=CONVERT_TIMEOUT):
+    """Conversor local de reemplazo para equipos sin LibreOffice: lee el DOCX completo (texto e imágenes) y escribe
+    un PDF de una página con el texto. No reproduce el maquetado; sirve para medir y probar el resto del pipeline."""
+    with zipfile.ZipFile(docx_path) as docx:
+        document_xml = docx.read('word/document.xml').decode('utf-8'); media = [docx.read(name) for name in docx.namelist() if name.startswith('word/media/')]
+    paragraphs = [''.join(re.findall(r'<w:t(?:\s[^>]*)?>([^<]*)</w:t>', p)) for p in re.findall(r'<w:p[ >].*?</w:p>', document_xml, re.S)]
+    lines = [html.unescape(p) for p in paragraphs if p.strip()] + [f"[{len(media)} imágenes, {sum(len(m) for m in media) // 1024} KB]"]
+    write_simple_pdf(pdf_path, lines); return True, ""
+
+register_pdf_converter("simulado", convert_simulated)
+
+# --- Motor PDF Nativo ---
+RENDER_ENGINES = ("docx", "nativo", "hibrido") # docx: plantilla + conversor PDF; nativo: dibujo directo a PDF (sin LibreOffice); hibrido: solo el texto pasa por el conversor
+RENDER_ENGINE_LABELS = {'docx': "LibreOffice", 'nativo': "Nativo (rápido)", 'hibrido': "Híbrido (texto + fotos)"}
+NATIVE_LAYOUT_VERSION = 2 # Cambiar si cambia el dibujo nativo (entra en la huella de la caché de render)
+PDF_PAGE_W, PDF_PAGE_H, PDF_MARGIN = 595.28, 841.89, 36.0 # A4 en puntos, márgenes de la plantilla (12,7 mm)
+MM_TO_PT = 72 / 25.4
+PHOTO_ROW_GAP_PT, PHOTO_GROUP_GAP_PT = 4.0, 12.0 # Entre fotos de un grupo de la plantilla y entre grupos (el párrafo vacío tras cada tabla)
+_HELVETICA_WIDTHS = { # Anchos AFM (milésimas de em) de ' ' a '~'; el resto se aproxima con su letra base (NFD)
+    False: [278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278, 556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+            1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778, 667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+            333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556, 556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584],
+    True: [278, 333, 474, 556, 556, 889, 722, 238, 333, 333, 389, 584, 278, 333, 278, 278, 556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 333, 333, 584, 584, 584, 611,
+           975, 722, 722, 722, 722, 667, 611, 778, 722, 278, 556, 722, 611, 833, 722, 778, 667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 333, 278, 333, 584, 556,
+           333, 556, 611, 556, 611, 556, 333, 611, 611, 278, 278, 556, 278, 889, 611, 611, 611, 611, 389, 556, 333, 611, 556, 778, 556, 556, 500, 389, 280, 389, 584]}
+
+def resolve_render_engine(job, config):
+    """Motor de render de un trabajo: el del trabajo, si no el de config ('render_engine'). Uno desconocido vuelve a 'docx'."""
+    engine = (job or {}).get('engine') or config.get(CONFIG_KEY_RENDER_ENGINE) or "docx"
+    if engine not in RENDER_ENGINES: print(f"WARN: Motor de render desconocido '{engine}' (disponibles: {', '.join(RENDER_ENGINES)}). Se usa docx."); engine = "docx"
+    if engine == "hibrido" and not pypdf_available(): print("WARN: El motor híbrido necesita pypdf (pip install pypdf). Se usa docx."); engine = "docx"
+    return engine
+
+def text_width(text, size, bold=False):
+    """Ancho en puntos de una línea en Helvetica (o Helvetica-Bold) a ese tamaño."""
+    widths = _HELVETICA_WIDTHS[bold]; total = 0
+    for ch in text:
+        code = ord(ch) if ord(ch) < 127 else ord(unicodedata.normalize('NFD', ch)[0])
+        total += widths[code - 32] if 32 <= code < 127 else 556
+    return total * size / 1000
+
+def wrap_text(text, size, width, bold=False):
+    """Parte el texto en líneas que caben en width puntos. Respeta los saltos de línea y corta palabras más largas que la línea."""
+    lines = []
+    for paragraph in str(text or '').splitlines() or ['']:
+        line = ""
+        for word in paragraph.split(' '):
+            candidate = f"{line} {word}" if line else word
+            if text_width(candidate, size, bold) <= width: line = candidate; continue
+            if line: lines.append(line)
+            while len(word) > 1 and text_width(word, size, bold) > width:
+                cut = next((n for n in range(len(word) - 1, 0, -1) if text_width(word[:n], size, bold) <= width), 1); lines.append(word[:cut]); word = word[cut:]
+            line = word
+        lines.append(line)
+    return lines
+
+def jpeg_info(data):
+    """(ancho, alto, componentes) leídos del marcador SOF del JPEG, sin decodificarlo. ValueError si no es un JPEG válido."""
+    if data[:2] != b'\xff\xd8': raise ValueError("No es un JPEG.")
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF: i += 1; continue
+        marker = data[i + 1]
+        if marker == 0xFF or marker == 0x01 or 0xD0 <= marker <= 0xD8: i += 1 if marker == 0xFF else 2; continue # Relleno y marcadores sin longitud
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC): return int.from_bytes(data[i + 7:i + 9], 'big'), int.from_bytes(data[i + 5:i + 7], 'big'), data[i + 9]
+        i += 2 + int.from_bytes(data[i + 2:i + 4], 'big')
+    raise ValueError("JPEG sin cabecera SOF.")
+
+class NativePdf:
+    """PDF mínimo escrito a mano: páginas A4, Helvetica y Helvetica-Bold (WinAnsi), rectángulos y fotos JPEG incrustadas
+    tal cual (DCTDecode, sin decodificar ni recomprimir). Coordenadas en puntos desde la esquina superior izquierda."""
+    def __init__(self):
+        self.pages = []; self.images = {} # sha1 del JPEG -> (nombre, bytes, ancho, alto, componentes); una foto repetida se incrusta una vez
+        self.add_page()
+
+    def add_page(self):
+        self.ops = []; self.used = set(); self.pages.append((self.ops, self.used)) # Cada página declara solo las fotos que dibuja
+
+    def text(self, x, y, text, size=9, bold=False):
+        """Escribe una línea con la línea base en y."""
+        self.ops.append(b"BT /%s %.1f Tf %.2f %.2f Td (%s) Tj ET" % (b"F2" if bold else b"F1", size, x, PDF_PAGE_H - y, _pdf_string(text)))
+
+    def rect(self, x, y, w, h, line_width=0.5):
+        self.ops.append(b"%.2f w %.2f %.2f %.2f %.2f re S" % (line_width, x, PDF_PAGE_H - y - h, w, h))
+
+    def image(self, jpeg, x, y, w, h):
+        """Coloca un JPEG en el rectángulo (x, y, w, h)."""
+        key = hashlib.sha1(jpeg).hexdigest()
+        if key not in self.images: self.images[key] = (b"Im%d" % (len(self.images) + 1), jpeg, *jpeg_info(jpeg))
+        self.ops.append(b"q %.2f 0 0 %.2f %.2f %.2f cm /%s Do Q" % (w, h, x, PDF_PAGE_H - y - h, self.images[key][0])); self.used.add(key)
+
+    def to_bytes(self):
+        first_page = 5 + len(self.images) # 1 catálogo, 2 páginas, 3-4 fuentes, luego imágenes y cada página con su contenido
+        objects = [b"<< /Type /Catalog /Pages 2 0 R >>", b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % (first_page + 2 * n) for n in range(len(self.pages))), len(self.pages)),
+                   b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>", b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold /Encoding /WinAnsiEncoding >>"]
+        xrefs = {}
+        for n, (key, (name, jpeg, width, height, components)) in enumerate(self.images.items()):
+            colorspace = {1: b"/DeviceGray", 4: b"/DeviceCMYK /Decode [1 0 1 0 1 0 1 0]"}.get(components, b"/DeviceRGB") # CMYK de Adobe va invertido
+            objects.append(b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace %s /BitsPerComponent 8 /Filter /DCTDecode /Length %d >>\nstream\n" % (width, height, colorspace, len(jpeg)) + jpeg + b"\nendstream")
+            xrefs[key] = b"/%s %d 0 R" % (name, 5 + n)
+        for n, (ops, used) in enumerate(self.pages):
+            stream = zlib.compress(b"\n".join(ops)); resources = b"<< /Font << /F1 3 0 R /F2 4 0 R >> /XObject << %s >> >>" % b" ".join(xrefs[key] for key in self.images if key in used)
+            objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.2f %.2f] /Resources %s /Contents %d 0 R >>" % (PDF_PAGE_W, PDF_PAGE_H, resources, first_page + 2 * n + 1))
+            objects.append(b"<< /Length %d /Filter /FlateDecode >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        return _serialize_pdf(objects)
+
+def render_native_pdf(context):
+    """Dibuja el reporte directo a PDF con el mismo contexto que la plantilla (image_rows con los JPEG ya comprimidos, en bytes):
+    recuadro de la cirugía, registro de envío (fecha de emisión, código, ID), tabla de campos con observaciones y las fotos
+    como las coloca la plantilla (ver _draw_photo_grid). Las páginas fijas de la plantilla (nota de devolución y encuesta)
+    no se reproducen. Devuelve los bytes del PDF."""
+    pdf = NativePdf(); left = PDF_MARGIN; width = PDF_PAGE_W - 2 * PDF_MARGIN; bottom = PDF_PAGE_H - PDF_MARGIN; pad = 4.0; size = 9; leading = 11.0
+    value = lambda key: str(context.get(key) or '')
+    y = PDF_MARGIN
+    def row(cells):
+        """Fila de celdas con borde [(ancho, texto, negrita)]; si no cabe en la página sigue en la siguiente."""
+        nonlocal y
+        pending = [wrap_text(text, size, cell_w - 2 * pad, bold) for cell_w, text, bold in cells]
+        while any(pending):
+            fit = int((bottom - y - 2 * pad) // leading)
+            if fit < min(2, max(len(lines) for lines in pending)): pdf.add_page(); y = PDF_MARGIN; continue
+            n = min(fit, max(len(lines) for lines in pending)); height = n * leading + 2 * pad; x = left
+            for (cell_w, _, bold), lines in zip(cells, pending):
+                pdf.rect(x, y, cell_w, height)
+                for i, line in enumerate(lines[:n]): pdf.text(x + pad, y + pad + (i + 1) * leading - 2.5, line, size, bold)
+                x += cell_w
+            pending = [lines[n:] for lines in pending]; y += height
+    row([(width, "\n".join(f"{label}: {value(key)}" for label, key in (("Fecha de cirugía", 'fecha_cirugia'), ("Nombre del Doctor", 'medico'), ("Paciente", 'paciente'), ("Tipo de cirugía", 'tipo_cirugia'), ("Lugar", 'lugar'))), False)])
+    y += 18
+    row([(width - 140, "REGISTRO DE ENVIO DE MATERIALES", True), (140, f"FECHA\n{value('fecha_emision_corta')}", False)])
+    row([(width - 140, "INSTRUMENTAL, IMPLANTES, DESCARTABLES, EQUIPO", True), (140, "CODIGO:\nREG -C3-01-01-G", False)])
+    y += 6
+    if y + leading > bottom: pdf.add_page(); y = PDF_MARGIN
+    pdf.text(left, y + leading, f"ID: {value('unique_id')}", size); y += leading + 6
+    for label, key in (("CLIENTE", 'cliente'), ("PACIENTE", 'paciente'), ("MEDICO", 'medico'), ("INSTITUCIÓN", 'lugar'), ("TECNICO:", 'tecnico'), ("COORDINADOR DE CX", 'coordinador_cx'),
+                       ("ENCARGADO DE LOGISTICA", 'encargado_logistica'), ("ENCARGADO/A DE PREPARACIÓN DE LA CAJA", 'encargado_preparacion'), ("OBSERVACIONES:", 'observaciones_generales')):
+        row([(150, label, True), (width - 150, value(key), False)])
+    _draw_photo_grid(pdf, context.get('image_rows'), y + 12.0)
+    return pdf.to_bytes()
+
+def _draw_photo_grid(pdf, image_rows, y):
+    """Fotos desde y como en el bucle image_rows de template.docx: una por fila, centradas y de LAYOUT_2_PER_ROW_WIDTH_MM
+    de ancho, en grupos de IMAGES_PER_TEMPLATE_ROW separados por una línea. Una foto que no cabe pasa a la página siguiente."""
+    bottom = PDF_PAGE_H - PDF_MARGIN
+    for group in image_rows or []:
+        for jpeg in group:
+            if not jpeg: continue
+            img_w, img_h, _ = jpeg_info(jpeg); w = LAYOUT_2_PER_ROW_WIDTH_MM * MM_TO_PT; h = w * img_h / img_w
+            if h > bottom - PDF_MARGIN: h = bottom - PDF_MARGIN; w = h * img_w / img_h # Foto vertical más alta que la página
+            if y + h > bottom: pdf.add_page(); y = PDF_MARGIN
+            pdf.image(jpeg, (PDF_PAGE_W - w) / 2, y, w, h); y += h + PHOTO_ROW_GAP_PT
+        y += PHOTO_GROUP_GAP_PT
+
+# --- Ensamblado Híbrido ---
+TEXT_PDF_CACHE_MAX_FILES = 500 # Partes de texto convertidas que se conservan (LRU por mtime)
+_pypdf_available = None # pypdf importable (se comprueba una vez)
+
+def pypdf_available():
+    """True si pypdf (opcional; une la parte de texto con las páginas de fotos) está instalado."""
+    global _pypdf_available
+    if _pypdf_available is None:
+        try: import pypdf; _pypdf_available = True
+        except ImportError: _pypdf_available = False
+    return _pypdf_available
+
+def render_photo_pages(image_rows):
+    """Páginas de fotos del modo híbrido: las fotos de render_native_pdf (ver _draw_photo_grid), solas. Devuelve los bytes del PDF (b"" sin fotos)."""
+    if not any(any(row) for row in image_rows or []): return b""
+    pdf = NativePdf(); _draw_photo_grid(pdf, image_rows, PDF_MARGIN); return pdf.to_bytes()
+
+def text_pdf_cache_dir(config):
+    return Path(config.get(CONFIG_KEY_TEXT_CACHE_DIR) or (Path(DB_FILENAME).resolve().parent / "cache_texto_pdf")).resolve()
+
+def lookup_text_pdf(fingerprint, cache_dir):
+    """Parte de texto ya convertida con esa huella, o None. Un acierto renueva su fecha (LRU)."""
+    if not fingerprint: return None
+    path = Path(cache_dir) / f"{fingerprint}.pdf"
+    try: os.utime(path)
+    except OSError: return None
+    print(f"Caché texto: reutilizando {path.name}"); return path
+
+def store_text_pdf(fingerprint, pdf_path, cache_dir):
+    """Guarda una copia de la parte de texto recién convertida y poda la caché a TEXT_PDF_CACHE_MAX_FILES."""
+    if not fingerprint: return
+    cache_dir = Path(cache_dir); partial_path = cache_dir / f"{fingerprint}.pdf.partial"
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True); shutil.copyfile(pdf_path, partial_path); os.replace(partial_path, cache_dir / f"{fingerprint}.pdf")
+        entries = sorted(cache_dir.glob("*.pdf"), key=lambda p: p.stat().st_mtime)
+        for old in entries[:max(0, len(entries) - TEXT_PDF_CACHE_MAX_FILES)]: old.unlink(missing_ok=True)
+    except OSError as e: print(f"WARN: Parte de texto no guardada en caché: {e}")
+
+def merge_pdf_parts(parts, output_pdf_path):
+    """Une PDFs (bytes, en orden) en output_pdf_path con pypdf, que copia los streams sin recomprimir. Devuelve (ok, mensaje_error)."""
+    from pypdf import PdfReader, PdfWriter
+    writer = PdfWriter(); buffer = io.BytesIO()
+    try:
+        for part in parts: writer.append(PdfReader(io.BytesIO(part)))
+        writer.write(buffer)
+    except Exception as e: error_msg = f"Unión de PDF: {type(e).__name__}: {e}"; print(f"ERROR: {error_msg}"); return False, error_msg
+    return _write_pdf_bytes(buffer.getvalue(), output_pdf_path)
+
+def _assemble_hybrid(prepared, text_pdf_path, output_pdf_path):
+    """Modo híbrido: guarda en caché la parte de texto si es nueva y le añade las páginas de fotos en output_pdf_path.
+    Devuelve (ok, mensaje_error)."""
+    if not prepared.get('text_pdf'): store_text_pdf(prepared.get('text_fingerprint'), text_pdf_path, prepared['text_cache_dir'])
+    try: text_bytes = Path(text_pdf_path).read_bytes()
+    except OSError as e: return False, f"Parte de texto no legible: {e}"
+    if not prepared['photo_pdf_bytes']: return _write_pdf_bytes(text_bytes, output_pdf_path)
+    return merge_pdf_parts([text_bytes, prepared['photo_pdf_bytes']], output_pdf_path)
+
+def _needs_conversion(prepared):
+    """False si el reporte preparado ya no pasa por el conversor (PDF nativo o parte de texto en caché)."""
+    return prepared.get('pdf_bytes') is None and not prepared.get('text_pdf')
+
+# --- Capa de Base de Datos ---
+class DatabaseManager:
+    """Conexión SQLite única y compartida entre el hilo Tk y los hilos de trabajo.
+    WAL + pragmas ajustados, caché de sentencias preparadas y contadores de tiempo por consulta."""
+    def __init__(self, db_path):
+        self.db_path = Path(db_path).resolve(); self.lock = threading.RLock(); self.conn = None
+        self.query_stats = {} # sql -> [llamadas, segundos totales, segundos máx.]
+
+    def _connect(self):
+        if self.conn is not None: return self.conn
+        conn = sqlite3.connect(self.db_path, timeout=DB_BUSY_TIMEOUT, check_same_thread=False, isolation_level=None, cached_statements=DB_CACHED_STATEMENTS)
+        conn.row_factory = sqlite3.Row
+        mode = conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+        if str(mode).lower() != "wal": print(f"WARN: La BD no admite WAL (journal_mode={mode}).")
+        conn.execute("PRAGMA synchronous=NORMAL"); conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE_MB * 1024 * 1024}"); conn.execute("PRAGMA temp_store=MEMORY")
+        self.conn = conn; return conn
+
+    def _record(self, sql, elapsed):
+        entry = self.query_stats.setdefault(sql, [0, 0.0, 0.0]); entry[0] += 1; entry[1] += elapsed; entry[2] = max(entry[2], elapsed)
+        if elapsed > DB_SLOW_QUERY_S: print(f"WARN: Consulta lenta ({elapsed:.3f}s): {sql[:120]}")
+
+    def execute(self, sql, params=()):
+        """Ejecuta una sentencia y devuelve el cursor (sin leer filas)."""
+        with self.lock:
+            start_t = time.perf_counter()
+            try: return self._connect().execute(sql, params)
+            finally: self._record(sql, time.perf_counter() - start_t)
+
+    def query(self, sql, params=()):
+        """Ejecuta una consulta y devuelve todas las filas (sqlite3.Row)."""
+        with self.lock:
+            start_t = time.perf_counter()
+            try: return self._connect().execute(sql, params).fetchall()
+            finally: self._record(sql, time.perf_counter() - start_t)
+
+    def query_one(self, sql, params=()):
+        """Ejecuta una consulta y devuelve la primera fila o None."""
+        with self.lock:
+            start_t = time.perf_counter()
+            try: return self._connect().execute(sql, params).fetchone()
+            finally: self._record(sql, time.perf_counter() - start_t)
+
+    @contextmanager
+    def transaction(self):
+        """Bloque transaccional: BEGIN IMMEDIATE ... COMMIT (o ROLLBACK si hay excepción)."""
+        with self.lock:
+            conn = self._connect(); conn.execute("BEGIN IMMEDIATE")
+            try: yield self
+            except BaseException: conn.execute("ROLLBACK"); raise
+            else: conn.execute("COMMIT")
+
+    def stats(self):
+        """Contadores por consulta, ordenados por tiempo total: [(sql, llamadas, total_s, max_s)]."""
+        with self.lock: items = [(sql, n, total, mx) for sql, (n, total, mx) in self.query_stats.items()]
+        return sorted(items, key=lambda it: it[2], reverse=True)
+
+    def close(self):
+        with self.lock:
+            if self.conn is None: return
+            try: self.conn.execute("PRAGMA optimize"); self.conn.close()
+            except sqlite3.Error as e: print(f"WARN: Error cerrando BD: {e}")
+            self.conn = None
+
+def get_db():
+    """Devuelve el DatabaseManager de DB_FILENAME (lo recrea si la ruta cambió)."""
+    global _db
+    db_path = Path(DB_FILENAME).resolve()
+    with _db_lock:
+        if _db is None or _db.db_path != db_path:
+            if _db is not None: _db.close()
+            _db = DatabaseManager(db_path)
+        return _db
+
+def close_db():
+    """Cierra la conexión compartida e imprime las consultas más costosas."""
+    global _db
+    with _db_lock:
+        if _db is None: return
+        for sql, n, total, mx in _db.stats()[:5]: print(f"DB stats: {n}x {total:.3f}s (máx {mx:.3f}s) {sql[:80]}")
+        _db.close(); _db = None
+
+atexit.register(close_db)
 
 def init_db():
     """Inicializa la base de datos."""
-    conn = None; db_path = Path(DB_FILENAME).resolve(); print(f"DB Init: {db_path}")
+    db_path = Path(DB_FILENAME).resolve(); print(f"DB Init: {db_path}")
     if not db_path.parent.exists():
         try: db_path.parent.mkdir(parents=True, exist_ok=True)
         except OSError as e: print(f"FATAL: No crear dir DB: {e}"); sys.exit()
     try:
-        conn = sqlite3.connect(db_path, timeout=10); cursor = conn.cursor()
-        cursor.execute("CREATE TABLE IF NOT EXISTS cirugias (id TEXT PRIMARY KEY, fecha_generacion TEXT NOT NULL, archivo_pdf TEXT, fecha_cirugia TEXT, cliente TEXT, paciente TEXT, medico TEXT, tecnico TEXT, tipo_cirugia TEXT, lugar TEXT, observaciones_generales TEXT, encargado_preparacion TEXT, encargado_logistica TEXT, coordinador_cx TEXT, observaciones_logistica TEXT, unique_id TEXT UNIQUE NOT NULL)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_fecha_gen ON cirugias (fecha_generacion);"); cursor.execute("CREATE INDEX IF NOT EXISTS idx_paciente ON cirugias (paciente);"); cursor.execute("CREATE INDEX IF NOT EXISTS idx_medico ON cirugias (medico);"); cursor.execute("CREATE INDEX IF NOT EXISTS idx_unique_id ON cirugias (unique_id);")
-        conn.commit(); print("DB OK.")
+        with get_db().transaction() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS cirugias (id TEXT PRIMARY KEY, fecha_generacion TEXT NOT NULL, archivo_pdf TEXT, fecha_cirugia TEXT, cliente TEXT, paciente TEXT, medico TEXT, tecnico TEXT, tipo_cirugia TEXT, lugar TEXT, observaciones_generales TEXT, encargado_preparacion TEXT, encargado_logistica TEXT, coordinador_cx TEXT, observaciones_logistica TEXT, unique_id TEXT UNIQUE NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_fecha_gen ON cirugias (fecha_generacion);"); db.execute("CREATE INDEX IF NOT EXISTS idx_paciente ON cirugias (paciente);"); db.execute("CREATE INDEX IF NOT EXISTS idx_medico ON cirugias (medico);"); db.execute("CREATE INDEX IF NOT EXISTS idx_unique_id ON cirugias (unique_id);")
+            _migrate_fecha_cirugia_iso(db); _create_sort_indexes(db)
+            _init_stats_tables(db)
+            db.execute("CREATE TABLE IF NOT EXISTS imagenes (hash TEXT PRIMARY KEY, bytes INTEGER, ancho_mm INTEGER, calidad INTEGER, creado TEXT)")
+            db.execute("CREATE TABLE IF NOT EXISTS cirugia_imagenes (cirugia_id TEXT NOT NULL, orden INTEGER NOT NULL, hash TEXT NOT NULL, PRIMARY KEY (cirugia_id, orden)) WITHOUT ROWID")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_cirugia_imagenes_hash ON cirugia_imagenes (hash);")
+            db.execute("CREATE TRIGGER IF NOT EXISTS cirugia_imagenes_ad AFTER DELETE ON cirugias BEGIN DELETE FROM cirugia_imagenes WHERE cirugia_id = old.id; END")
+            db.execute("CREATE TABLE IF NOT EXISTS render_cache (huella TEXT PRIMARY KEY, cirugia_id TEXT NOT NULL, pdf TEXT NOT NULL, bytes INTEGER, mtime_ns INTEGER, creado TEXT)")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_render_cache_cirugia ON render_cache (cirugia_id);")
+            db.execute("CREATE TABLE IF NOT EXISTS generation_metrics (id INTEGER PRIMARY KEY, cirugia_id TEXT, tipo TEXT NOT NULL, inicio TEXT NOT NULL, etapa TEXT NOT NULL, duracion_s REAL NOT NULL, imagenes INTEGER, bytes_entrada INTEGER, bytes_salida INTEGER, ok INTEGER NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_metrics_inicio ON generation_metrics (inicio);")
+            db.execute("CREATE TABLE IF NOT EXISTS generation_jobs (id INTEGER PRIMARY KEY, estado TEXT NOT NULL, trabajo TEXT NOT NULL, paciente TEXT, archivo_pdf TEXT, intentos INTEGER NOT NULL DEFAULT 0, creado TEXT NOT NULL, inicio TEXT, fin TEXT, cirugia_id TEXT, error TEXT, progreso TEXT, propietario TEXT, latido REAL)")
+            job_columns = {r['name'] for r in db.query("PRAGMA table_info(generation_jobs)")}
+            for column, kind in (('propietario', 'TEXT'), ('latido', 'REAL')): # Colas creadas antes de los latidos
+                if column not in job_columns: db.execute(f"ALTER TABLE generation_jobs ADD COLUMN {column} {kind}")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_estado ON generation_jobs (estado, id);")
+        print("DB OK.")
     except sqlite3.Error as e: print(f"FATAL: DB Init Error: {e}"); sys.exit()
-    finally:
-        if conn: conn.close()
-
-def save_record(record_data):
+    init_fts()
+
+def normalize_date_iso(value):
+    """Convierte una fecha de texto libre (YYYY-MM-DD, DD/MM/YYYY, DD-MM-YY, ISO con hora...) a 'YYYY-MM-DD'. None si no se reconoce."""
+    text = str(value or "").strip()
+    if not text: return None
+    try: return datetime.fromisoformat(text).date().isoformat()
+    except ValueError: pass
+    for fmt in ('%d/%m/%Y', '%d-%m-%Y', '%Y/%m/%d', '%d.%m.%Y', '%d/%m/%y', '%d-%m-%y'):
+        try: return datetime.strptime(text.split(" ")[0], fmt).date().isoformat()
+        except ValueError: continue
+    return None
+
+def _migrate_fecha_cirugia_iso(db):
+    """Añade fecha_cirugia_iso (fecha_cirugia normalizada) con su índice y rellena las filas pendientes."""
+    if 'fecha_cirugia_iso' not in {r['name'] for r in db.query("PRAGMA table_info(cirugias)")}:
+        db.execute("ALTER TABLE cirugias ADD COLUMN fecha_cirugia_iso TEXT"); print("INFO: Columna fecha_cirugia_iso añadida.")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_fecha_cx_iso ON cirugias (fecha_cirugia_iso);")
+    pending = db.query("SELECT rowid, fecha_cirugia FROM cirugias WHERE fecha_cirugia_iso IS NULL AND fecha_cirugia IS NOT NULL AND TRIM(fecha_cirugia) != ''")
+    updates = [(iso, rowid) for rowid, fecha in pending if (iso := normalize_date_iso(fecha))]
+    for iso, rowid in updates: db.execute("UPDATE cirugias SET fecha_cirugia_iso = ? WHERE rowid = ?", (iso, rowid))
+    if updates: print(f"INFO: fecha_cirugia_iso rellenada en {len(updates)} registros.")
+    if len(updates) < len(pending): print(f"WARN: {len(pending) - len(updates)} registros con fecha_cirugia no reconocida.")
+
+def _init_stats_tables(db):
+    """Crea stats_mensuales (conteos por dimensión y mes de generación) mantenida por triggers en la misma transacción que el INSERT."""
+    exists = db.query_one("SELECT 1 FROM sqlite_master WHERE type='table' AND name='stats_mensuales'") is not None
+    db.execute("CREATE TABLE IF NOT EXISTS stats_mensuales (dimension TEXT NOT NULL, valor TEXT NOT NULL, mes TEXT NOT NULL, cantidad INTEGER NOT NULL, PRIMARY KEY (dimension, valor, mes)) WITHOUT ROWID")
+    def upsert(ref, delta):
+        return " ".join(f"INSERT INTO stats_mensuales (dimension, valor, mes, cantidad) SELECT '{col}', TRIM({ref}.{col}), substr({ref}.fecha_generacion, 1, 7), {delta} WHERE TRIM(COALESCE({ref}.{col}, '')) != '' ON CONFLICT (dimension, valor, mes) DO UPDATE SET cantidad = cantidad + ({delta});" for col in STATS_DIMENSIONS.values())
+    purge = "DELETE FROM stats_mensuales WHERE cantidad <= 0;"; cols = ", ".join(STATS_DIMENSIONS.values())
+    db.execute(f"CREATE TRIGGER IF NOT EXISTS stats_mensuales_ai AFTER INSERT ON cirugias BEGIN {upsert('new', 1)} END")
+    db.execute(f"CREATE TRIGGER IF NOT EXISTS stats_mensuales_ad AFTER DELETE ON cirugias BEGIN {upsert('old', -1)} {purge} END")
+    db.execute(f"CREATE TRIGGER IF NOT EXISTS stats_mensuales_au AFTER UPDATE OF fecha_generacion, {cols} ON cirugias BEGIN {upsert('old', -1)} {upsert('new', 1)} {purge} END")
+    if not exists:
+        for col in STATS_DIMENSIONS.values(): db.execute(f"INSERT INTO stats_mensuales (dimension, valor, mes, cantidad) SELECT '{col}', TRIM({col}), substr(fecha_generacion, 1, 7), COUNT(*) FROM cirugias WHERE TRIM(COALESCE({col}, '')) != '' GROUP BY 2, 3")
+        print("INFO: Tabla stats_mensuales creada y rellenada.")
+
+def init_fts():
+    """Crea el índice de texto completo cirugias_fts (triggers + carga inicial). Sin FTS5 se usa LIKE."""
+    global fts_available
+    cols = list(FTS_COLUMNS); col_list = ", ".join(cols); new_vals = ", ".join(f"new.{c}" for c in cols)
+    try:
+        with get_db().transaction() as db:
+            exists = db.query_one("SELECT 1 FROM sqlite_master WHERE type='table' AND name='cirugias_fts'") is not None
+            # Tabla FTS con copia del texto y 'id' como enlace: no depende del rowid de cirugias (VACUUM puede renumerarlo)
+            db.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS cirugias_fts USING fts5(id UNINDEXED, {col_list}, tokenize='unicode61 remove_diacritics 2')")
+            db.execute(f"CREATE TRIGGER IF NOT EXISTS cirugias_fts_ai AFTER INSERT ON cirugias BEGIN INSERT INTO cirugias_fts (id, {col_list}) VALUES (new.id, {new_vals}); END")
+            db.execute("CREATE TRIGGER IF NOT EXISTS cirugias_fts_ad AFTER DELETE ON cirugias BEGIN DELETE FROM cirugias_fts WHERE id = old.id; END")
+            db.execute(f"CREATE TRIGGER IF NOT EXISTS cirugias_fts_au AFTER UPDATE OF id, {col_list} ON cirugias BEGIN DELETE FROM cirugias_fts WHERE id = old.id; INSERT INTO cirugias_fts (id, {col_list}) VALUES (new.id, {new_vals}); END")
+            if not exists:
+                start_t = time.time(); db.execute(f"INSERT INTO cirugias_fts (id, {col_list}) SELECT id, {col_list} FROM cirugias")
+                print(f"INFO: Índice de texto completo creado ({time.time() - start_t:.2f}s).")
+        fts_available = True
+    except sqlite3.OperationalError as e: fts_available = False; print(f"WARN: Búsqueda de texto sin FTS5 (se usará LIKE): {e}")
+
+def save_record(record_data, images=()):
     """Guarda registro. Devuelve True/False. Guarda error en global."""
-    global last_db_error; last_db_error = ""
-    conn = None; required = ['id', 'unique_id', 'fecha_generacion']
+    global last_db_error
+    ok, last_db_error = insert_record(record_data, images); return ok
+
+def insert_record(record_data, images=()):
+    """Inserta un registro en cirugias y, en la misma transacción, sus imágenes archivadas
+    ('images': [{'hash', 'bytes', 'ancho_mm', 'calidad'}] en orden). Devuelve (ok, mensaje_error)."""
+    required = ['id', 'unique_id', 'fecha_generacion']
     if not all(f in record_data and record_data[f] for f in required):
         missing = [f for f in required if not record_data.get(f)]
-        last_db_error = f"Faltan campos DB: {', '.join(missing)}"; print(f"ERROR DB SAVE: {last_db_error}"); return False
-    db_path = Path(DB_FILENAME).resolve()
+        error_msg = f"Faltan campos DB: {', '.join(missing)}"; print(f"ERROR DB SAVE: {error_msg}"); return False, error_msg
     try:
-        conn = sqlite3.connect(db_path, timeout=10); cursor = conn.cursor()
         # Excluir claves que no deben ir a la BD explícitamente
-        keys_to_exclude_from_db = ['image_pairs', 'fecha_emision', 'fecha_emision_corta'] # Cambiado a image_pairs
+        keys_to_exclude_from_db = ['image_rows', 'fecha_emision', 'fecha_emision_corta']
         db_data = {k: v for k, v in record_data.items() if k not in keys_to_exclude_from_db}
+        if 'fecha_cirugia' in db_data: db_data['fecha_cirugia_iso'] = normalize_date_iso(db_data['fecha_cirugia'])
 
         fields = list(db_data.keys()); values = list(db_data.values())
         placeholders = ','.join(['?'] * len(fields)); sql = f"INSERT INTO cirugias ({','.join(fields)}) VALUES ({placeholders})"
         print(f"DEBUG DB SQL: {sql}"); print(f"DEBUG DB Values: {values}")
-        cursor.execute(sql, values); conn.commit(); print(f"DB Save OK (ID: {record_data.get('id')})"); return True
+        with get_db().transaction() as db:
+            rowid = db.execute(sql, values).lastrowid; created = record_data.get('fecha_generacion')
+            for orden, img in enumerate(images):
+                db.execute("INSERT OR IGNORE INTO imagenes (hash, bytes, ancho_mm, calidad, creado) VALUES (?, ?, ?, ?, ?)", (img['hash'], img.get('bytes'), img.get('ancho_mm'), img.get('calidad'), created))
+                db.execute("INSERT INTO cirugia_imagenes (cirugia_id, orden, hash) VALUES (?, ?, ?)", (record_data['id'], orden, img['hash']))
+        print(f"DB Save OK (ID: {record_data.get('id')})"); get_suggestion_index().add_record(db_data, rowid); return True, ""
     except sqlite3.IntegrityError as e:
-        if "unique constraint failed: cirugias.unique_id" in str(e).lower(): last_db_error = f"ID único '{record_data.get('unique_id')}' ya existe."
-        else: last_db_error = f"Error integridad DB: {e}"
-        print(f"ERROR DB SAVE (Integrity): {last_db_error}"); return False
+        if "unique constraint failed: cirugias.unique_id" in str(e).lower(): error_msg = f"ID único '{record_data.get('unique_id')}' ya existe."
+        else: error_msg = f"Error integridad DB: {e}"
+        print(f"ERROR DB SAVE (Integrity): {error_msg}"); return False, error_msg
     except sqlite3.Error as e:
-        last_db_error = f"Error general DB: {e}"; print(f"ERROR DB SAVE (General): {last_db_error}"); return False
-    finally:
-        if conn: conn.close()
+        error_msg = f"Error general DB: {e}"; print(f"ERROR DB SAVE (General): {error_msg}"); return False, error_msg
 
-def get_suggestions(field_name, limit=30):
-    """Obtiene sugerencias para campos."""
-    conn = None; suggestions = []; db_path = Path(DB_FILENAME).resolve()
-    allowed = ['cliente', 'medico', 'tecnico', 'tipo_cirugia', 'lugar', 'encargado_preparacion', 'encargado_logistica', 'coordinador_cx']
-    if field_name not in allowed: return []
-    try:
-        conn = sqlite3.connect(db_path, timeout=5); cursor = conn.cursor()
-        sql = f"SELECT DISTINCT {field_name} FROM cirugias WHERE {field_name} IS NOT NULL AND TRIM({field_name}) != '' ORDER BY fecha_generacion DESC LIMIT ?"
-        cursor.execute(sql, (limit,)); suggestions = sorted([str(row[0]) for row in cursor.fetchall() if row[0]])
-    except sqlite3.Error as e: print(f"Error sugerencias '{field_name}': {e}")
-    finally:
-        if conn: conn.close()
-    return suggestions
+def get_suggestions(field_name, limit=SUGGESTION_LIMIT, prefix=""):
+    """Obtiene sugerencias para campos desde el índice en memoria (lo carga si hace falta)."""
+    if field_name not in SUGGESTION_FIELDS: return []
+    index = get_suggestion_index()
+    if not index.ready.is_set(): index.build()
+    return index.search(field_name, prefix, limit)
 
 def get_record_by_id(record_id):
     """Obtiene un registro completo por ID."""
-    conn = None; record = None; db_path = Path(DB_FILENAME).resolve()
     if not record_id: return None
-    try:
-        conn = sqlite3.connect(db_path, timeout=5); conn.row_factory = sqlite3.Row; cursor = conn.cursor()
-        cursor.execute("SELECT * FROM cirugias WHERE id = ?", (record_id,)); record = cursor.fetchone()
-        return dict(record) if record else None
+    try: record = get_db().query_one("SELECT * FROM cirugias WHERE id = ?", (record_id,)); return dict(record) if record else None
     except sqlite3.Error as e: print(f"Error get ID '{record_id}': {e}"); return None
-    finally:
-        if conn: conn.close()
+
+def get_record_images(record_id, config):
+    """Imágenes archivadas de un registro, en el orden del reporte: [Path]. Omite (con aviso) las que falten en disco."""
+    archive = get_image_archive(config)
+    if not archive or not record_id: return []
+    try: rows = get_db().query("SELECT hash FROM cirugia_imagenes WHERE cirugia_id = ? ORDER BY orden", (record_id,))
+    except sqlite3.Error as e: print(f"Error imágenes de '{record_id}': {e}"); return []
+    paths = []
+    for row in rows:
+        path = archive.path_for(row[0])
+        if path.exists(): paths.append(path)
+        else: print(f"WARN: Imagen archivada no encontrada: {path}")
+    return paths
+
+def get_counts_by_dimension(dimension, month_from=None, month_to=None):
+    """Conteos por valor de 'dimension' (columna de STATS_DIMENSIONS) leídos de stats_mensuales. Meses 'YYYY-MM' inclusivos."""
+    counts = []
+    if dimension not in STATS_DIMENSIONS.values(): return []
+    sql = "SELECT valor, SUM(cantidad) AS count FROM stats_mensuales WHERE dimension = ?"; params = [dimension]
+    if month_from: sql += " AND mes >= ?"; params.append(month_from)
+    if month_to: sql += " AND mes <= ?"; params.append(month_to)
+    sql += " GROUP BY valor ORDER BY count DESC, valor ASC"
+    try: counts = [tuple(row) for row in get_db().query(sql, params)]
+    except sqlite3.Error as e: print(f"Error conteos '{dimension}': {e}")
+    return counts
+
+def get_monthly_counts(dimension, valor=None):
+    """Serie mensual [(mes, cantidad)] de una dimensión (o de un valor concreto) para cuadros de mando."""
+    if dimension not in STATS_DIMENSIONS.values(): return []
+    sql = "SELECT mes, SUM(cantidad) FROM stats_mensuales WHERE dimension = ?"; params = [dimension]
+    if valor is not None: sql += " AND valor = ?"; params.append(valor)
+    try: return [tuple(row) for row in get_db().query(sql + " GROUP BY mes ORDER BY mes", params)]
+    except sqlite3.Error as e: print(f"Error serie mensual '{dimension}': {e}"); return []
 
 def get_counts_by_preparador():
      """Obtiene conteos por preparador."""
-     conn = None; counts = []; db_path = Path(DB_FILENAME).resolve()
-     try:
-         conn = sqlite3.connect(db_path, timeout=5); cursor = conn.cursor()
-         sql = "SELECT encargado_preparacion, COUNT(*) as count FROM cirugias WHERE encargado_preparacion IS NOT NULL AND TRIM(encargado_preparacion) != '' GROUP BY encargado_preparacion ORDER BY count DESC, encargado_preparacion ASC"
-         cursor.execute(sql); counts = cursor.fetchall()
-     except sqlite3.Error as e: print(f"Error conteos prep: {e}")
-     finally:
-         if conn: conn.close()
-     return counts
+     return get_counts_by_dimension('encargado_preparacion')
+
+RECORD_LIST_COLUMNS = ['id', 'fecha_generacion', 'fecha_cirugia', 'paciente', 'medico', 'tipo_cirugia', 'lugar', 'encargado_preparacion', 'unique_id']
+
+DATE_FILTER_COLUMNS = {'Generado': 'fecha_generacion', 'Cirugía': 'fecha_cirugia_iso'} # Etiqueta -> columna ISO filtrable por rango
+
+def build_record_filters(d_from=None, d_to=None, medico=None, paciente=None, cliente=None, unique_id=None, date_column='fecha_generacion'):
+    """Cláusula WHERE y parámetros para los filtros de la ventana de registros.
+    Las fechas ('YYYY-MM-DD', inclusivas) se comparan como rango sobre la columna ISO para que use su índice."""
+    sql = "1=1"; params = []
+    if date_column not in DATE_FILTER_COLUMNS.values(): raise ValueError(f"Columna de fecha no válida: {date_column}")
+    if d_from: sql += f" AND {date_column} >= ?"; params.append(d_from)
+    if d_to: sql += f" AND {date_column} < ?"; params.append((datetime.strptime(d_to, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d'))
+    if medico: sql += " AND medico LIKE ? COLLATE NOCASE"; params.append(f"%{medico}%")
+    if paciente: sql += " AND paciente LIKE ? COLLATE NOCASE"; params.append(f"%{paciente}%")
+    if cliente: sql += " AND cliente LIKE ? COLLATE NOCASE"; params.append(f"%{cliente}%")
+    if unique_id: sql += " AND unique_id = ?"; params.append(unique_id)
+    return sql, params
+
+# Columna de la tabla de registros -> (expresión SQL de orden, descendente por defecto). Los NULL se ordenan como ''
+# y cada expresión tiene índice (ver _create_sort_indexes) para que ORDER BY + paginación no recorran la tabla.
+RECORD_SORT_COLUMNS = {'fecha_gen': ('fecha_generacion', True), 'fecha_cx': ("COALESCE(fecha_cirugia_iso, '')", True),
+                       'paciente': ("COALESCE(paciente, '') COLLATE NOCASE", False), 'medico': ("COALESCE(medico, '') COLLATE NOCASE", False),
+                       'tipo': ("COALESCE(tipo_cirugia, '') COLLATE NOCASE", False), 'lugar': ("COALESCE(lugar, '') COLLATE NOCASE", False),
+                       'enc_prep': ("COALESCE(encargado_preparacion, '') COLLATE NOCASE", False), 'unique_id_col': ('unique_id', False)}
+DEFAULT_RECORD_SORT = RECORD_SORT_COLUMNS['fecha_gen']
+
+def _create_sort_indexes(db):
+    """Índices de expresión para las columnas ordenables que admiten NULL."""
+    for key, (expr, _) in RECORD_SORT_COLUMNS.items():
+        if "(" in expr: db.execute(f"CREATE INDEX IF NOT EXISTS idx_sort_{key} ON cirugias ({expr})")
+
+def _records_page_sql(where_sql, params, after=None, limit=STATS_PAGE_SIZE, sort=DEFAULT_RECORD_SORT):
+    expr, descending = sort; op = "<" if descending else ">"; direction = "DESC" if descending else "ASC"
+    sql = f"SELECT rowid, {expr} AS sort_key, {', '.join(RECORD_LIST_COLUMNS)} FROM cirugias WHERE {where_sql}"; params = list(params)
+    if after: sql += f" AND {expr} {op}= ? AND ({expr} {op} ? OR rowid {op} ?)"; params.extend([after[0], after[0], after[1]]) # Keyset (clave, rowid) en forma que SQLite acota con el índice
+    sql += f" ORDER BY {expr} {direction}, rowid {direction} LIMIT ?"; params.append(limit)
+    return sql, params
+
+def get_records_page(where_sql, params, after=None, limit=STATS_PAGE_SIZE, sort=DEFAULT_RECORD_SORT):
+    """Página de registros (solo columnas de la tabla) ordenada por 'sort' (expresión, descendente); por defecto, más recientes primero.
+    'after' es la clave (valor de orden, rowid) de la última fila ya cargada. Devuelve (filas, clave_siguiente o None)."""
+    sql, params = _records_page_sql(where_sql, params, after, limit, sort); rows = [dict(r) for r in get_db().query(sql, params)]
+    next_key = (rows[-1]['sort_key'], rows[-1]['rowid']) if len(rows) == limit else None
+    return rows, next_key
+
+def check_query_plans():
+    """EXPLAIN QUERY PLAN de los filtros por fecha y de la paginación ordenada. Devuelve [(descripción, índice esperado, plan, ok)]."""
+    checks = [("Rango fecha generación", 'idx_fecha_gen', build_record_filters('2024-01-01', '2024-12-31'), None, DEFAULT_RECORD_SORT),
+              ("Rango fecha cirugía", 'idx_fecha_cx_iso', build_record_filters('2024-01-01', '2024-12-31', date_column='fecha_cirugia_iso'), None, DEFAULT_RECORD_SORT),
+              ("Página siguiente por paciente", 'idx_sort_paciente', build_record_filters(), ('m', 1), RECORD_SORT_COLUMNS['paciente']),
+              ("Página siguiente por fecha cirugía", 'idx_sort_fecha_cx', build_record_filters(), ('2024-01-01', 1), RECORD_SORT_COLUMNS['fecha_cx'])]
+    results = []
+    for label, index_name, (where_sql, params), after, sort in checks:
+        sql, params = _records_page_sql(where_sql, params, after, sort=sort)
+        plan = " | ".join(r[3] for r in get_db().query(f"EXPLAIN QUERY PLAN {sql}", params))
+        results.append((label, index_name, plan, f"INDEX {index_name}" in plan))
+    return results
+
+def _search_terms(text):
+    """Palabras de la búsqueda (letras/dígitos), sin comillas ni operadores FTS."""
+    return re.findall(r"\w+", text or "")
+
+def search_records(text, where_sql="1=1", params=(), limit=SEARCH_RESULT_LIMIT, sort=None):
+    """Registros que contienen todas las palabras de 'text' como prefijo (sin tildes ni mayúsculas), mejor puntuados primero
+    (o por 'sort', ver RECORD_SORT_COLUMNS). Respeta los filtros de build_record_filters. Sin FTS5 recurre a LIKE ordenado por fecha."""
+    terms = _search_terms(text); cols = ", ".join(f"c.{c}" for c in RECORD_LIST_COLUMNS)
+    if not terms: return get_records_page(where_sql, params, limit=limit, sort=sort or DEFAULT_RECORD_SORT)[0]
+    order_sql = f"{sort[0]} {'DESC' if sort[1] else 'ASC'}, " if sort else ""
+    if fts_available:
+        match = " ".join('"' + t.replace('"', '""') + '"*' for t in terms); weights = ", ".join(str(w) for w in FTS_COLUMNS.values())
+        sql = (f"SELECT c.rowid AS rowid, {cols} FROM cirugias c JOIN (SELECT id AS fts_id, bm25(cirugias_fts, 0, {weights}) AS score FROM cirugias_fts WHERE cirugias_fts MATCH ?) m ON c.id = m.fts_id"
+               f" WHERE {where_sql} ORDER BY {order_sql}m.score, c.fecha_generacion DESC LIMIT ?")
+        return [dict(r) for r in get_db().query(sql, [match, *params, limit])]
+    like_sql = " AND ".join("(" + " OR ".join(f"{c} LIKE ? COLLATE NOCASE" for c in FTS_COLUMNS) + ")" for _ in terms)
+    like_params = [f"%{t}%" for t in terms for _ in FTS_COLUMNS]
+    sql = f"SELECT c.rowid AS rowid, {cols} FROM cirugias c WHERE {where_sql} AND {like_sql} ORDER BY {order_sql}fecha_generacion DESC LIMIT ?"
+    return [dict(r) for r in get_db().query(sql, [*params, *like_params, limit])]
+
+# --- Índice de Sugerencias ---
+def _fold_text(text):
+    """Normaliza para comparar: sin tildes, sin mayúsculas y sin espacios sobrantes."""
+    decomposed = unicodedata.normalize("NFKD", str(text).strip())
+    return " ".join("".join(c for c in decomposed if not unicodedata.combining(c)).casefold().split())
+
+class SuggestionIndex:
+    """Valores históricos por campo, ordenados por frecuencia y recencia, con búsqueda por prefijo.
+    Se construye una vez desde la BD y se actualiza en memoria con cada registro guardado."""
+    def __init__(self, fields=SUGGESTION_FIELDS):
+        self.fields = list(fields); self.lock = threading.Lock(); self.ready = threading.Event(); self.max_rowid = 0
+        self.entries = {f: {} for f in self.fields} # campo -> clave normalizada -> [texto, usos, última fecha]
+        self.keys = {f: [] for f in self.fields} # campo -> [(sufijo desde cada palabra, clave)] ordenado (bisect para prefijos)
+
+    def _add(self, field, value, fecha):
+        value = str(value or "").strip(); key = _fold_text(value)
+        if not key: return
+        entry = self.entries[field].get(key)
+        if entry is None:
+            self.entries[field][key] = [value, 1, fecha]; words = key.split(" ")
+            for i in range(len(words)): bisect.insort(self.keys[field], (" ".join(words[i:]), key)) # "alv" encuentra "Dr. Álvarez"
+            return
+        entry[1] += 1
+        if fecha >= entry[2]: entry[0] = value; entry[2] = fecha # Se muestra la grafía más reciente
+
+    def build(self):
+        """Carga todo el historial con una sola consulta."""
+        with self.lock:
+            if self.ready.is_set(): return
+            start_t = time.time(); cols = ", ".join(self.fields)
+            try: rows = get_db().query(f"SELECT rowid, fecha_generacion, {cols} FROM cirugias")
+            except sqlite3.Error as e: print(f"Error índice sugerencias: {e}"); return
+            for row in rows:
+                fecha = row[1] or ""; self.max_rowid = max(self.max_rowid, row[0])
+                for i, field in enumerate(self.fields): self._add(field, row[2 + i], fecha)
+            self.ready.set()
+        print(f"Índice de sugerencias: {len(rows)} registros en {time.time() - start_t:.2f}s.")
+
+    def add_record(self, record, rowid):
+        """Incorpora un registro recién guardado (ignorado si el índice aún no se ha cargado o ya lo incluye)."""
+        with self.lock:
+            if not self.ready.is_set() or rowid <= self.max_rowid: return
+            self.max_rowid = rowid; fecha = record.get('fecha_generacion') or ""
+            for field in self.fields:
+                if field in record: self._add(field, record[field], fecha)
+
+    def _score(self, entry, now):
+        try: age_days = max(0.0, (now - datetime.fromisoformat(entry[2])).total_seconds() / 86400)
+        except (ValueError, TypeError): age_days = SUGGESTION_HALF_LIFE_DAYS * 4
+        return entry[1] * 0.5 ** (age_days / SUGGESTION_HALF_LIFE_DAYS)
+
+    def search(self, field, prefix="", limit=SUGGESTION_LIMIT):
+        """Valores de 'field' con alguna palabra que empieza por 'prefix' (sin tildes ni mayúsculas), mejor puntuados primero."""
+        if field not in self.entries: return []
+        prefix = _fold_text(prefix); now = datetime.now()
+        with self.lock:
+            keys = self.keys[field]; entries = self.entries[field]; lo = bisect.bisect_left(keys, (prefix, "")); matches = {}
+            for subkey, key in keys[lo:]:
+                if not subkey.startswith(prefix): break
+                matches[key] = entries[key]
+            matches = matches.values()
+            ranked = sorted(matches, key=lambda e: (-self._score(e, now), e[0].casefold()))
+        return [e[0] for e in ranked[:limit]]
+
+def get_suggestion_index():
+    """Devuelve el índice de sugerencias compartido (sin construirlo)."""
+    global _suggestion_index
+    with _suggestion_index_lock:
+        if _suggestion_index is None: _suggestion_index = SuggestionIndex()
+        return _suggestion_index
+
+# --- Caché de Plantilla ---
+def ensure_generation_stack():
+    """Importa docxtpl, python-docx y jinja2 y define las clases de la caché de plantilla (una vez, seguro entre hilos).
+    Se difiere para que la ventana aparezca sin esperar ~0.2 s de importaciones que solo hacen falta al generar."""
+    global DocxTemplate, InlineImage, Mm, _CompiledTemplateEnvironment, _CachedDocxTemplate
+    if _CachedDocxTemplate is not None: return
+    with _generation_stack_lock:
+        if _CachedDocxTemplate is not None: return
+        start_t = time.perf_counter()
+        import jinja2
+        from docxtpl import DocxTemplate, InlineImage
+        from docx.shared import Mm
+
+        class _CompiledTemplateEnvironment(jinja2.Environment):
+            """Entorno Jinja que memoriza from_string(): el XML de cada parte de la plantilla se compila una sola vez."""
+            def __init__(self):
+                super().__init__(); self._compiled = {}; self._compiled_lock = threading.Lock()
+
+            def from_string(self, source, globals=None, template_class=None):
+                if globals or template_class: return super().from_string(source, globals, template_class)
+                compiled = self._compiled.get(source)
+                if compiled is None:
+                    compiled = super().from_string(source)
+                    with self._compiled_lock: self._compiled[source] = compiled
+                return compiled
+
+        class _CachedDocxTemplate(DocxTemplate):
+            """DocxTemplate de un solo uso que reutiliza el XML del cuerpo ya parcheado y el Jinja compilado de TemplateCache."""
+            def __init__(self, template_file, template_cache):
+                super().__init__(template_file); self._template_cache = template_cache
+
+            def render(self, context, jinja_env=None, autoescape=False):
+                if jinja_env is None and not autoescape: jinja_env = self._template_cache.jinja_env
+                super().render(context, jinja_env, autoescape)
+
+            def build_xml(self, context, jinja_env=None):
+                if jinja_env is not self._template_cache.jinja_env: return super().build_xml(context, jinja_env)
+                return self.render_xml_part(self._template_cache.body_xml, self.docx._part, context, jinja_env)
+        print(f"DEBUG: docxtpl/python-docx/jinja2 cargados en {time.perf_counter() - start_t:.2f}s.")
+
+class TemplateCache:
+    """Plantilla DOCX cargada una vez (bytes, XML parcheado y Jinja compilado) que entrega copias baratas por render.
+    Se recarga sola cuando cambia el mtime/tamaño del archivo."""
+    def __init__(self, template_path):
+        self.template_path = Path(template_path); self.lock = threading.Lock(); self._stamp = None
+        self.template_bytes = None; self.body_xml = None; self.jinja_env = None; self.version = None
+
+    def _refresh(self):
+        st = self.template_path.stat(); stamp = (st.st_mtime_ns, st.st_size)
+        if stamp == self._stamp: return
+        start_t = time.time(); template_bytes = self.template_path.read_bytes()
+        probe = DocxTemplate(io.BytesIO(template_bytes)); probe.init_docx()
+        self.body_xml = probe.patch_xml(probe.get_xml()); self.template_bytes = template_bytes
+        self.jinja_env = _CompiledTemplateEnvironment(); self.version = hashlib.sha1(template_bytes).hexdigest(); self._stamp = stamp
+        print(f"Plantilla cargada: {self.template_path.name} (versión {self.version[:10]}, {time.time() - start_t:.2f}s)")
+
+    def new_document(self):
+        """Devuelve un DocxTemplate listo para render(), independiente de los demás."""
+        with self.lock: self._refresh(); return _CachedDocxTemplate(io.BytesIO(self.template_bytes), self)
+
+    def current_version(self):
+        """SHA-1 de la plantilla actual en disco (recarga si cambió)."""
+        with self.lock: self._refresh(); return self.version
+
+def get_template(template_path=None):
+    """Devuelve la TemplateCache de la plantilla indicada (TEMPLATE_FILENAME por defecto)."""
+    ensure_generation_stack(); template_path = Path(template_path or TEMPLATE_FILENAME).resolve()
+    if not template_path.exists(): raise FileNotFoundError(f"Plantilla '{template_path.name}' no encontrada.")
+    with _template_caches_lock:
+        cache = _template_caches.get(template_path)
+        if cache is None: cache = _template_caches[template_path] = TemplateCache(template_path)
+    return cache
+
+# --- Caché de Resultados de Render ---
+RENDER_FINGERPRINT_VERSION = 2 # Cambiar si cambia cómo se arma el documento (invalida todas las huellas)
+
+def render_fingerprint(context, image_hashes, config, engine="docx"):
+    """Huella del documento final: versión de la plantilla y/o del dibujo nativo + todo lo que se imprime (campos normalizados,
+    QR y fecha de emisión corta) + hashes de las imágenes en orden. Así un PDF solo se reutiliza el mismo día en que se emitió;
+    'fecha_emision' (con hora) no entra porque no se imprime. engine 'hibrido-texto' identifica la parte de texto del motor
+    híbrido (sin imágenes). None si la caché está desactivada."""
+    if not config.get(CONFIG_KEY_RENDER_CACHE_ENABLED, True): return None
+    fields = {k: "\n".join(str(context.get(k) or '').strip().splitlines()) for k in REPORT_FIELDS}
+    key = {'v': RENDER_FINGERPRINT_VERSION, 'plantilla': get_template().current_version() if engine != "nativo" else None, 'campos': fields, 'unique_id': context.get('unique_id'), 'emision': context.get('fecha_emision_corta'), 'imagenes': list(image_hashes)}
+    if engine != "docx": key.update({'motor': engine, 'dibujo': NATIVE_LAYOUT_VERSION})
+    return hashlib.sha1(json.dumps(key, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def lookup_rendered_pdf(fingerprint):
+    """PDF ya producido con esa huella (y sin modificar desde entonces) o None. Cuenta aciertos/fallos."""
+    if not fingerprint: return None
+    row = None
+    try: row = get_db().query_one("SELECT pdf, bytes, mtime_ns FROM render_cache WHERE huella = ?", (fingerprint,))
+    except sqlite3.Error as e: print(f"Error caché render: {e}")
+    path = Path(row['pdf']) if row else None
+    try: valid = path is not None and (lambda st: st.st_size == row['bytes'] and st.st_mtime_ns == row['mtime_ns'])(path.stat())
+    except OSError: valid = False
+    with _render_cache_lock: _render_cache_stats['hits' if valid else 'misses'] += 1
+    if valid: print(f"Caché render: reutilizando {path.name}"); return path
+    return None
+
+def remember_rendered_pdf(fingerprint, record_id, pdf_path):
+    """Anota el PDF producido para una huella (para reutilizarlo en regeneraciones idénticas)."""
+    if not fingerprint: return
+    try:
+        st = Path(pdf_path).stat()
+        with get_db().transaction() as db: db.execute("INSERT OR REPLACE INTO render_cache (huella, cirugia_id, pdf, bytes, mtime_ns, creado) VALUES (?, ?, ?, ?, ?, ?)", (fingerprint, record_id, str(Path(pdf_path).resolve()), st.st_size, st.st_mtime_ns, datetime.now().isoformat(timespec='seconds')))
+    except (OSError, sqlite3.Error) as e: print(f"WARN: No se anotó en caché render: {e}")
+
+def render_cache_stats():
+    """Aciertos/fallos de la caché de render en esta sesión."""
+    with _render_cache_lock: hits, misses = _render_cache_stats['hits'], _render_cache_stats['misses']
+    return {'hits': hits, 'misses': misses, 'hit_rate': hits / (hits + misses) if hits + misses else 0.0}
+
+def _reuse_pdf(src_pdf, output_pdf_path):
+    """Copia un PDF de la caché de render a su destino (nada que hacer si es el mismo archivo). Devuelve (ok, mensaje_error)."""
+    src_pdf = Path(src_pdf); output_pdf_path = Path(output_pdf_path)
+    if src_pdf.resolve() == output_pdf_path.resolve(): return True, ""
+    tmp_path = output_pdf_path.with_name(f".{output_pdf_path.name}.{uuid.uuid4().hex[:8]}.part")
+    try: shutil.copyfile(src_pdf, tmp_path); os.replace(tmp_path, output_pdf_path); return True, ""
+    except OSError as e:
+        tmp_path.unlink(missing_ok=True); return False, f"No se copió el PDF existente '{src_pdf.name}': {e}"
+
+# --- Métricas de Generación ---
+METRIC_STAGES = ['datos', 'imagenes', 'render', 'conversion', 'reutilizado', 'guardado', 'importacion', 'ventana', 'bd', 'sugerencias', 'precarga', 'total'] # Orden del informe
+
+class GenerationMetrics:
+    """Tiempos por etapa de un reporte (vueltas de cronómetro) con nº de imágenes y bytes, para generation_metrics."""
+    def __init__(self, kind):
+        self.kind = kind; self.started = datetime.now().isoformat(timespec='seconds'); self.t0 = time.perf_counter(); self.mark = self.t0; self.stages = []
+
+    def lap(self, stage, **info):
+        """Cierra la etapa 'stage' con el tiempo transcurrido desde la etapa anterior."""
+        now = time.perf_counter(); self.add(stage, now - self.mark, **info)
+
+    def add(self, stage, duration, images=None, bytes_in=None, bytes_out=None):
+        """Registra una etapa con duración explícita (p.ej. la parte de una conversión por tandas)."""
+        self.stages.append((stage, duration, images, bytes_in, bytes_out)); self.mark = time.perf_counter()
+
+    def save(self, record_id, ok, config, total=None):
+        """Guarda las etapas y el total (por defecto, el tiempo desde la creación) en generation_metrics. No lanza excepciones."""
+        if not config.get(CONFIG_KEY_METRICS_ENABLED, True) or not self.stages: return
+        rows = [(record_id, self.kind, self.started, stage, duration, images, bytes_in, bytes_out, int(bool(ok))) for stage, duration, images, bytes_in, bytes_out in self.stages]
+        rows.append((record_id, self.kind, self.started, 'total', time.perf_counter() - self.t0 if total is None else total, None, None, None, int(bool(ok))))
+        try:
+            with get_db().transaction() as db:
+                for row in rows: db.execute("INSERT INTO generation_metrics (cirugia_id, tipo, inicio, etapa, duracion_s, imagenes, bytes_entrada, bytes_salida, ok) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+        except sqlite3.Error as e: print(f"WARN: No se guardaron métricas: {e}")
+
+def _percentile(sorted_values, pct):
+    """Percentil por rango más cercano sobre una lista ordenada."""
+    if not sorted_values: return None
+    return sorted_values[max(0, min(len(sorted_values) - 1, int(-(-pct * len(sorted_values) // 100)) - 1))]
+
+def get_stage_percentiles(date_from=None, date_to=None, kind=None, only_ok=True):
+    """p50/p95/máx por etapa en un rango de fechas ('YYYY-MM-DD', inclusivo).
+    Devuelve [{'etapa', 'n', 'p50', 'p95', 'max', 'imagenes_media', 'mb_entrada_media', 'mb_salida_media'}] en orden de METRIC_STAGES."""
+    sql = "SELECT etapa, duracion_s, imagenes, bytes_entrada, bytes_salida FROM generation_metrics WHERE 1=1"; params = []
+    if date_from: sql += " AND inicio >= ?"; params.append(date_from)
+    if date_to: sql += " AND inicio < ?"; params.append((datetime.strptime(date_to, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d'))
+    if kind: sql += " AND tipo = ?"; params.append(kind)
+    if only_ok: sql += " AND ok = 1"
+    by_stage = {}
+    for stage, duration, images, bytes_in, bytes_out in get_db().query(sql, params): by_stage.setdefault(stage, []).append((duration, images, bytes_in, bytes_out))
+    mean = lambda values: sum(values) / len(values) if values else None
+    report = []
+    for stage in sorted(by_stage, key=lambda s: METRIC_STAGES.index(s) if s in METRIC_STAGES else len(METRIC_STAGES)):
+        rows = by_stage[stage]; durations = sorted(r[0] for r in rows)
+        report.append({'etapa': stage, 'n': len(rows), 'p50': _percentile(durations, 50), 'p95': _percentile(durations, 95), 'max': durations[-1],
+                       'imagenes_media': mean([r[1] for r in rows if r[1] is not None]),
+                       'mb_entrada_media': (lambda m: m / 1048576 if m is not None else None)(mean([r[2] for r in rows if r[2] is not None])),
+                       'mb_salida_media': (lambda m: m / 1048576 if m is not None else None)(mean([r[3] for r in rows if r[3] is not None]))})
+    return report
+
+# --- Pipeline de Generación (sin GUI) ---
+REPORT_FIELDS = ['fecha_cirugia', 'cliente', 'paciente', 'medico', 'tecnico', 'tipo_cirugia', 'lugar', 'observaciones_generales', 'encargado_preparacion', 'encargado_logistica', 'coordinador_cx', 'observaciones_logistica']
+
+def sanitize_filename(name):
+    """Limpia un nombre de archivo."""
+    if not name: return "_"
+    valid = "-_.() abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"; san = ''.join(c for c in name if c in valid)
+    san = san.replace(' ', '_'); san = san.strip('_.- '); return san[:100] or "_"
+
+def suggested_report_filename(fields, suffix=""):
+    """Nombre de PDF derivado del registro: Reporte_<paciente>_<cliente>_<fecha>[suffix].pdf"""
+    p = sanitize_filename(fields.get('paciente', '')) or "P"; c = sanitize_filename(fields.get('cliente', '')) or "C"
+    try: f = datetime.strptime(str(fields.get('fecha_cirugia', '')), '%Y-%m-%d').strftime('%Y%m%d')
+    except ValueError: f = datetime.now().strftime('%Y%m%d')
+    return f"Reporte_{p}_{c}_{f}{suffix}.pdf"
+
+def new_report_job(fields, image_paths, output_pdf_path, image_quality=IMG_QUALITY_HIGH, engine=None):
+    """Foto fija de un reporte a generar (campos del formulario, imágenes y destino), sin dependencias de Tk.
+    engine ('docx' o 'nativo') fija el motor de render para este reporte; None usa el de config."""
+    job = {'fields': {k: str(fields.get(k) or '').strip() for k in REPORT_FIELDS},
+           'image_paths': [str(p) for p in image_paths][:MAX_IMAGES_ALLOWED], 'output_pdf': str(output_pdf_path), 'quality': int(image_quality)}
+    if engine: job['engine'] = engine
+    return job
+
+def generate_report(job, config, progress_cb=None, cancel_event=None):
+    """Genera un reporte completo: compresión, render DOCX, conversión PDF y save_record.
+    Devuelve dict {ok, pdf, error, record_id, unique_id, images, duration}. No lanza excepciones.
+    cancel_event (threading.Event) detiene la compresión entre imágenes y mata la conversión en curso (error "Cancelado.")."""
+    progress = progress_cb or (lambda message: None)
+    prepared = prepare_report(job, config, progress, cancel_event)
+    try:
+        if prepared['result']['error']: return prepared['result']
+        output_pdf_path = Path(job['output_pdf'])
+        progress("Paso 4/5: Convirtiendo a PDF...")
+        ok, err = _convert_prepared(prepared, output_pdf_path, cancel_event); prepared['metrics'].lap('conversion', bytes_out=_file_size(output_pdf_path) if ok else None)
+        if not ok: prepared['result']['error'] = err if err == "Cancelado." else f"Conversión PDF: {err}"; prepared['result']['duration'] = time.time() - prepared['start_time']; return prepared['result']
+        progress("Paso 5/5: Guardando registro...")
+        return finish_report(prepared, output_pdf_path)
+    finally: prepared['metrics'].save(prepared['result']['record_id'], prepared['result']['ok'], config); _cleanup_prepared(prepared)
+
+def prepare_report(job, config, progress_cb=None, cancel_event=None):
+    """Pasos 1-3: contexto, compresión de imágenes y render del DOCX (en memoria o a un DOCX temporal) o, con el motor
+    nativo, del PDF directamente. Devuelve dict con 'result' (ver generate_report), 'record' (datos para la BD),
+    'docx_bytes', 'docx_path' o 'pdf_bytes' y temporales."""
+    progress = progress_cb or (lambda message: None)
+    start_time = time.time(); record_id = job.get('record_id') or str(uuid.uuid4()); unique_id_for_qr = str(uuid.uuid4()) # La cola fija record_id al encolar
+    result = {'ok': False, 'pdf': None, 'error': "", 'record_id': record_id, 'unique_id': unique_id_for_qr, 'images': 0, 'duration': 0.0}
+    prepared = {'result': result, 'record': None, 'docx_bytes': None, 'docx_path': None, 'pdf_bytes': None, 'photo_pdf_bytes': None, 'text_pdf': None, 'temp_files': [], 'images': [], 'start_time': start_time, 'metrics': GenerationMetrics('generacion')}
+    metrics = prepared['metrics']; engine = resolve_render_engine(job, config)
+    print(f"\n--- GENERACIÓN INICIADA (Q:{job['quality']}, Imágenes: {len(job['image_paths'])}, Motor: {engine}) ---")
+    try:
+        progress("Paso 1/5: Recopilando datos...")
+        context = dict(job['fields']); context['image_rows'] = []; context['unique_id'] = unique_id_for_qr
+        now = datetime.now(); context['fecha_emision'] = now.strftime('%d/%m/%Y %H:%M:%S'); context['fecha_emision_corta'] = now.strftime('%d/%m/%Y'); print(f"DEBUG: Fecha emisión: {context['fecha_emision']}")
+        progress("Paso 1/5: Preparando archivos...")
+        in_memory = config.get(CONFIG_KEY_IN_MEMORY, True)
+        output_pdf_path = Path(job['output_pdf'])
+        if not in_memory and engine != "nativo": prepared['docx_path'] = Path(output_pdf_path.parent / f"temp_docx_{record_id[:8]}.docx").resolve()
+        doc = get_template().new_document() if engine != "nativo" else None; metrics.lap('datos')
+        progress("Paso 2/5: Procesando imágenes...")
+        processed_images = []; image_paths = job['image_paths']; num_images = len(image_paths); target_width_mm = LAYOUT_2_PER_ROW_WIDTH_MM # Usar ancho para 2 columnas
+        workers = resolve_image_workers(config.get(CONFIG_KEY_IMG_WORKERS)); print(f"DEBUG: Procesando {num_images} imágenes (target width: {target_width_mm}mm, procesos: {workers}).")
+        image_cache = get_image_cache(config); image_archive = get_image_archive(config); configure_decode_budget(config.get(CONFIG_KEY_DECODE_BUDGET_MB, 512))
+        compressed = compress_images(image_paths, target_width_mm, job['quality'], workers, progress_cb=lambda n, t, name: progress(f"Paso 2/5: Procesando imagen {n}/{t}..."), cache=image_cache, fast_decode=config.get(CONFIG_KEY_FAST_DECODE, True), in_memory=in_memory, cancel_event=cancel_event)
+        if cancel_event is not None and cancel_event.is_set():
+            prepared['temp_files'].extend(c for c in compressed if isinstance(c, Path) and not (image_cache and image_cache.owns(c)))
+            print("INFO: Generación cancelada durante la compresión."); result['error'] = "Cancelado."; result['duration'] = time.time() - start_time; return prepared
+        bytes_in = sum(_file_size(p) or 0 for p in image_paths); bytes_out = 0
+        for img_path_str, compressed_img in zip(image_paths, compressed): # Orden original
+            if compressed_img:
+                bytes_out += len(compressed_img) if isinstance(compressed_img, bytes) else (_file_size(compressed_img) or 0)
+                if isinstance(compressed_img, bytes): img_source = io.BytesIO(compressed_img); img_label = f"{Path(img_path_str).name} (memoria)"
+                else:
+                    if not (image_cache and image_cache.owns(compressed_img)): prepared['temp_files'].append(compressed_img) # Las entradas de caché no se borran
+                    img_source = str(compressed_img); img_label = compressed_img.name
+                if engine != "docx": processed_images.append(compressed_img if isinstance(compressed_img, bytes) else Path(compressed_img).read_bytes()) # El JPEG tal cual, sin InlineImage
+                else:
+                    try: processed_images.append(InlineImage(doc, img_source, width=Mm(target_width_mm))); print(f"DEBUG: InlineImage creado para '{img_label}'")
+                    except Exception as img_add_error: print(f"ERROR Add InlineImage: {img_label}: {img_add_error}"); continue
+                if image_archive: # Copia permanente para poder regenerar el reporte con sus fotos
+                    try:
+                        data = compressed_img if isinstance(compressed_img, bytes) else Path(compressed_img).read_bytes()
+                        prepared['images'].append({'hash': image_archive.store(data), 'bytes': len(data), 'ancho_mm': target_width_mm, 'calidad': job['quality']})
+                    except OSError as archive_error: print(f"WARN: No se archivó {img_label}: {archive_error}")
+            else: print(f"WARN: Falló compresión, se omite: {Path(img_path_str).name}")
+        result['images'] = len(processed_images); print(f"DEBUG: Total InlineImage procesados: {len(processed_images)}"); metrics.lap('imagenes', images=len(processed_images), bytes_in=bytes_in, bytes_out=bytes_out)
+        # Agrupar en pares para la plantilla
+        context['image_rows'] = template_image_rows(processed_images)
+        if len(prepared['images']) == len(processed_images): prepared['fingerprint'] = render_fingerprint(context, [img['hash'] for img in prepared['images']], config, engine) # Para reutilizar el PDF al regenerar; solo si se archivaron todas las fotos
+        elif image_archive: print(f"WARN: {len(processed_images) - len(prepared['images'])} imágenes sin archivar; el PDF no se registra en la caché de render.")
+        progress("Paso 3/5: Generando PDF..." if engine == "nativo" else "Paso 3/5: Generando DOCX..."); print(f"DEBUG: Contexto Keys={list(context.keys())}")
+        render_context = _prepare_hybrid(prepared, context, config) if engine == "hibrido" else context # Híbrido: la plantilla sin fotos
+        if engine == "nativo": prepared['pdf_bytes'] = render_native_pdf(context); print(f"PDF nativo OK en memoria ({len(prepared['pdf_bytes']) // 1024} KB).")
+        elif prepared['text_pdf']: pass # Parte de texto ya convertida: sin render DOCX
+        elif in_memory: docx_buffer = io.BytesIO(); doc.render(render_context); doc.save(docx_buffer); prepared['docx_bytes'] = docx_buffer.getvalue(); print(f"DOCX OK en memoria ({len(prepared['docx_bytes']) // 1024} KB).")
+        else: print(f"Renderizando DOCX: {prepared['docx_path']}..."); doc.render(render_context); doc.save(prepared['docx_path']); print("DOCX OK.")
+        metrics.lap('render', bytes_out=_prepared_size(prepared))
+        record_data = {k: v for k, v in context.items() if k not in ['image_rows', 'fecha_emision', 'fecha_emision_corta']} # Excluir image_rows y fechas
+        record_data.update({'id': record_id, 'unique_id': unique_id_for_qr}); prepared['record'] = record_data
+    except FileNotFoundError as e: print(f"ERROR Generación (FileNotFound): {e}"); result['error'] = f"Archivo no encontrado: {e}"
+    except Exception as e: print(f"ERROR Generación (General): {type(e).__name__} - {e}\n{traceback.format_exc()}"); result['error'] = f"Error inesperado: {type(e).__name__}: {e}"
+    if result['error']: result['duration'] = time.time() - start_time
+    return prepared
+
+def _prepared_size(prepared):
+    """Bytes del documento renderizado de un reporte preparado (PDF nativo, DOCX en memoria o temporal y páginas de fotos del híbrido)."""
+    if prepared.get('pdf_bytes') is not None: return len(prepared['pdf_bytes'])
+    docx_size = len(prepared['docx_bytes']) if prepared['docx_bytes'] is not None else _file_size(prepared['docx_path'])
+    return (docx_size or 0) + len(prepared['photo_pdf_bytes']) if prepared.get('photo_pdf_bytes') is not None else docx_size
+
+def _prepare_hybrid(prepared, context, config):
+    """Motor híbrido: dibuja las páginas de fotos y busca la parte de texto en caché. Devuelve el contexto para la plantilla (sin fotos)."""
+    prepared['photo_pdf_bytes'] = render_photo_pages(context.get('image_rows')); text_context = dict(context, image_rows=[])
+    prepared['text_fingerprint'] = render_fingerprint(text_context, [], config, "hibrido-texto"); prepared['text_cache_dir'] = text_pdf_cache_dir(config)
+    prepared['text_pdf'] = lookup_text_pdf(prepared['text_fingerprint'], prepared['text_cache_dir'])
+    print(f"Híbrido: {len(prepared['photo_pdf_bytes']) // 1024} KB de páginas de fotos, parte de texto {'en caché' if prepared['text_pdf'] else 'a convertir'}.")
+    return text_context
+
+def _file_size(path):
+    """Tamaño en bytes o None si no existe."""
+    try: return os.path.getsize(path)
+    except (OSError, TypeError): return None
+
+def template_image_rows(images):
+    """Agrupa las imágenes (InlineImage o bytes JPEG) de a IMAGES_PER_TEMPLATE_ROW, con None al final del último grupo,
+    para el bucle 'image_rows' de la plantilla (cada grupo es una tabla de 3 celdas apiladas: row[0], row[1], row[2])."""
+    n = IMAGES_PER_TEMPLATE_ROW
+    return [tuple(images[i:i + n]) + (None,) * (n - len(images[i:i + n])) for i in range(0, len(images), n)]
+
+def finish_report(prepared, pdf_path):
+    """Paso 5: guarda el registro apuntando al PDF ya generado. Devuelve el dict result."""
+    result = prepared['result']; result['pdf'] = str(pdf_path)
+    record_data = dict(prepared['record']); record_data.update({'fecha_generacion': datetime.now().isoformat(timespec='seconds'), 'archivo_pdf': result['pdf']})
+    ok, err = insert_record(record_data, prepared.get('images', ()))
+    if ok: result['ok'] = True; remember_rendered_pdf(prepared.get('fingerprint'), record_data['id'], pdf_path)
+    else: result['error'] = f"Base de Datos: {err}"
+    if prepared.get('metrics'): prepared['metrics'].lap('guardado')
+    result['duration'] = time.time() - prepared['start_time']
+    print(f"--- GENERACIÓN FINALIZADA (Dur: {result['duration']:.2f}s, Éxito: {result['ok']}{', Error: ' + result['error'] if result['error'] else ''}) ---")
+    return result
+
+def _convert_prepared(prepared, output_pdf_path, cancel_event=None):
+    """Convierte el DOCX de un reporte preparado (bytes o archivo temporal) a output_pdf_path; un PDF nativo solo se escribe
+    y en el híbrido se añaden las páginas de fotos a la parte de texto (convertida o de caché). Devuelve (ok, mensaje_error)."""
+    if prepared.get('pdf_bytes') is not None: return _write_pdf_bytes(prepared['pdf_bytes'], output_pdf_path)
+    if prepared.get('text_pdf'): return _assemble_hybrid(prepared, prepared['text_pdf'], output_pdf_path)
+    if prepared['docx_bytes'] is not None: ok, err = convert_docx_bytes_to_pdf(prepared['docx_bytes'], output_pdf_path, f"reporte_{prepared['result']['record_id'][:8]}", cancel_event=cancel_event)
+    else:
+        temp_docx_path = prepared['docx_path']; ok, err = _convert_to_pdf(temp_docx_path, output_pdf_path.parent, cancel_event=cancel_event)
+        if ok: ok, err = _move_pdf(temp_docx_path.with_suffix('.pdf'), output_pdf_path)
+    if ok and prepared.get('photo_pdf_bytes') is not None: ok, err = _assemble_hybrid(prepared, output_pdf_path, output_pdf_path) # Texto recién convertido + fotos
+    return ok, err
+
+def _write_pdf_bytes(pdf_bytes, output_pdf_path):
+    """Escribe un PDF ya armado en su destino (vía archivo parcial + os.replace). Devuelve (ok, mensaje_error)."""
+    partial_path = Path(f"{output_pdf_path}.partial")
+    try: partial_path.write_bytes(pdf_bytes); os.replace(partial_path, output_pdf_path); return True, ""
+    except OSError as write_error:
+        partial_path.unlink(missing_ok=True); error_msg = f"No se pudo escribir '{output_pdf_path}': {write_error}"; print(f"ERROR: {error_msg}"); return False, error_msg
+
+def _move_pdf(src_pdf, output_pdf_path):
+    """Mueve un PDF generado a su destino final (reemplazando). Devuelve (ok, mensaje_error)."""
+    try:
+        if output_pdf_path.exists(): output_pdf_path.unlink()
+        shutil.move(str(src_pdf), str(output_pdf_path)); return True, ""
+    except OSError as move_error: error_msg = f"PDF generado ({Path(src_pdf).name}) pero no movido a '{output_pdf_path}': {move_error}"; print(f"ERROR: {error_msg}"); return False, error_msg
+
+def _cleanup_prepared(prepared):
+    """Elimina el DOCX temporal y las imágenes comprimidas temporales de un reporte preparado."""
+    docx_path = prepared.get('docx_path')
+    if docx_path and docx_path.exists():
+        try: docx_path.unlink(); print("  - DOCX temp eliminado.")
+        except OSError as clean_err: print(f"WARN: No eliminar DOCX temp: {clean_err}")
+    for temp_file in prepared.get('temp_files', []):
+        try: temp_file.unlink()
+        except OSError as clean_err: print(f"WARN: No eliminar {temp_file.name}: {clean_err}")
+    prepared['temp_files'] = []; prepared['docx_bytes'] = None; prepared['pdf_bytes'] = None; prepared['photo_pdf_bytes'] = None
+
+# --- Regeneración de Reportes Existentes ---
+def regeneration_filename(record):
+    """Nombre del PDF regenerado, derivado del registro (incluye el ID del QR para no pisar otros reportes)."""
+    return suggested_report_filename(record, f"_{(record.get('unique_id') or 'X')[:8]}_REGENERADO")
+
+def prepare_regeneration(record, config, output_pdf_path):
+    """Render del DOCX (o del PDF nativo, según config) de un registro existente: mismo QR y sus imágenes archivadas (sin recomprimir).
+    Devuelve un dict como prepare_report; 'record' es el registro original (no se vuelve a guardar)."""
+    start_time = time.time(); record_id = record.get('id'); unique_id = record.get('unique_id')
+    result = {'ok': False, 'pdf': None, 'error': "", 'record_id': record_id, 'unique_id': unique_id, 'images': 0, 'duration': 0.0}
+    prepared = {'result': result, 'record': record, 'docx_bytes': None, 'docx_path': None, 'pdf_bytes': None, 'photo_pdf_bytes': None, 'text_pdf': None, 'temp_files': [], 'images': [], 'start_time': start_time, 'metrics': GenerationMetrics('regeneracion')}
+    metrics = prepared['metrics']; engine = resolve_render_engine(None, config)
+    print(f"\n--- REGENERACIÓN (ID: {record_id or 'N/A'}, Motor: {engine}) ---")
+    try:
+        if not unique_id or not record_id: raise ValueError("Datos de registro inválidos.")
+        context = {k: record.get(k) or '' for k in REPORT_FIELDS}; context['unique_id'] = unique_id
+        now = datetime.now(); context['fecha_emision'] = now.strftime('%d/%m/%Y %H:%M:%S'); context['fecha_emision_corta'] = now.strftime('%d/%m/%Y')
+        archived = get_record_images(record_id, config); result['images'] = len(archived) # Ya comprimidas: se insertan tal cual
+        if not archived: context['observaciones_generales'] += "\n\n--- REGENERADO (SIN IMÁGENES ORIGINALES) ---"
+        prepared['fingerprint'] = render_fingerprint(context, [p.stem for p in archived], config, engine)
+        prepared['cached_pdf'] = lookup_rendered_pdf(prepared['fingerprint']); metrics.lap('datos', images=len(archived))
+        if prepared['cached_pdf']: return prepared # Documento idéntico ya producido: sin render ni conversión
+        if engine == "nativo":
+            context['image_rows'] = template_image_rows([p.read_bytes() for p in archived]); prepared['pdf_bytes'] = render_native_pdf(context)
+            print(f"PDF nativo (regen) OK, {len(archived)} imágenes archivadas."); metrics.lap('render', images=len(archived), bytes_out=len(prepared['pdf_bytes'])); return prepared
+        if engine == "hibrido":
+            context['image_rows'] = template_image_rows([p.read_bytes() for p in archived]); context = _prepare_hybrid(prepared, context, config)
+            if prepared['text_pdf']: metrics.lap('render', images=len(archived), bytes_out=_prepared_size(prepared)); return prepared
+        doc = get_template().new_document()
+        if engine == "docx": context['image_rows'] = template_image_rows([InlineImage(doc, str(p), width=Mm(LAYOUT_2_PER_ROW_WIDTH_MM)) for p in archived])
+        if config.get(CONFIG_KEY_IN_MEMORY, True): docx_buffer = io.BytesIO(); doc.render(context); doc.save(docx_buffer); prepared['docx_bytes'] = docx_buffer.getvalue()
+        else: prepared['docx_path'] = Path(Path(output_pdf_path).parent / f"temp_regen_{record_id[:8]}.docx").resolve(); doc.render(context); doc.save(prepared['docx_path'])
+        print(f"DOCX (regen) OK, {len(archived)} imágenes archivadas.")
+        metrics.lap('render', images=len(archived), bytes_out=_prepared_size(prepared))
+    except FileNotFoundError as e: print(f"ERROR Regen (FileNotFound): {e}"); result['error'] = f"Archivo no encontrado: {e}"
+    except Exception as e: print(f"ERROR Regen (General): {type(e).__name__} - {e}\n{traceback.format_exc()}"); result['error'] = f"Error inesperado: {type(e).__name__}: {e}"
+    if result['error']: result['duration'] = time.time() - start_time
+    return prepared
+
+def regenerate_report(record, output_pdf_path, config, progress_cb=None):
+    """Regenera el PDF de un registro existente. Devuelve el dict result de generate_report. No lanza excepciones."""
+    progress = progress_cb or (lambda message: None); output_pdf_path = Path(output_pdf_path)
+    progress("Regenerando: Creando DOCX...")
+    prepared = prepare_regeneration(record, config, output_pdf_path); result = prepared['result']
+    try:
+        if result['error']: return result
+        if prepared.get('cached_pdf'): progress("Regenerando: Reutilizando PDF idéntico..."); ok, err = _reuse_pdf(prepared['cached_pdf'], output_pdf_path); result['cached'] = ok; prepared['metrics'].lap('reutilizado')
+        else:
+            progress("Regenerando: Convirtiendo a PDF...")
+            ok, err = _convert_prepared(prepared, output_pdf_path); prepared['metrics'].lap('conversion', bytes_out=_file_size(output_pdf_path) if ok else None)
+            if ok: remember_rendered_pdf(prepared.get('fingerprint'), result['record_id'], output_pdf_path)
+        if ok: result['ok'] = True; result['pdf'] = str(output_pdf_path)
+        else: result['error'] = f"Conversión PDF: {err}"
+        result['duration'] = time.time() - prepared['start_time']; return result
+    finally: prepared['metrics'].save(result['record_id'], result['ok'], config); _cleanup_prepared(prepared)
+
+def regenerate_records(records, output_dir, config, workers=None, progress_cb=None, cancel_event=None):
+    """Regenera muchos registros: render en un pool acotado de hilos y conversión por tandas (convert_many_to_pdf).
+    Los PDF se nombran con regeneration_filename() dentro de output_dir. progress_cb(hechos, total, result) tras cada registro;
+    cancel_event (threading.Event) detiene el trabajo al terminar la tanda en curso. Devuelve la lista de results en orden."""
+    output_dir = Path(output_dir); output_dir.mkdir(parents=True, exist_ok=True); records = list(records); total = len(records)
+    workers = max(1, min(total, workers or os.cpu_count() or 2)); batch_size = max(1, int(config.get(CONFIG_KEY_CONVERT_BATCH_SIZE) or CONVERT_BATCH_SIZE))
+    results = []; cancelled = lambda: cancel_event is not None and cancel_event.is_set()
+    def _prepare(record):
+        if cancelled(): return None
+        return prepare_regeneration(record, config, output_dir / regeneration_filename(record))
+    print(f"REGENERACIÓN MÚLTIPLE: {total} registros (hilos: {workers}, tanda de conversión: {batch_size}).")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for chunk_start in range(0, total, batch_size):
+            chunk = records[chunk_start:chunk_start + batch_size]
+            if cancelled(): break
+            work_dir = Path(tempfile.mkdtemp(prefix=WORKDIR_PREFIX))
+            try:
+                prepared = list(executor.map(_prepare, chunk)); items = []
+                for idx, prep in enumerate(prepared):
+                    if prep is None or prep['result']['error'] or prep.get('cached_pdf') or not _needs_conversion(prep): continue # PDF nativo o texto en caché: sin conversor
+                    docx_path = prep['docx_path']
+                    if prep['docx_bytes'] is not None: docx_path = work_dir / f"regen_{chunk_start + idx:05d}_{prep['result']['record_id'][:8]}.docx"; docx_path.write_bytes(prep['docx_bytes']); prep['docx_bytes'] = None
+                    items.append((chunk_start + idx, docx_path))
+                convert_start = time.perf_counter(); conversions = convert_many_to_pdf(items, work_dir, batch_size, cancel_event=cancel_event) if items and not cancelled() else {}; convert_share = (time.perf_counter() - convert_start) / max(1, len(items))
+                for idx, (record, prep) in enumerate(zip(chunk, prepared)):
+                    if prep is None: res = {'ok': False, 'pdf': None, 'error': "Cancelado.", 'record_id': record.get('id'), 'unique_id': record.get('unique_id'), 'images': 0, 'duration': 0.0}
+                    else:
+                        res = prep['result']; output_pdf = output_dir / regeneration_filename(record)
+                        if not res['error'] and prep.get('cached_pdf'):
+                            ok, err = _reuse_pdf(prep['cached_pdf'], output_pdf); res['cached'] = ok; prep['metrics'].lap('reutilizado')
+                            if ok: res['ok'] = True; res['pdf'] = str(output_pdf)
+                            else: res['error'] = err
+                        elif not res['error'] and not _needs_conversion(prep):
+                            write_start = time.perf_counter(); ok, err = _convert_prepared(prep, output_pdf); prep['metrics'].add('conversion', time.perf_counter() - write_start, bytes_out=_file_size(output_pdf) if ok else None)
+                            if ok: res['ok'] = True; res['pdf'] = str(output_pdf); remember_rendered_pdf(prep.get('fingerprint'), res['record_id'], output_pdf)
+                            else: res['error'] = err
+                        elif not res['error']:
+                            conv = conversions.get(chunk_start + idx, {'pdf': None, 'error': "Cancelado." if cancelled() else "Sin resultado de conversión."})
+                            if conv['pdf']: prep['metrics'].add('conversion', convert_share, bytes_out=_file_size(conv['pdf']))
+                            ok, err = _move_pdf(conv['pdf'], output_pdf) if conv['pdf'] else (False, conv['error'])
+                            if ok and prep['photo_pdf_bytes'] is not None: ok, err = _assemble_hybrid(prep, output_pdf, output_pdf)
+                            if ok: res['ok'] = True; res['pdf'] = str(output_pdf); remember_rendered_pdf(prep.get('fingerprint'), res['record_id'], output_pdf)
+                            else: res['error'] = err if err == "Cancelado." else f"Conversión PDF: {err}"
+                        res['duration'] = time.time() - prep['start_time']; prep['metrics'].save(res['record_id'], res['ok'], config); _cleanup_prepared(prep)
+                    results.append(res)
+                    if progress_cb: progress_cb(len(results), total, res)
+            finally: shutil.rmtree(work_dir, ignore_errors=True)
+    for record in records[len(results):]: # Tandas no iniciadas por cancelación
+        res = {'ok': False, 'pdf': None, 'error': "Cancelado.", 'record_id': record.get('id'), 'unique_id': record.get('unique_id'), 'images': 0, 'duration': 0.0}; results.append(res)
+        if progress_cb: progress_cb(len(results), total, res)
+    stats = render_cache_stats()
+    print(f"REGENERACIÓN MÚLTIPLE FINALIZADA: {sum(r['ok'] for r in results)} OK ({sum(bool(r.get('cached')) for r in results)} reutilizados sin convertir), {sum(not r['ok'] for r in results)} con error/cancelados. Caché render (sesión): {stats['hits']} aciertos, {stats['misses']} fallos ({stats['hit_rate']:.0%}).")
+    return results
+
+# --- Generación por Lotes (CLI) ---
+def load_manifest(manifest_path):
+    """Lee un manifiesto JSONL (un objeto por línea) o CSV (con cabecera).
+    Campos: los de REPORT_FIELDS, 'imagenes' (lista o rutas separadas por ';'), y opcionales 'archivo_pdf', 'calidad', 'job_id'.
+    Devuelve lista de (job_id, registro); cada registro lleva '_linea' (línea del archivo) y '_error' si la línea no se pudo leer."""
+    manifest_path = Path(manifest_path); rows = []; records = []
+    with open(manifest_path, 'r', encoding='utf-8-sig', newline='') as f:
+        if manifest_path.suffix.lower() == '.csv': reader = csv.DictReader(f); rows = [(reader.line_num, row) for row in reader]
+        else:
+            for file_line, line in enumerate(f, start=1):
+                if not line.strip(): continue
+                try: row = json.loads(line)
+                except json.JSONDecodeError as e: row = {'_error': f"JSON inválido: {e}", '_crudo': line.strip()}
+                if not isinstance(row, dict): row = {'_error': "La línea no es un objeto JSON.", '_crudo': line.strip()}
+                rows.append((file_line, row))
+    for line_no, (file_line, row) in enumerate(rows, start=1):
+        if not row.get('_error'):
+            images = row.get('imagenes') or []
+            if isinstance(images, str): images = [p.strip() for p in images.split(';') if p.strip()]
+            row['imagenes'] = images
+        job_id = str(row.get('job_id') or f"{line_no}:{hashlib.sha1(json.dumps(row, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()[:12]}")
+        row['_linea'] = file_line; records.append((job_id, row))
+    return records
+
+def run_batch(manifest_path, output_dir=None, workers=2, resume=False, config=None):
+    """Genera todos los reportes de un manifiesto. Por cada tanda de convert_batch_size trabajos:
+    compresión y render en un pool acotado de hilos, una sola conversión para toda la tanda y guardado.
+    El estado de cada trabajo se anota en '<manifiesto>.estado.jsonl'; con resume se saltan los ya completados.
+    Devuelve (completados, fallidos)."""
+    config = config or load_config(); output_dir = Path(output_dir or config.get(CONFIG_KEY_OUTPUT_DIR) or Path.cwd()); output_dir.mkdir(parents=True, exist_ok=True)
+    state_path = Path(f"{manifest_path}.estado.jsonl"); done_ids = set()
+    if resume and state_path.exists():
+        with open(state_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try: entry = json.loads(line)
+                except json.JSONDecodeError: continue
+                if entry.get('ok'): done_ids.add(entry['job_id'])
+    elif state_path.exists(): state_path.unlink()
+    records = load_manifest(manifest_path); pending = [(job_id, row) for job_id, row in records if job_id not in done_ids]
+    batch_size = max(1, int(config.get(CONFIG_KEY_CONVERT_BATCH_SIZE) or CONVERT_BATCH_SIZE))
+    print(f"LOTE: {len(records)} trabajos en manifiesto, {len(records) - len(pending)} ya completados, {len(pending)} pendientes (hilos: {workers}, tanda de conversión: {batch_size}).")
+    ok_count = 0; fail_count = 0; batch_start = time.time()
+    def _prepare(entry):
+        job_id, row = entry
+        try: # Una fila mal formada se anota como fallida y el lote sigue
+            if row.get('_error'): raise ValueError(row['_error'])
+            if not isinstance(row['imagenes'], list): raise ValueError("'imagenes' debe ser una lista o rutas separadas por ';'.")
+            try: quality = int(row.get('calidad') or IMG_QUALITY_HIGH)
+            except (ValueError, TypeError): raise ValueError(f"'calidad' no es un número: {row.get('calidad')!r}")
+            if not 1 <= quality <= 100: raise ValueError(f"'calidad' fuera de rango (1-100): {quality}")
+            output_pdf = Path(row['archivo_pdf']) if row.get('archivo_pdf') else output_dir / suggested_report_filename(row, f"_{hashlib.sha1(job_id.encode()).hexdigest()[:6]}")
+            job = new_report_job(row, row['imagenes'], output_pdf, quality)
+        except (ValueError, TypeError) as e: return None, f"Fila inválida en la línea {row.get('_linea')} del manifiesto: {e}"
+        return job, prepare_report(job, config)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for chunk_start in range(0, len(pending), batch_size):
+            chunk = pending[chunk_start:chunk_start + batch_size]; work_dir = Path(tempfile.mkdtemp(prefix=WORKDIR_PREFIX))
+            try:
+                prepared = list(executor.map(_prepare, chunk)); items = []
+                for idx, ((job_id, _), (job, prep)) in enumerate(zip(chunk, prepared)):
+                    if job is None or prep['result']['error'] or not _needs_conversion(prep): continue # PDF nativo o texto en caché: sin conversor
+                    docx_path = prep['docx_path']
+                    if prep['docx_bytes'] is not None: docx_path = work_dir / f"job_{chunk_start + idx:05d}_{prep['result']['record_id'][:8]}.docx"; docx_path.write_bytes(prep['docx_bytes']); prep['docx_bytes'] = None
+                    items.append((job_id, docx_path))
+                convert_start = time.perf_counter(); conversions = convert_many_to_pdf(items, work_dir, batch_size) if items else {}; convert_share = (time.perf_counter() - convert_start) / max(1, len(items))
+                for (job_id, row), (job, prep) in zip(chunk, prepared):
+                    if job is None: res = {'ok': False, 'pdf': None, 'error': prep, 'record_id': None, 'unique_id': None, 'images': 0, 'duration': 0.0} # Fila inválida del manifiesto
+                    else:
+                        res = prep['result']; prep['metrics'].kind = 'lote'
+                        if not res['error'] and not _needs_conversion(prep):
+                            write_start = time.perf_counter(); ok, err = _convert_prepared(prep, Path(job['output_pdf'])); prep['metrics'].add('conversion', time.perf_counter() - write_start, bytes_out=_file_size(job['output_pdf']) if ok else None)
+                            if ok: res = finish_report(prep, job['output_pdf'])
+                            else: res['error'] = err
+                        elif not res['error']:
+                            conv = conversions.get(job_id, {'pdf': None, 'error': "Sin resultado de conversión."}); ok, err = (True, "") if conv['pdf'] else (False, conv['error'])
+                            prep['metrics'].add('conversion', convert_share, bytes_out=_file_size(conv['pdf']) if ok else None) # Parte proporcional de la tanda
+                            if ok: ok, err = _move_pdf(conv['pdf'], Path(job['output_pdf']))
+                            if ok and prep['photo_pdf_bytes'] is not None: ok, err = _assemble_hybrid(prep, job['output_pdf'], job['output_pdf'])
+                            if ok: res = finish_report(prep, job['output_pdf'])
+                            else: res['error'] = f"Conversión PDF: {err}"
+                        prep['metrics'].save(res['record_id'], res['ok'], config); _cleanup_prepared(prep)
+                    with open(state_path, 'a', encoding='utf-8') as f: f.write(json.dumps({'job_id': job_id, 'linea': row.get('_linea'), 'ok': res['ok'], 'pdf': res['pdf'], 'record_id': res['record_id'], 'error': res['error'], 'fin': datetime.now().isoformat(timespec='seconds')}, ensure_ascii=False) + "\n")
+                    n = ok_count + fail_count + 1
+                    if res['ok']: ok_count += 1; print(f"LOTE [{n}/{len(pending)}] OK    {job_id} -> {res['pdf']} ({res['duration']:.1f}s)")
+                    else: fail_count += 1; print(f"LOTE [{n}/{len(pending)}] ERROR {job_id}: {res['error']}")
+            finally: shutil.rmtree(work_dir, ignore_errors=True)
+    print(f"LOTE FINALIZADO: {ok_count} OK, {fail_count} con error, {time.time() - batch_start:.1f}s. Estado: {state_path}")
+    return ok_count, fail_count
+
+# --- Cola Persistente de Generación ---
+JOB_STATE_LABELS = {'pendiente': "En cola", 'en_curso': "Generando", 'completado': "Completado", 'fallido': "Error", 'cancelado': "Cancelado"}
+JOB_MAX_ATTEMPTS = 3 # Arranques de un trabajo (incluidas caídas a mitad) antes de darlo por fallido
+JOB_RETENTION_DAYS = 30 # Los trabajos terminados sin error se purgan pasado este tiempo
+JOB_IDLE_RECHECK_S = 30 # Sin avisos, un hilo ocioso revisa la tabla cada tanto (p.ej. trabajos de otra instancia)
+JOB_HEARTBEAT_S = 10 # Cada cuánto renueva una instancia el latido de sus trabajos en curso
+JOB_STALE_S = 60 # Un trabajo 'en_curso' sin latido desde hace más que esto es de una instancia cerrada o caída y se reclama
+QUEUE_PANEL_ROWS = 50
+
+class GenerationQueue:
+    """Cola persistente de reportes (tabla generation_jobs) atendida por N hilos de fondo.
+    Cada trabajo guarda al encolarse la foto del formulario (new_report_job) con un record_id fijo: si la app se cierra
+    o cae a mitad, el trabajo vuelve a la cola y, si el registro ya se había guardado, no se duplica.
+    Al reclamar un trabajo se anota la instancia dueña y un latido que se renueva mientras corre: solo se reclaman
+    trabajos 'en_curso' cuyo latido caducó (JOB_STALE_S), nunca los de otra instancia viva.
+    Las fotos se retienen en el archivo de imágenes desde que se encolan hasta que el trabajo se completa."""
+    def __init__(self, config, workers=1, on_finished=None):
+        self.config = config; self.workers = max(1, int(workers or 1)); self.on_finished = on_finished
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}" # Identifica a esta instancia en generation_jobs
+        self.wakeup = threading.Condition(); self.version = 0; self.stopping = False; self.threads = []
+        self.stop_event = threading.Event() # Solo para el latido: no se despierta con cada cambio de la cola
+        self.running = {} # id -> {'cancel': Event, 'progress': ProgressReporter}
+
+    def _changed(self):
+        """Anota un cambio de estado (la GUI refresca al ver otra versión) y despierta a los hilos ociosos."""
+        with self.wakeup: self.version += 1; self.wakeup.notify_all()
+
+    def recover(self):
+        """Al arrancar: reclama los trabajos 'en_curso' abandonados (ver _reclaim_stale) y purga los terminados antiguos.
+        Devuelve cuántos se reanudan."""
+        cutoff = (datetime.now() - timedelta(days=JOB_RETENTION_DAYS)).isoformat(timespec='seconds')
+        with get_db().transaction() as db:
+            resumed = self._reclaim_stale(db); alive = db.query_one("SELECT COUNT(*) AS n FROM generation_jobs WHERE estado = 'en_curso'")['n']
+            purged = [json.loads(row['trabajo']) for row in db.query("SELECT trabajo FROM generation_jobs WHERE estado = 'cancelado' AND fin < ?", (cutoff,))]
+            db.execute("DELETE FROM generation_jobs WHERE estado IN ('completado', 'cancelado') AND fin < ?", (cutoff,))
+        for job in purged: self._release_images(job)
+        if resumed: print(f"INFO: {resumed} trabajos de generación interrumpidos vuelven a la cola.")
+        if alive: print(f"INFO: {alive} trabajos en curso en otra instancia; se reanudarán si deja de responder.")
+        self._changed(); return resumed
+
+    def _reclaim_stale(self, db):
+        """Dentro de una transacción: los trabajos 'en_curso' de otra instancia sin latido desde hace JOB_STALE_S (cerrada
+        o caída) vuelven a 'pendiente', o fallan si agotaron intentos. Devuelve cuántos vuelven a la cola."""
+        stale = "estado = 'en_curso' AND (propietario IS NULL OR propietario != ?) AND (latido IS NULL OR latido < ?)"; params = (self.owner, time.time() - JOB_STALE_S)
+        db.execute(f"UPDATE generation_jobs SET estado = 'fallido', fin = ?, error = 'Interrumpido demasiadas veces.' WHERE {stale} AND intentos >= ?", (datetime.now().isoformat(timespec='seconds'), *params, JOB_MAX_ATTEMPTS))
+        return db.execute(f"UPDATE generation_jobs SET estado = 'pendiente', propietario = NULL, latido = NULL, progreso = 'Reanudado tras un cierre' WHERE {stale}", params).rowcount
+
+    def start(self):
+        """Arranca los hilos de trabajo y el del latido."""
+        for n in range(self.workers): thread = threading.Thread(target=self._worker_loop, name=f"cola-{n + 1}", daemon=True); thread.start(); self.threads.append(thread)
+        threading.Thread(target=self._heartbeat_loop, name="cola-latido", daemon=True).start()
+        print(f"Cola de generación activa ({self.workers} hilos).")
+
+    def stop(self, timeout=5):
+        """Cierre de la app: interrumpe los trabajos en curso (quedan 'pendiente' para la próxima vez) y espera a los hilos."""
+        self.stopping = True; self.stop_event.set()
+        for entry in list(self.running.values()): entry['cancel'].set()
+        self._changed(); deadline = time.monotonic() + timeout
+        for thread in self.threads: thread.join(max(0.0, deadline - time.monotonic()))
+
+    def submit(self, job):
+        """Encola un trabajo de new_report_job(). Las fotos se copian antes al archivo de imágenes y el trabajo guarda sus
+        hashes ('image_digests'): si el original se borra o se mueve antes de que el trabajo corra, se genera igual. Devuelve su id."""
+        job = dict(job); job.setdefault('record_id', str(uuid.uuid4())); job['image_digests'] = self._retain_images(job['image_paths'])
+        cursor = get_db().execute("INSERT INTO generation_jobs (estado, trabajo, paciente, archivo_pdf, creado) VALUES ('pendiente', ?, ?, ?, ?)",
+                                  (json.dumps(job, ensure_ascii=False), job['fields'].get('paciente', ''), job['output_pdf'], datetime.now().isoformat(timespec='seconds')))
+        self._changed(); return cursor.lastrowid
+
+    def cancel(self, job_id):
+        """Saca de la cola un trabajo pendiente o interrumpe uno en curso (mata el conversor). Devuelve True si hizo algo."""
+        entry = self.running.get(job_id)
+        if entry: entry['cancel'].set(); entry['progress']("Cancelando..."); return True
+        cursor = get_db().execute("UPDATE generation_jobs SET estado = 'cancelado', fin = ? WHERE id = ? AND estado = 'pendiente'", (datetime.now().isoformat(timespec='seconds'), job_id))
+        self._changed(); return cursor.rowcount > 0
+
+    def retry(self, job_id):
+        """Devuelve a la cola un trabajo fallido o cancelado. Devuelve True si se reencoló."""
+        cursor = get_db().execute("UPDATE generation_jobs SET estado = 'pendiente', intentos = 0, error = NULL, fin = NULL, progreso = NULL WHERE id = ? AND estado IN ('fallido', 'cancelado')", (job_id,))
+        self._changed(); return cursor.rowcount > 0
+
+    def _retain_images(self, image_paths):
+        """Copia cada foto al archivo de imágenes. Devuelve los hashes alineados con image_paths (None si no se pudo o no hay archivo)."""
+        archive = get_image_archive(self.config); digests = []
+        for path in image_paths:
+            try: digests.append(archive.store(Path(path).read_bytes()) if archive else None)
+            except OSError as e: print(f"WARN Cola: {Path(path).name} no se copió al archivo (se usará la ruta original): {e}"); digests.append(None)
+        return digests
+
+    def _archived_paths(self, job):
+        """Rutas con las que generar: la copia archivada de cada foto si existe, si no la ruta original."""
+        archive = get_image_archive(self.config); digests = job.get('image_digests') or []
+        return [str(archive.path_for(digest)) if archive and digest and archive.path_for(digest).exists() else path for path, digest in zip(job['image_paths'], digests + [None] * len(job['image_paths']))]
+
+    def _release_images(self, job):
+        """Borra del archivo las fotos retenidas por un trabajo que ya no puede reintentarse, salvo que sean fotos archivadas
+        de un reporte o que otro trabajo aún las use."""
+        archive = get_image_archive(self.config)
+        if not archive: return
+        for digest in set(filter(None, job.get('image_digests') or [])):
+            try:
+                if get_db().query_one("SELECT 1 FROM cirugia_imagenes WHERE hash = ? LIMIT 1", (digest,)): continue
+                if get_db().query_one("SELECT 1 FROM generation_jobs WHERE estado != 'completado' AND trabajo LIKE ? LIMIT 1", (f"%{digest}%",)): continue
+                archive.path_for(digest).unlink(missing_ok=True)
+            except (sqlite3.Error, OSError) as e: print(f"WARN Cola: no se liberó la foto retenida {digest[:12]}: {e}")
+
+    def list_jobs(self, limit=QUEUE_PANEL_ROWS):
+        """Trabajos activos primero y luego los más recientes: [{id, estado, paciente, archivo_pdf, intentos, creado, fin, error, progreso}]."""
+        return [dict(row) for row in get_db().query("SELECT id, estado, paciente, archivo_pdf, intentos, creado, fin, error, progreso FROM generation_jobs ORDER BY estado IN ('pendiente', 'en_curso') DESC, id DESC LIMIT ?", (limit,))]
+
+    def progress_messages(self):
+        """Último aviso de progreso de cada trabajo en curso desde la consulta anterior: {id: mensaje}."""
+        return {job_id: message for job_id, entry in list(self.running.items()) if (message := entry['progress'].take())}
+
+    def _claim(self):
+        """Toma el siguiente trabajo pendiente (atómico entre hilos e instancias) a nombre de esta instancia,
+        tras reclamar los abandonados por otra. Devuelve (id, job) o None."""
+        with get_db().transaction() as db:
+            self._reclaim_stale(db)
+            row = db.query_one("SELECT id, trabajo FROM generation_jobs WHERE estado = 'pendiente' ORDER BY id LIMIT 1")
+            if row is None: return None
+            db.execute("UPDATE generation_jobs SET estado = 'en_curso', intentos = intentos + 1, inicio = ?, error = NULL, propietario = ?, latido = ? WHERE id = ?", (datetime.now().isoformat(timespec='seconds'), self.owner, time.time(), row['id']))
+        return row['id'], json.loads(row['trabajo'])
+
+    def _heartbeat_loop(self):
+        """Renueva cada JOB_HEARTBEAT_S el latido de los trabajos en curso de esta instancia, para que otra no los reclame."""
+        while not self.stop_event.wait(JOB_HEARTBEAT_S):
+            if not self.running: continue
+            try: get_db().execute("UPDATE generation_jobs SET latido = ? WHERE estado = 'en_curso' AND propietario = ?", (time.time(), self.owner))
+            except sqlite3.Error as e: print(f"WARN Cola: latido no guardado: {e}")
+
+    def _worker_loop(self):
+        while not self.stopping:
+            seen = self.version
+            try: claimed = self._claim()
+            except (sqlite3.Error, json.JSONDecodeError) as e: print(f"ERROR Cola: {e}"); claimed = None
+            if claimed is None:
+                with self.wakeup: self.wakeup.wait_for(lambda: self.stopping or self.version != seen, timeout=JOB_IDLE_RECHECK_S)
+                continue
+            self._run(*claimed)
+
+    def _run(self, job_id, job):
+        """Genera un trabajo ya reclamado y anota el resultado."""
+        entry = {'cancel': threading.Event(), 'progress': ProgressReporter()}; self.running[job_id] = entry; self._changed()
+        print(f"COLA: Trabajo #{job_id} ({job['fields'].get('paciente', '')}) iniciado.")
+        try:
+            if get_record_by_id(job.get('record_id')): # Guardado antes de una caída: no generar (ni registrar) dos veces
+                result = {'ok': True, 'pdf': job['output_pdf'], 'error': "", 'record_id': job['record_id'], 'images': 0, 'duration': 0.0}
+            else: result = generate_report(dict(job, image_paths=self._archived_paths(job)), self.config, entry['progress'], entry['cancel'])
+        except Exception as e:
+            print(f"ERROR Cola #{job_id}: {type(e).__name__} - {e}\n{traceback.format_exc()}"); result = {'ok': False, 'pdf': None, 'error': f"Error inesperado: {type(e).__name__}: {e}", 'record_id': job.get('record_id'), 'images': 0, 'duration': 0.0}
+        finally: self.running.pop(job_id, None)
+        if result['ok']: state = 'completado'
+        elif result['error'] == "Cancelado.": state = 'pendiente' if self.stopping else 'cancelado' # Cierre de la app: se reanuda al volver a abrir
+        else: state = 'fallido'
+        updated = 0
+        try:
+            updated = get_db().execute("UPDATE generation_jobs SET estado = ?, intentos = intentos - ?, fin = ?, cirugia_id = ?, error = ?, progreso = NULL, propietario = NULL, latido = NULL WHERE id = ? AND estado = 'en_curso' AND propietario = ?",
+                                       (state, 1 if state == 'pendiente' else 0, datetime.now().isoformat(timespec='seconds') if state != 'pendiente' else None, result['record_id'] if result['ok'] else None, result['error'] or None, job_id, self.owner)).rowcount
+            if not updated: print(f"WARN Cola #{job_id}: otra instancia reclamó el trabajo (latido caducado); no se anota el estado '{state}'.")
+        except sqlite3.Error as e: print(f"ERROR Cola #{job_id}: no se guardó el estado '{state}': {e}")
+        print(f"COLA: Trabajo #{job_id} -> {state}{': ' + result['error'] if result['error'] else ''}"); self._changed()
+        if state == 'completado' and updated: self._release_images(job)
+        if self.on_finished and state != 'pendiente': self.on_finished(job_id, result)
+
+# --- Benchmark del Pipeline ---
+BENCHMARK_SET_SIZES = [1, 10, 50, 100] # Imágenes por reporte en cada conjunto
+BENCHMARK_IMAGE_SPECS = [((4032, 3024), 'RGB', 'JPEG'), ((1920, 1080), 'RGBA', 'PNG'), ((1600, 1200), 'P', 'PNG'), ((3024, 4032), 'RGB', 'JPEG'), ((800, 600), 'RGB', 'PNG')] # (resolución, modo, formato) en rotación
+
+def make_synthetic_images(count, out_dir, scale=1.0, seed=0):
+    """Fotos sintéticas deterministas (ruido suavizado sobre degradados) en out_dir, recorriendo BENCHMARK_IMAGE_SPECS:
+    JPEG RGB de cámara, PNG RGBA y PNG con paleta (los dos últimos pasan por la conversión a RGB de compress_image)."""
+    out_dir = Path(out_dir); out_dir.mkdir(parents=True, exist_ok=True); paths = []
+    for i in range(count):
+        (width, height), mode, fmt = BENCHMARK_IMAGE_SPECS[i % len(BENCHMARK_IMAGE_SPECS)]; width, height = max(16, int(width * scale)), max(16, int(height * scale))
+        tile_size = (max(2, width // 8), max(2, height // 8)); rng = random.Random(seed * 100003 + i)
+        noise = PILImage.frombytes('RGB', tile_size, rng.randbytes(tile_size[0] * tile_size[1] * 3)).resize((width, height), PILImage.BICUBIC)
+        gradient = PILImage.merge('RGB', (PILImage.linear_gradient('L').resize((width, height)), PILImage.radial_gradient('L').resize((width, height)), PILImage.new('L', (width, height), rng.randrange(256))))
+        img = PILImage.blend(gradient, noise, 0.6)
+        if mode == 'RGBA': img.putalpha(PILImage.linear_gradient('L').rotate(90).resize((width, height)))
+        elif mode == 'P': img = img.quantize(64)
+        path = out_dir / f"foto_{i:03d}.{'jpg' if fmt == 'JPEG' else 'png'}"; img.save(path, fmt, **({'quality': 92} if fmt == 'JPEG' else {})); paths.append(path)
+    return paths
+
+def peak_rss_mb():
+    """Pico de memoria residente en MB: (proceso actual, mayor de los hijos ya terminados). (None, None) si el SO no lo expone."""
+    try: import resource # No existe en Windows
+    except ImportError: return None, None
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024 # ru_maxrss: bytes en macOS, KiB en Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+
+def _benchmark_set(db_path, converter, bench_config, jobs, verbose):
+    """Proceso hijo de run_benchmark: genera los reportes de un conjunto y devuelve (fallidos, segundos, RSS pico, RSS pico de hijos).
+    Cada conjunto corre en un proceso nuevo porque ru_maxrss no se puede reiniciar: así el pico es solo de ese conjunto."""
+    global DB_FILENAME
+    DB_FILENAME = db_path; quiet = (lambda: nullcontext()) if verbose else (lambda: redirect_stdout(io.StringIO()))
+    try:
+        with quiet():
+            set_pdf_converter(converter)
+            if converter == "libreoffice" and bench_config[CONFIG_KEY_RENDER_ENGINE] != "nativo" and bench_config.get(CONFIG_KEY_OFFICE_DAEMON, True): start_office_daemon() # Arranque fuera de la medición
+        failures = 0; start_t = time.perf_counter()
+        for job in jobs:
+            with quiet(): res = generate_report(job, bench_config)
+            if not res['ok']: failures += 1; print(f"WARN: {job['fields']['paciente']} falló: {res['error']}")
+        wall_s = time.perf_counter() - start_t
+    finally: stop_office_daemon(); shutdown_image_pool(); close_db() # Sin pool vivo, sus procesos cuentan en RUSAGE_CHILDREN
+    return (failures, wall_s, *peak_rss_mb())
+
+def run_benchmark(set_sizes=BENCHMARK_SET_SIZES, repeats=3, converter=None, image_scale=1.0, quality=IMG_QUALITY_HIGH, config=None, verbose=False, engine=None):
+    """Genera 'repeats' reportes por conjunto de fotos sintéticas con una BD temporal (la real no se toca) y mide cada etapa
+    con generation_metrics. converter: nombre registrado ('simulado') o None = LibreOffice si está instalado.
+    engine: motor de render ('docx' o 'nativo'); None usa el de config. Cada conjunto corre en un proceso nuevo
+    (ver _benchmark_set) para que su pico de RSS no arrastre el de los anteriores.
+    Devuelve un dict serializable a JSON con la etapa, sus p50/p95/máx, el rendimiento y el pico de RSS por conjunto."""
+    global DB_FILENAME
+    bench_config = dict(config or load_config())
+    bench_config.update({CONFIG_KEY_IMG_CACHE_ENABLED: False, CONFIG_KEY_RENDER_CACHE_ENABLED: False, CONFIG_KEY_METRICS_ENABLED: True, CONFIG_KEY_IMG_ARCHIVE_DIR: ""}) # Cada repetición comprime y renderiza de verdad
+    engine = bench_config[CONFIG_KEY_RENDER_ENGINE] = resolve_render_engine({'engine': engine}, bench_config)
+    if converter is None: soffice = find_libreoffice(); converter = "libreoffice" if (Path(soffice).is_file() or soffice.lower() == "soffice") else "simulado"
+    quiet = (lambda: nullcontext()) if verbose else (lambda: redirect_stdout(io.StringIO()))
+    previous_db = DB_FILENAME; previous_converter = active_pdf_converter; work_dir = Path(tempfile.mkdtemp(prefix="generador_bench_")); sets = []
+    try:
+        close_db(); DB_FILENAME = str(work_dir / "benchmark.db")
+        with quiet(): init_db()
+        converter = set_pdf_converter(converter)
+        print(f"Generando {max(set_sizes)} fotos sintéticas (escala {image_scale})...")
+        images = make_synthetic_images(max(set_sizes), work_dir / "fotos", image_scale)
+        fields = {field: f"Benchmark {field}" for field in REPORT_FIELDS}; fields['fecha_cirugia'] = datetime.now().strftime('%Y-%m-%d')
+        for size in set_sizes:
+            get_db().execute("DELETE FROM generation_metrics")
+            jobs = [new_report_job(dict(fields, paciente=f"Paciente {size}-{rep}"), images[:size], work_dir / f"benchmark_{size}_{rep}.pdf", quality) for rep in range(repeats)]
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as runner:
+                failures, wall_s, rss_self, rss_children = runner.submit(_benchmark_set, DB_FILENAME, converter, bench_config, jobs, verbose).result()
+            stages = {}
+            for r in get_stage_percentiles(only_ok=True):
+                per_s = 1 / r['p50'] if r['p50'] else None
+                stages[r['etapa']] = {'n': r['n'], 'p50_s': r['p50'], 'p95_s': r['p95'], 'max_s': r['max'], 'reportes_por_s': per_s,
+                                      'imagenes_por_s': r['imagenes_media'] * per_s if per_s and r['imagenes_media'] is not None else None,
+                                      'mb_entrada_por_s': r['mb_entrada_media'] * per_s if per_s and r['mb_entrada_media'] is not None else None,
+                                      'mb_salida_media': r['mb_salida_media']}
+            sets.append({'imagenes': size, 'repeticiones': repeats, 'fallidos': failures, 'duracion_s': wall_s, 'etapas': stages, 'rss_pico_mb': rss_self, 'rss_pico_hijos_mb': rss_children})
+            if 'total' not in stages: print(f"Conjunto {size:>3} imágenes: sin reportes correctos."); continue
+            print(f"Conjunto {size:>3} imágenes: p50 total {stages['total']['p50_s']:.2f}s (" + ", ".join(f"{name} {s['p50_s']:.2f}s" for name, s in stages.items() if name != 'total') + ")" + (f", RSS pico {rss_self:.0f} MB" if rss_self else ""))
+    finally:
+        close_db(); DB_FILENAME = previous_db; set_pdf_converter(previous_converter); shutil.rmtree(work_dir, ignore_errors=True)
+    return {'fecha': datetime.now().isoformat(timespec='seconds'), 'plataforma': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count(),
+            'convertidor': converter, 'motor': engine, 'escala_imagenes': image_scale, 'calidad': quality, 'procesos_imagen': resolve_image_workers(bench_config.get(CONFIG_KEY_IMG_WORKERS)),
+            'en_memoria': bench_config.get(CONFIG_KEY_IN_MEMORY, True), 'conjuntos': sets}
+
+def compare_benchmarks(previous, current):
+    """Líneas de texto con el p50 por etapa de dos resultados de run_benchmark (anterior -> actual) para los conjuntos comunes."""
+    lines = []; previous_sets = {s['imagenes']: s for s in previous.get('conjuntos', [])}
+    for current_set in current.get('conjuntos', []):
+        previous_set = previous_sets.get(current_set['imagenes'])
+        if not previous_set: continue
+        for stage, now in current_set['etapas'].items():
+            before = previous_set['etapas'].get(stage)
+            if before and before.get('p50_s') and now.get('p50_s'): lines.append(f"{current_set['imagenes']:>3} imgs {stage:<12} {before['p50_s']:8.3f}s -> {now['p50_s']:8.3f}s ({(now['p50_s'] / before['p50_s'] - 1) * 100:+.1f}%)")
+    return lines
+
+# --- Paridad entre Motores de Render ---
+PARITY_SIZE_TOLERANCE_MM = 1.0 # Diferencia admitida en el tamaño con que se coloca cada foto
+PARITY_PREVIEW_DPI = 40
+
+def check_render_parity(record_id=None, output_dir=None, config=None):
+    """Regenera un registro (el más reciente si no se indica) con cada motor disponible y compara los PDF con el de docx.
+    Siempre verifica que los bytes JPEG de cada foto archivada estén en cada PDF (error si el de docx no trae ninguna).
+    Con PyMuPDF (opcional) verifica además que cada campo aparezca en ambos o en ninguno, que las fotos vayan en orden
+    y colocadas al mismo tamaño, y guarda una tira de páginas por motor para revisar a ojo.
+    Devuelve dict {ok, registro, pdf_<motor>, tiempos_s, paginas, diferencias, pymupdf, error}."""
+    config = dict(config or load_config()); config[CONFIG_KEY_RENDER_CACHE_ENABLED] = False # Render real con cada motor
+    if record_id: record = get_record_by_id(record_id)
+    else: row = get_db().query_one("SELECT * FROM cirugias ORDER BY fecha_generacion DESC LIMIT 1"); record = dict(row) if row else None
+    engines = [engine for engine in RENDER_ENGINES if resolve_render_engine({'engine': engine}, config) == engine] # Sin pypdf no hay híbrido
+    report = {'ok': False, 'registro': (record or {}).get('id') or record_id, 'tiempos_s': {}, 'paginas': {}, 'diferencias': [], 'pymupdf': False, 'error': "", **{f"pdf_{engine}": None for engine in engines}}
+    if not record: report['error'] = "Registro no encontrado."; return report
+    output_dir = Path(output_dir or tempfile.mkdtemp(prefix="generador_paridad_")); output_dir.mkdir(parents=True, exist_ok=True)
+    for engine in engines:
+        res = regenerate_report(record, output_dir / f"paridad_{engine}.pdf", dict(config, **{CONFIG_KEY_RENDER_ENGINE: engine}))
+        if not res['ok']: report['error'] = f"Motor {engine}: {res['error']}"; return report
+        report[f"pdf_{engine}"] = res['pdf']; report['tiempos_s'][engine] = res['duration']
+    archived = get_record_images(record['id'], config); photo_bytes = [path.read_bytes() for path in archived]; found = {}
+    for engine in engines: # Las fotos van sin recomprimir (DCTDecode): sus bytes aparecen tal cual en el PDF
+        pdf_bytes = Path(report[f"pdf_{engine}"]).read_bytes(); found[engine] = sum(1 for data in photo_bytes if data in pdf_bytes)
+        if found[engine] < len(photo_bytes): report['diferencias'].append(f"Motor {engine}: {found[engine]} de {len(photo_bytes)} fotos archivadas en el PDF.")
+    if photo_bytes and found.get('docx') == 0: report['error'] = f"El PDF del motor docx no contiene ninguna de las {len(photo_bytes)} fotos archivadas del registro."
+    try: import fitz # PyMuPDF, opcional: solo para esta comprobación
+    except ImportError: report['ok'] = not report['diferencias'] and not report['error']; return report # Sin PyMuPDF el resto se compara a mano ('pymupdf': False)
+    report['pymupdf'] = True; photo_hashes = [p.stem for p in archived]; texts = {}; photos = {}
+    for engine in engines:
+        with fitz.open(report[f"pdf_{engine}"]) as doc:
+            report['paginas'][engine] = doc.page_count; texts[engine] = " ".join(" ".join(page.get_text().split()) for page in doc); placed = []
+            for page in doc:
+                for xref, *_ in page.get_images(full=True):
+                    digest = hashlib.sha1(doc.extract_image(xref)['image']).hexdigest(); rects = page.get_image_rects(xref)
+                    if digest in photo_hashes: placed.extend((digest, rect.width / MM_TO_PT, rect.height / MM_TO_PT) for rect in rects)
+            photos[engine] = placed
+            previews = [PILImage.frombytes('RGB', (pix.width, pix.height), pix.samples) for pix in (page.get_pixmap(dpi=PARITY_PREVIEW_DPI) for page in doc)]
+        strip = PILImage.new('RGB', (sum(p.width for p in previews) + 10 * (len(previews) - 1), max(p.height for p in previews)), 'white')
+        for n, preview in enumerate(previews): strip.paste(preview, (sum(p.width + 10 for p in previews[:n]), 0))
+        strip.save(output_dir / f"paridad_{engine}.png")
+    for field in REPORT_FIELDS + ['unique_id']:
+        expected = " ".join(str(record.get(field) or '').split())
+        for engine in engines[1:]:
+            if expected and (expected in texts['docx']) != (expected in texts[engine]): report['diferencias'].append(f"Campo '{field}' solo aparece con el motor {'docx' if expected in texts['docx'] else engine} (docx vs {engine}).")
+    for engine in engines:
+        if found[engine] == len(photo_bytes) and [digest for digest, *_ in photos[engine]] != photo_hashes: report['diferencias'].append(f"Motor {engine}: {len(photos[engine])} de {len(photo_hashes)} fotos con sus bytes originales y en orden.")
+    for engine in engines[1:]:
+        for n, (a, b) in enumerate(zip(photos['docx'], photos[engine]), start=1):
+            if a[0] == b[0] and max(abs(a[1] - b[1]), abs(a[2] - b[2])) > PARITY_SIZE_TOLERANCE_MM: report['diferencias'].append(f"Foto {n}: {a[1]:.1f}x{a[2]:.1f} mm (docx) vs {b[1]:.1f}x{b[2]:.1f} mm ({engine}).")
+    report['ok'] = not report['diferencias'] and not report['error']; return report
+
+def main_cli(argv):
+    """Punto de entrada sin GUI."""
+    parser = argparse.ArgumentParser(prog="generador_app.py", description="Generador de reportes PDF (modo consola).")
+    sub = parser.add_subparsers(dest="comando", required=True)
+    p_lote = sub.add_parser("lote", help="Genera reportes a partir de un manifiesto JSONL/CSV.")
+    p_lote.add_argument("manifiesto"); p_lote.add_argument("--salida", help="Carpeta de PDFs (por defecto la de config.json).")
+    p_lote.add_argument("--hilos", type=int, default=2, help="Reportes simultáneos (por defecto 2).")
+    p_lote.add_argument("--reanudar", action="store_true", help="Salta los trabajos ya completados en el archivo de estado.")
+    p_lote.add_argument("--motor", choices=RENDER_ENGINES, help="Motor de render (por defecto el de config.json).")
+    sub.add_parser("planes", help="Muestra el EXPLAIN QUERY PLAN de los filtros por fecha y verifica que usan índice.")
+    p_met = sub.add_parser("metricas", help="Informe p50/p95/máx por etapa de generación (tabla generation_metrics).")
+    p_met.add_argument("--desde", help="Fecha inicial YYYY-MM-DD."); p_met.add_argument("--hasta", help="Fecha final YYYY-MM-DD (inclusive).")
+    p_met.add_argument("--tipo", choices=["generacion", "regeneracion", "lote", "arranque"]); p_met.add_argument("--incluir-fallidos", action="store_true", help="Incluye reportes que fallaron.")
+    p_bench = sub.add_parser("benchmark", help="Mide compresión, render, conversión y guardado con fotos sintéticas y una BD temporal.")
+    p_bench.add_argument("--conjuntos", default=",".join(map(str, BENCHMARK_SET_SIZES)), help="Imágenes por reporte en cada conjunto, separadas por comas.")
+    p_bench.add_argument("--repeticiones", type=int, default=3, help="Reportes por conjunto (por defecto 3).")
+    p_bench.add_argument("--convertidor", help="'libreoffice' o uno registrado, p.ej. 'simulado' (por defecto LibreOffice si está instalado).")
+    p_bench.add_argument("--escala", type=float, default=1.0, help="Factor de resolución de las fotos sintéticas (1.0 = 12 MP).")
+    p_bench.add_argument("--salida", help="JSON de resultados (por defecto benchmark_AAAAMMDD_HHMMSS.json).")
+    p_bench.add_argument("--comparar", help="JSON de una ejecución anterior para mostrar la diferencia.")
+    p_bench.add_argument("--detalle", action="store_true", help="Muestra la salida completa del pipeline.")
+    p_bench.add_argument("--motor", choices=RENDER_ENGINES, help="Motor de render (por defecto el de config.json).")
+    p_par = sub.add_parser("paridad", help="Regenera un registro con cada motor de render y compara los PDF con el de docx (requiere PyMuPDF para comparar).")
+    p_par.add_argument("--registro", help="ID del registro (por defecto el más reciente)."); p_par.add_argument("--salida", help="Carpeta para los PDF y las vistas previas.")
+    args = parser.parse_args(argv)
+    if args.comando == "lote":
+        config = load_config(); init_db()
+        if args.motor: config[CONFIG_KEY_RENDER_ENGINE] = args.motor
+        if set_pdf_converter(config.get(CONFIG_KEY_PDF_CONVERTER)) == "libreoffice" and resolve_render_engine(None, config) != "nativo" and config.get(CONFIG_KEY_OFFICE_DAEMON, True): start_office_daemon()
+        try: _, failed = run_batch(args.manifiesto, args.salida, args.hilos, args.reanudar, config)
+        finally: stop_office_daemon(); shutdown_image_pool(); close_db()
+        return 1 if failed else 0
+    if args.comando == "planes":
+        init_db(); results = check_query_plans(); close_db()
+        for label, index_name, plan, ok in results: print(f"{'OK ' if ok else 'MAL'} {label} (esperado {index_name}): {plan}")
+        return 0 if all(ok for *_, ok in results) else 1
+    if args.comando == "metricas":
+        init_db(); report = get_stage_percentiles(args.desde, args.hasta, args.tipo, not args.incluir_fallidos); close_db()
+        if not report: print("Sin métricas en el rango indicado."); return 0
+        fmt = lambda v, spec: format(v, spec) if v is not None else "-"
+        print(f"{'Etapa':<12}{'n':>7}{'p50 s':>9}{'p95 s':>9}{'máx s':>9}{'imgs':>7}{'MB ent':>9}{'MB sal':>9}")
+        for r in report: print(f"{r['etapa']:<12}{r['n']:>7}{fmt(r['p50'], '.2f'):>9}{fmt(r['p95'], '.2f'):>9}{fmt(r['max'], '.2f'):>9}{fmt(r['imagenes_media'], '.1f'):>7}{fmt(r['mb_entrada_media'], '.2f'):>9}{fmt(r['mb_salida_media'], '.2f'):>9}")
+        return 0
+    if args.comando == "benchmark":
+        try: set_sizes = sorted({min(MAX_IMAGES_ALLOWED, max(1, int(n))) for n in args.conjuntos.split(",") if n.strip()})
+        except ValueError: parser.error("--conjuntos debe ser una lista de enteros separados por comas.")
+        results = run_benchmark(set_sizes, max(1, args.repeticiones), args.convertidor, args.escala, verbose=args.detalle, engine=args.motor)
+        output_path = Path(args.salida or f"benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+        output_path.write_text(json.dumps(results, indent=2, ensure_ascii=False), encoding='utf-8'); print(f"Resultados guardados en {output_path}")
+        if args.comparar:
+            try: previous = json.loads(Path(args.comparar).read_text(encoding='utf-8'))
+            except (OSError, json.JSONDecodeError) as e: print(f"ERROR: No se pudo leer '{args.comparar}': {e}"); return 1
+            for line in compare_benchmarks(previous, results): print(line)
+        return 1 if any(s['fallidos'] for s in results['conjuntos']) else 0
+    if args.comando == "paridad":
+        config = load_config(); init_db()
+        if set_pdf_converter(config.get(CONFIG_KEY_PDF_CONVERTER)) == "libreoffice" and config.get(CONFIG_KEY_OFFICE_DAEMON, True): start_office_daemon()
+        try: report = check_render_parity(args.registro, args.salida, config)
+        finally: stop_office_daemon(); close_db()
+        for engine, seconds in report['tiempos_s'].items(): print(f"PDF {engine:<8} {report[f'pdf_{engine}']} ({seconds:.2f}s)")
+        for line in report['diferencias']: print(f"DIFERENCIA: {line}")
+        if report['error']: print(f"ERROR: {report['error']}"); return 1
+        if not report['pymupdf']: print("WARN: PyMuPDF no instalado (pip install pymupdf): solo se verificaron las fotos; compara el resto de los PDF a mano."); return 1
+        print(f"Páginas: {', '.join(f'{engine} {n}' for engine, n in report['paginas'].items())} (el motor nativo no incluye las páginas fijas de la plantilla). Vistas previas en {Path(report['pdf_docx']).parent}")
+        print("Paridad OK." if report['ok'] else f"{len(report['diferencias'])} diferencias."); return 0 if report['ok'] else 1
+    return 2
+
+# --- Progreso entre Hilos ---
+class ProgressReporter:
+    """Canal de progreso de un hilo de trabajo hacia Tk. Llamarlo solo guarda el último mensaje (sin after() ni print por
+    actualización); la GUI lo recoge con take() cada PROGRESS_REFRESH_MS, así mil avisos por segundo cuestan un refresco."""
+    def __init__(self):
+        self.lock = threading.Lock(); self._message = None; self.posted = 0; self.shown = 0
+
+    def __call__(self, message):
+        with self.lock: self._message = message; self.posted += 1
+
+    def take(self):
+        """Devuelve el mensaje pendiente (o None) y lo marca como mostrado."""
+        with self.lock:
+            message, self._message = self._message, None
+            if message is not None: self.shown += 1
+            return message
 
 # --- Clase Ventana de Configuración ---
 class SettingsWindow(ctk.CTkToplevel):
@@ -246,11 +2386,11 @@ class SettingsWindow(ctk.CTkToplevel):
         if directory: self.output_dir_var.set(directory)
 
     def save_and_close(self):
-        new_config = {CONFIG_KEY_IMG_DIR: self.img_dir_var.get(), CONFIG_KEY_OUTPUT_DIR: self.output_dir_var.get()}
+        new_config = dict(self.initial_config); new_config.update({CONFIG_KEY_IMG_DIR: self.img_dir_var.get(), CONFIG_KEY_OUTPUT_DIR: self.output_dir_var.get()})
         if save_config(new_config):
             if self.master_app: self.master_app.config = new_config; self.master_app._update_status("Configuración guardada.")
             self.close_window()
-        else: show_error("Error Guardar", "No se pudo guardar el archivo de configuración.")
+        else: show_error_safe("Error Guardar", "No se pudo guardar el archivo de configuración.")
 
     def close_window(self): self.grab_release(); self.destroy()
 
@@ -264,18 +2404,57 @@ class App(ctk.CTk):
         ctk.set_default_color_theme("blue")
         self.protocol("WM_DELETE_WINDOW", self.on_closing)
 
-        self.config = load_config()
-        init_db()
+        self.config = load_config(); self.db_ready = threading.Event()
+        self.progress = ProgressReporter(); self._progress_users = 0; self._progress_after_id = None
+        self.job_queue = GenerationQueue(self.config, self.config.get(CONFIG_KEY_QUEUE_WORKERS, 1), on_finished=lambda job_id, result: self.after(0, self._on_job_finished, job_id, result)); self._queue_version = None
+        self._startup_timings = {'importacion': time.perf_counter() - _MODULE_LOAD_START}; self._window_start = time.perf_counter()
+        if set_pdf_converter(self.config.get(CONFIG_KEY_PDF_CONVERTER)) == "libreoffice" and self.config.get(CONFIG_KEY_OFFICE_DAEMON, True): threading.Thread(target=start_office_daemon, daemon=True).start() # Arranque en frío fuera del hilo de la GUI
 
         self.image_file_paths = []; self.output_pdf_path_str = ""; self.last_generated_pdf_path = None
         self.stats_window = None; self.temp_image_files = []
         self.fecha_var = tk.StringVar(value=datetime.now().strftime('%Y-%m-%d')); self.cliente_var = tk.StringVar(); self.paciente_var = tk.StringVar(); self.medico_var = tk.StringVar(); self.tecnico_var = tk.StringVar(); self.tipo_cirugia_var = tk.StringVar(); self.lugar_var = tk.StringVar(); self.enc_prep_var = tk.StringVar(); self.enc_log_var = tk.StringVar(); self.coord_cx_var = tk.StringVar()
-        self.image_quality_var = tk.IntVar(value=IMG_QUALITY_HIGH)
+        self.image_quality_var = tk.IntVar(value=IMG_QUALITY_HIGH); self.render_engine_var = tk.StringVar(value=RENDER_ENGINE_LABELS[resolve_render_engine(None, self.config)])
         self.validation_error_message = ""
         self.settings_window = None
 
         self._create_widgets()
-        self.update_suggestions()
+        threading.Thread(target=self._background_startup, daemon=True).start() # BD, sugerencias y precarga sin retrasar la ventana
+        self.after_idle(self._mark_interactive)
+
+    def _background_startup(self):
+        """Hilo de arranque: init_db, índice de sugerencias y precarga de docxtpl y la plantilla."""
+        start_t = time.perf_counter()
+        try: init_db(); cleanup_stale_workdirs()
+        except SystemExit: self.after(0, self._fatal_db_error); return # init_db sale del proceso si la BD no abre
+        self.db_ready.set(); timings = {'bd': time.perf_counter() - start_t}
+        try: self.job_queue.recover(); self.job_queue.start() # Trabajos que quedaron a medias en la sesión anterior
+        except sqlite3.Error as e: print(f"ERROR: No se pudo iniciar la cola de generación: {e}")
+        start_t = time.perf_counter()
+        get_suggestion_index().build(); timings['sugerencias'] = time.perf_counter() - start_t
+        if self.winfo_exists(): self.after(0, self.update_suggestions)
+        start_t = time.perf_counter()
+        try: ensure_generation_stack(); get_template().current_version() # Plantilla ya parseada para el primer "Generar PDF"
+        except Exception as e: print(f"WARN: Precarga de generación incompleta: {type(e).__name__}: {e}")
+        timings['precarga'] = time.perf_counter() - start_t
+        if self.winfo_exists(): self.after(0, self._record_startup_timings, timings)
+
+    def _fatal_db_error(self):
+        show_error_safe("Error de Base de Datos", f"No se pudo inicializar '{DB_FILENAME}'. Revisa la consola."); self.destroy()
+
+    def _mark_interactive(self):
+        """Primer ciclo ocioso del mainloop: la ventana ya está dibujada y acepta entrada."""
+        self._startup_timings['ventana'] = time.perf_counter() - self._window_start
+        self._startup_timings['interactivo'] = time.perf_counter() - _MODULE_LOAD_START
+        print(f"INFO: Interactivo en {self._startup_timings['interactivo']:.2f}s (importación {self._startup_timings['importacion']:.2f}s, ventana {self._startup_timings['ventana']:.2f}s).")
+        self._record_startup_timings({})
+
+    def _record_startup_timings(self, timings):
+        """Junta los tiempos de la ventana y del hilo de arranque; con ambos, los guarda como tipo 'arranque' en generation_metrics."""
+        self._startup_timings.update(timings)
+        if 'interactivo' not in self._startup_timings or 'precarga' not in self._startup_timings: return
+        metrics = GenerationMetrics('arranque')
+        for stage in ('importacion', 'ventana', 'bd', 'sugerencias', 'precarga'): metrics.add(stage, self._startup_timings[stage])
+        threading.Thread(target=metrics.save, args=(None, True, self.config, self._startup_timings['interactivo']), daemon=True).start()
 
     def _create_widgets(self):
         """Crea y organiza todos los widgets de la interfaz."""
@@ -306,6 +2485,7 @@ class App(ctk.CTk):
         self.combo_enc_log = ctk.CTkComboBox(main_frame, variable=self.enc_log_var); self.combo_enc_log.grid(row=row_idx, column=1, columnspan=2, padx=10, pady=5, sticky="ew"); row_idx += 1
         ctk.CTkLabel(main_frame, text="Coord. CX:").grid(row=row_idx, column=0, padx=10, pady=5, sticky="w")
         self.combo_coord_cx = ctk.CTkComboBox(main_frame, variable=self.coord_cx_var); self.combo_coord_cx.grid(row=row_idx, column=1, columnspan=2, padx=10, pady=5, sticky="ew"); row_idx += 1
+        for combo, field in self._suggestion_combos().items(): combo.bind("<KeyRelease>", lambda e, c=combo, f=field: self._filter_suggestions(e, c, f))
         ctk.CTkLabel(main_frame, text="Obs. Logística:").grid(row=row_idx, column=0, padx=10, pady=5, sticky="nw")
         self.text_obs_log = ctk.CTkTextbox(main_frame, height=70); self.text_obs_log.grid(row=row_idx, column=1, columnspan=2, padx=10, pady=5, sticky="ew"); row_idx += 1
         ctk.CTkFrame(main_frame, height=2, fg_color="gray50").grid(row=row_idx, column=0, columnspan=3, padx=10, pady=8, sticky="ew"); row_idx += 1
@@ -318,6 +2498,8 @@ class App(ctk.CTk):
         ctk.CTkRadioButton(q_sub, text="Media(75)", variable=self.image_quality_var, value=IMG_QUALITY_MEDIUM).pack(side="left", padx=5)
         ctk.CTkRadioButton(q_sub, text="Baja(60)", variable=self.image_quality_var, value=IMG_QUALITY_LOW).pack(side="left", padx=5)
         options_frame.columnconfigure(2, weight=1)
+        ctk.CTkLabel(options_frame, text="Motor PDF:").grid(row=0, column=3, padx=(5, 2), pady=5, sticky="e")
+        ctk.CTkOptionMenu(options_frame, variable=self.render_engine_var, values=list(RENDER_ENGINE_LABELS.values()), width=170).grid(row=0, column=4, padx=5, pady=5, sticky="e")
 
         # --- Selección de Imágenes y Salida ---
         ctk.CTkLabel(main_frame, text="Imágenes:").grid(row=row_idx, column=0, padx=10, pady=5, sticky="w")
@@ -341,6 +2523,18 @@ class App(ctk.CTk):
         # --- Etiqueta de Estado ---
         self.status_label = ctk.CTkLabel(main_frame, text="Listo.", anchor="w", text_color="gray60"); self.status_label.grid(row=row_idx, column=0, columnspan=3, padx=10, pady=(5, 10), sticky="ew"); row_idx += 1
 
+        # --- Cola de Generación ---
+        queue_frame = ctk.CTkFrame(main_frame); queue_frame.grid(row=row_idx, column=0, columnspan=3, padx=10, pady=(0, 10), sticky="ew"); row_idx += 1
+        cols = ('id', 'paciente', 'estado', 'detalle'); self.queue_tree = ttk.Treeview(queue_frame, columns=cols, show='headings', height=4, selectmode='browse')
+        for col, text, width, stretch in (('id', "#", 50, False), ('paciente', "Paciente", 200, True), ('estado', "Estado", 100, False), ('detalle', "Detalle", 320, True)): self.queue_tree.heading(col, text=text, anchor="w"); self.queue_tree.column(col, width=width, stretch=stretch, anchor="w")
+        queue_vsb = ttk.Scrollbar(queue_frame, orient="vertical", command=self.queue_tree.yview); self.queue_tree.configure(yscrollcommand=queue_vsb.set)
+        queue_buttons = ctk.CTkFrame(queue_frame, fg_color="transparent"); queue_buttons.pack(side="right", fill="y", padx=5, pady=5)
+        queue_vsb.pack(side="right", fill="y"); self.queue_tree.pack(side="left", fill="both", expand=True)
+        self.button_job_cancel = ctk.CTkButton(queue_buttons, text="Cancelar", command=self.cancel_selected_job, fg_color="#B22222", width=100); self.button_job_cancel.pack(pady=2)
+        self.button_job_retry = ctk.CTkButton(queue_buttons, text="Reintentar", command=self.retry_selected_job, width=100); self.button_job_retry.pack(pady=2)
+        self.button_job_open = ctk.CTkButton(queue_buttons, text="Abrir PDF", command=self.open_selected_job_pdf, width=100); self.button_job_open.pack(pady=2)
+        self.queue_tree.bind("<<TreeviewSelect>>", lambda e: self._update_job_buttons()); self._queue_jobs = {}; self._update_job_buttons(); self.after(PROGRESS_REFRESH_MS, self._poll_queue)
+
     def open_settings_window(self):
         """Abre la ventana de configuración."""
         if self.settings_window is None or not self.settings_window.winfo_exists():
@@ -384,17 +2578,11 @@ class App(ctk.CTk):
 
     def sanitize_filename(self, name):
         """Limpia un nombre de archivo."""
-        if not name: return "_"
-        valid = "-_.() abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"; san = ''.join(c for c in name if c in valid)
-        san = san.replace(' ', '_'); san = san.strip('_.- '); return san[:100] or "_"
+        return sanitize_filename(name)
 
     def select_save_path(self, suggested_filename=None):
         """Abre diálogo para guardar PDF, usando dir default. Devuelve True/False."""
-        if not suggested_filename:
-            p = self.sanitize_filename(self.paciente_var.get()) or "P"; c = self.sanitize_filename(self.cliente_var.get()) or "C"
-            try: f = datetime.strptime(self.fecha_var.get(), '%Y-%m-%d').strftime('%Y%m%d')
-            except ValueError: f = datetime.now().strftime('%Y%m%d')
-            suggested_filename = f"Reporte_{p}_{c}_{f}.pdf"
+        if not suggested_filename: suggested_filename = suggested_report_filename({'paciente': self.paciente_var.get(), 'cliente': self.cliente_var.get(), 'fecha_cirugia': self.fecha_var.get()})
         initial_out_dir = self.config.get(CONFIG_KEY_OUTPUT_DIR) or str(Path.home())
         if not Path(initial_out_dir).is_dir(): print(f"WARN: Dir salida default no válido: '{initial_out_dir}'. Usando Home."); initial_out_dir = str(Path.home())
         file_path = filedialog.asksaveasfilename(title="Guardar PDF Como", initialdir=initial_out_dir, initialfile=suggested_filename, defaultextension=".pdf", filetypes=(("PDF", "*.pdf"), ("Todos", "*.*")))
@@ -442,174 +2630,150 @@ class App(ctk.CTk):
 
     # --- Gestión de Hilos ---
     def start_pdf_generation_thread(self):
-        """Inicia la generación en un hilo."""
+        """Encola el formulario actual como trabajo de generación; el formulario queda libre para el siguiente reporte."""
         if not self._validate_inputs():
             self._update_status("Error: Corrige los datos.", is_error=True)
             self.after(0, lambda: show_error_safe("Datos Inválidos", self.validation_error_message))
             return
-        self.button_generate.configure(state="disabled", text="Generando..."); self.button_clear.configure(state="disabled"); self.button_stats.configure(state="disabled"); self.button_browse.configure(state="disabled"); self.button_save_as.configure(state="disabled"); self.button_settings.configure(state="disabled")
-        self._update_status("Iniciando generación..."); self.last_generated_pdf_path = None
-        self.button_print.configure(state="disabled"); self.button_email.configure(state="disabled")
-        global last_conversion_error, last_db_error; last_conversion_error = ""; last_db_error = ""
-        quality = self.image_quality_var.get()
-        # Layout ahora es fijo a 2, se usa image_pairs
-        thread = threading.Thread(target=self.generate_pdf_worker, args=(quality,), daemon=True)
-        thread.start()
-
-    def generate_pdf_worker(self, image_quality):
-        """Lógica de generación (ejecutada en hilo). Layout fijo a 2."""
-        images_per_row = 2 # Fijo a 2 columnas
-        print(f"\n--- HILO GENERATE INICIADO (Q:{image_quality}, L:{images_per_row}/fila) ---"); start_time = time.time()
-        success = False; render_success = False; conversion_success = False; db_save_success = False
-        generated_pdf_final_path = None; temp_docx_path = None
-        try:
-            self._update_status("Paso 1/5: Recopilando datos..."); time.sleep(0.1)
-            context = { 'fecha_cirugia': self.fecha_var.get(), 'cliente': self.cliente_var.get().strip(), 'paciente': self.paciente_var.get().strip(), 'medico': self.medico_var.get().strip(), 'tecnico': self.tecnico_var.get().strip(), 'tipo_cirugia': self.tipo_cirugia_var.get().strip(), 'lugar': self.lugar_var.get().strip(), 'observaciones_generales': self.text_obs_gen.get("1.0", "end-1c").strip(), 'encargado_preparacion': self.enc_prep_var.get().strip(), 'encargado_logistica': self.enc_log_var.get().strip(), 'coordinador_cx': self.coord_cx_var.get().strip(), 'observaciones_logistica': self.text_obs_log.get("1.0", "end-1c").strip(),
-                       'image_pairs': [] } # Usaremos image_pairs
-            record_id = str(uuid.uuid4()); unique_id_for_qr = str(uuid.uuid4()); context['unique_id'] = unique_id_for_qr
-            now = datetime.now(); context['fecha_emision'] = now.strftime('%d/%m/%Y %H:%M:%S'); context['fecha_emision_corta'] = now.strftime('%d/%m/%Y'); print(f"DEBUG: Fecha emisión: {context['fecha_emision']}")
-            self._update_status("Paso 1/5: Preparando archivos..."); time.sleep(0.1)
-            template_path = Path(TEMPLATE_FILENAME); output_pdf_path_user = Path(self.output_pdf_path_str); temp_docx_path = Path(output_pdf_path_user.parent / f"temp_docx_{record_id[:8]}.docx").resolve()
-            if not template_path.exists(): raise FileNotFoundError(f"Plantilla '{TEMPLATE_FILENAME}' no encontrada.")
-            doc = DocxTemplate(template_path)
-            self._update_status("Paso 2/5: Procesando imágenes..."); time.sleep(0.1)
-            processed_images = []; num_images = len(self.image_file_paths); target_width_mm = LAYOUT_2_PER_ROW_WIDTH_MM # Usar ancho para 2 columnas
-            print(f"DEBUG: Procesando {num_images} imágenes (target width: {target_width_mm}mm).")
-            for i, img_path_str in enumerate(self.image_file_paths):
-                 self._update_status(f"Paso 2/5: Procesando imagen {i+1}/{num_images}..."); time.sleep(0.05)
-                 img_path = Path(img_path_str.strip())
-                 if not img_path.exists(): print(f"WARN: Imagen no encontrada: {img_path}"); continue
-                 compressed_path = compress_image(img_path, target_width_mm, image_quality); print(f"DEBUG: compress_image para '{img_path.name}' devolvió: {compressed_path}")
-                 if compressed_path:
-                     self.temp_image_files.append(compressed_path)
-                     try: inline_img = InlineImage(doc, str(compressed_path), width=Mm(target_width_mm)); processed_images.append(inline_img); print(f"DEBUG: InlineImage creado para '{compressed_path.name}'")
-                     except Exception as img_add_error: print(f"ERROR Add InlineImage: {compressed_path.name}: {img_add_error}"); print(f"DEBUG: Falló InlineImage para '{compressed_path.name}'")
-                 else: print(f"WARN: Falló compresión: {img_path.name}"); print(f"DEBUG: Saltando imagen '{img_path.name}'")
-            print(f"DEBUG: Total InlineImage procesados: {len(processed_images)}")
-            # Agrupar en pares para la plantilla
-            image_pairs = [];
-            for i in range(0, len(processed_images), 2): img1 = processed_images[i]; img2 = processed_images[i+1] if (i+1) < len(processed_images) else None; image_pairs.append((img1, img2))
-            context['image_pairs'] = image_pairs; print(f"DEBUG: Añadiendo 'image_pairs' con {len(context['image_pairs'])} pares.")
-            self._update_status("Paso 3/5: Generando DOCX..."); time.sleep(0.1); print(f"DEBUG: Contexto Keys={list(context.keys())}"); print(f"Renderizando DOCX: {temp_docx_path}..."); doc.render(context); doc.save(temp_docx_path); print("DOCX OK."); render_success = True
-            self._update_status("Paso 4/5: Convirtiendo a PDF..."); time.sleep(0.1)
-            if convert_to_pdf(temp_docx_path, output_pdf_path_user.parent):
-                generated_pdf_temp_name = temp_docx_path.with_suffix('.pdf')
-                if generated_pdf_temp_name.exists():
-                    try:
-                        if output_pdf_path_user.exists(): output_pdf_path_user.unlink()
-                        generated_pdf_temp_name.rename(output_pdf_path_user); generated_pdf_final_path = str(output_pdf_path_user); conversion_success = True
-                    except Exception as rename_error: global last_conversion_error; last_conversion_error = f"PDF generado ({generated_pdf_temp_name.name}) pero no renombrado: {rename_error}"; generated_pdf_final_path = str(generated_pdf_temp_name)
-                else: last_conversion_error = f"Conversión OK, pero PDF no encontrado: {generated_pdf_temp_name}"
-            if render_success and conversion_success:
-                self._update_status("Paso 5/5: Guardando registro..."); time.sleep(0.1)
-                record_data = {k: v for k, v in context.items() if k not in ['image_pairs', 'fecha_emision', 'fecha_emision_corta']} # Excluir image_pairs y fechas
-                record_data.update({'id': record_id, 'fecha_generacion': datetime.now().isoformat(timespec='seconds'), 'archivo_pdf': generated_pdf_final_path, 'unique_id': unique_id_for_qr})
-                if save_record(record_data): db_save_success = True; self.after(0, self.update_suggestions)
-            success = render_success and conversion_success and db_save_success
-        except FileNotFoundError as e: print(f"ERROR Worker (FileNotFound): {e}"); self.after(0, lambda e=e: show_error_safe("Error Crítico", f"Archivo no encontrado:\n{e}")); self._update_status(f"Error: {e}", is_error=True)
-        except Exception as e: print(f"ERROR Worker (General): {type(e).__name__} - {e}\n{traceback.format_exc()}"); self.after(0, lambda e=e: show_error_safe("Error Crítico Inesperado", f"Ocurrió un error:\n{type(e).__name__}: {e}")); self._update_status(f"Error crítico: {e}", is_error=True)
-        finally:
-            end_time = time.time(); duration = end_time - start_time; print(f"--- HILO GENERATE FINALIZADO (Dur: {duration:.2f}s, Éxito Render: {render_success}, Éxito Convert: {conversion_success}, Éxito DB: {db_save_success}) ---")
-            self.after(0, self._finalize_generation, success, generated_pdf_final_path, duration)
-            print("Limpiando archivos temporales (worker)...")
-            if temp_docx_path and temp_docx_path.exists():
-                try: temp_docx_path.unlink(); print(f"  - DOCX temp eliminado.")
-                except Exception as clean_err: print(f"WARN: No eliminar DOCX temp: {clean_err}")
-            self._cleanup_temp_images()
-
-    def _finalize_generation(self, success, final_pdf_path, duration):
-        """Actualiza GUI al finalizar generación."""
-        print("Finalizando en GUI...");
-        self.button_generate.configure(state="normal", text="Generar PDF"); self.button_clear.configure(state="normal"); self.button_stats.configure(state="normal"); self.button_browse.configure(state="normal"); self.button_save_as.configure(state="normal"); self.button_settings.configure(state="normal")
-        fail_reason = ""
-        if not success:
-            if last_conversion_error: fail_reason = f"Conversión PDF: {last_conversion_error}"
-            elif last_db_error: fail_reason = f"Base de Datos: {last_db_error}"
-            else: fail_reason = "Causa desconocida (ver consola)."
-        if success:
-            final_msg = f"Éxito! PDF en {duration:.1f}s: {Path(final_pdf_path).name}"
-            self._update_status(final_msg); self.after(0, lambda p=final_pdf_path: show_info_safe("Generación Completada", f"Éxito! PDF generado:\n{Path(p).name}"))
+        if not self.db_ready.is_set(): self._update_status("Esperando a la base de datos..."); self.after(100, self.start_pdf_generation_thread); return
+        job = self._collect_report_job() # Se lee el formulario en el hilo de Tk; la cola no toca variables Tk
+        try: job_id = self.job_queue.submit(job)
+        except sqlite3.Error as e: show_error_safe("Error de Cola", f"No se pudo encolar el reporte:\n{e}"); return
+        self.output_pdf_path_str = ""; self.entry_output.configure(state="normal"); self.entry_output.delete(0, "end"); self.entry_output.insert(0, "Seleccionar..."); self.entry_output.configure(state="readonly") # El siguiente reporte no pisa este PDF
+        self._update_status(f"Trabajo #{job_id} en cola: {Path(job['output_pdf']).name}")
+
+    def _collect_report_job(self):
+        """Foto fija del formulario actual como trabajo de generación."""
+        fields = { 'fecha_cirugia': self.fecha_var.get(), 'cliente': self.cliente_var.get(), 'paciente': self.paciente_var.get(), 'medico': self.medico_var.get(), 'tecnico': self.tecnico_var.get(), 'tipo_cirugia': self.tipo_cirugia_var.get(), 'lugar': self.lugar_var.get(), 'observaciones_generales': self.text_obs_gen.get("1.0", "end-1c"), 'encargado_preparacion': self.enc_prep_var.get(), 'encargado_logistica': self.enc_log_var.get(), 'coordinador_cx': self.coord_cx_var.get(), 'observaciones_logistica': self.text_obs_log.get("1.0", "end-1c") }
+        return new_report_job(fields, self.image_file_paths, self.output_pdf_path_str, self.image_quality_var.get(), next(engine for engine, label in RENDER_ENGINE_LABELS.items() if label == self.render_engine_var.get()))
+
+    def _on_job_finished(self, job_id, result):
+        """Actualiza GUI al terminar un trabajo de la cola (hilo Tk)."""
+        if not self.winfo_exists(): return
+        self._queue_version = None; duration = result['duration']; final_pdf_path = result['pdf'] # Fuerza refresco del panel
+        if result['ok']:
+            self.update_suggestions(); self._update_status(f"Éxito! Trabajo #{job_id}, PDF en {duration:.1f}s: {Path(final_pdf_path).name}")
             self.last_generated_pdf_path = final_pdf_path; self.button_print.configure(state="normal"); self.button_email.configure(state="normal")
+        elif result['error'] == "Cancelado.": self._update_status(f"Trabajo #{job_id} cancelado ({duration:.1f}s).")
         else:
-            final_msg = f"Generación Fallida ({duration:.1f}s)."
-            error_display = f"La generación del PDF falló.\n\nMotivo: {fail_reason}"
-            self.after(0, lambda ed=error_display: show_error_safe("Error de Generación", ed))
-            self._update_status(f"Generación fallida ({duration:.1f}s).", is_error=True); self.last_generated_pdf_path = None; self.button_print.configure(state="disabled"); self.button_email.configure(state="disabled")
+            fail_reason = result['error'] or "Causa desconocida (ver consola)."
+            self.after(0, lambda ed=f"La generación del trabajo #{job_id} falló.\n\nMotivo: {fail_reason}": show_error_safe("Error de Generación", ed))
+            self._update_status(f"Trabajo #{job_id} fallido ({duration:.1f}s).", is_error=True)
+
+    # --- Panel de Cola ---
+    def _poll_queue(self):
+        """Refresca el panel si la cola cambió y muestra el último progreso de cada trabajo en curso (cada PROGRESS_REFRESH_MS)."""
+        if self.db_ready.is_set() and self._queue_version != self.job_queue.version:
+            self._queue_version = self.job_queue.version
+            try: self._reload_queue_panel()
+            except sqlite3.Error as e: print(f"ERROR Panel cola: {e}")
+        for job_id, message in self.job_queue.progress_messages().items():
+            if self.queue_tree.exists(str(job_id)): self.queue_tree.set(str(job_id), 'detalle', message)
+        self.after(PROGRESS_REFRESH_MS, self._poll_queue)
+
+    def _reload_queue_panel(self):
+        selected = self.queue_tree.selection(); self.queue_tree.delete(*self.queue_tree.get_children()); self._queue_jobs = {}
+        for job in self.job_queue.list_jobs():
+            if job['estado'] == 'fallido': detail = job['error'] or ""
+            elif job['estado'] == 'completado': detail = Path(job['archivo_pdf'] or "").name
+            else: detail = job['progreso'] or (f"Intento {job['intentos'] + 1}" if job['intentos'] else "")
+            self._queue_jobs[str(job['id'])] = job; self.queue_tree.insert("", "end", iid=str(job['id']), values=(job['id'], job['paciente'], JOB_STATE_LABELS.get(job['estado'], job['estado']), detail))
+        keep = [iid for iid in selected if self.queue_tree.exists(iid)]
+        if keep: self.queue_tree.selection_set(keep)
+        self._update_job_buttons()
+
+    def _selected_job(self):
+        selected = self.queue_tree.selection(); return self._queue_jobs.get(selected[0]) if selected else None
+
+    def _update_job_buttons(self):
+        job = self._selected_job(); state = job['estado'] if job else None
+        self.button_job_cancel.configure(state="normal" if state in ('pendiente', 'en_curso') else "disabled")
+        self.button_job_retry.configure(state="normal" if state in ('fallido', 'cancelado') else "disabled")
+        self.button_job_open.configure(state="normal" if state == 'completado' else "disabled")
+
+    def cancel_selected_job(self):
+        """Saca de la cola el trabajo seleccionado o detiene su generación (termina el conversor en curso)."""
+        job = self._selected_job()
+        if job and not self.job_queue.cancel(job['id']): self._update_status(f"El trabajo #{job['id']} ya terminó.")
+
+    def retry_selected_job(self):
+        """Devuelve a la cola un trabajo fallido o cancelado."""
+        job = self._selected_job()
+        if job and self.job_queue.retry(job['id']): self._update_status(f"Trabajo #{job['id']} de nuevo en cola.")
+
+    def open_selected_job_pdf(self):
+        """Abre el PDF de un trabajo completado."""
+        job = self._selected_job()
+        if not job or not job['archivo_pdf']: return
+        pdf_p = Path(job['archivo_pdf'])
+        if not pdf_p.exists(): show_error_safe("Error", f"Archivo no encontrado:\n{pdf_p}"); return
+        try:
+            if sys.platform == "win32": os.startfile(str(pdf_p))
+            elif sys.platform == "darwin": subprocess.run(["open", str(pdf_p)], check=True)
+            else: subprocess.run(["xdg-open", str(pdf_p)], check=True)
+        except Exception as e: show_error_safe("Error", f"No abrir PDF:\n{e}")
+
+    # --- Progreso Agrupado ---
+    def _start_progress(self):
+        """Empieza a mostrar self.progress (una generación o regeneración más en curso)."""
+        self._progress_users += 1
+        if self._progress_after_id is None: self._poll_progress()
+
+    def _stop_progress(self):
+        """Una tarea menos en curso; sin tareas se deja de consultar y se descartan mensajes pendientes."""
+        self._progress_users = max(0, self._progress_users - 1)
+        if self._progress_users == 0:
+            if self._progress_after_id is not None: self.after_cancel(self._progress_after_id); self._progress_after_id = None
+            self.progress.take(); print(f"DEBUG: Progreso: {self.progress.posted} avisos, {self.progress.shown} mostrados.")
+
+    def _poll_progress(self):
+        """Muestra el último aviso pendiente; como mucho un refresco cada PROGRESS_REFRESH_MS."""
+        message = self.progress.take()
+        if message: self.status_label.configure(text=message, text_color="gray60")
+        self._progress_after_id = self.after(PROGRESS_REFRESH_MS, self._poll_progress)
 
     # --- Hilos para Regeneración ---
     def start_regenerate_thread(self, data, save_path):
         """Inicia la regeneración en un hilo."""
-        self._update_status("Iniciando regeneración...")
-        global last_conversion_error; last_conversion_error = ""
+        self._update_status("Iniciando regeneración..."); self._start_progress()
         thread = threading.Thread(target=self.regenerate_pdf_worker, args=(data, save_path), daemon=True)
         thread.start()
 
     def regenerate_pdf_worker(self, data, output_pdf_path_str):
         """Lógica de regeneración (ejecutada en hilo)."""
-        print(f"\n--- HILO REGENERATE INICIADO (ID: {data.get('id', 'N/A')}) ---"); start_time = time.time()
-        success = False; render_success = False; conversion_success = False
-        generated_pdf_final_path = None; temp_docx_path = None
-        original_unique_id = data.get('unique_id'); original_record_id = data.get('id')
-        try:
-            if not original_unique_id or not original_record_id: raise ValueError("Datos de registro inválidos.")
-            self._update_status("Regenerando: Preparando datos..."); time.sleep(0.1)
-            output_pdf_path = Path(output_pdf_path_str); template_path = Path(TEMPLATE_FILENAME); temp_docx_path = Path(output_pdf_path.parent / f"temp_regen_{original_record_id[:8]}.docx").resolve()
-            keys_to_keep = ['fecha_cirugia', 'cliente', 'paciente', 'medico', 'tecnico', 'tipo_cirugia', 'lugar', 'observaciones_generales', 'encargado_preparacion', 'encargado_logistica', 'coordinador_cx', 'observaciones_logistica']
-            context = {k: data.get(k, '') for k in keys_to_keep}; context['unique_id'] = original_unique_id
-            now = datetime.now(); context['fecha_emision'] = now.strftime('%d/%m/%Y %H:%M:%S'); context['fecha_emision_corta'] = now.strftime('%d/%m/%Y')
-            regen_warning = "\n\n--- REGENERADO (SIN IMÁGENES ORIGINALES) ---"; context['observaciones_generales'] += regen_warning
-            context['image_pairs'] = [] # Sin imágenes, usar la clave correcta para la plantilla
-            if not template_path.exists(): raise FileNotFoundError(f"Plantilla '{TEMPLATE_FILENAME}' no encontrada.")
-            doc = DocxTemplate(template_path)
-            self._update_status("Regenerando: Creando DOCX..."); time.sleep(0.1); print(f"Renderizando DOCX (regen): {temp_docx_path}..."); doc.render(context); doc.save(temp_docx_path); print("DOCX (regen) OK."); render_success = True
-            self._update_status("Regenerando: Convirtiendo a PDF..."); time.sleep(0.1)
-            if convert_to_pdf(temp_docx_path, output_pdf_path.parent):
-                generated_pdf_temp_name = temp_docx_path.with_suffix('.pdf')
-                if generated_pdf_temp_name.exists():
-                    try:
-                        if output_pdf_path.exists(): output_pdf_path.unlink()
-                        generated_pdf_temp_name.rename(output_pdf_path); generated_pdf_final_path = str(output_pdf_path); conversion_success = True
-                    except Exception as rename_error: global last_conversion_error; last_conversion_error = f"PDF (regen) generado ({generated_pdf_temp_name.name}) pero no renombrado: {rename_error}"; generated_pdf_final_path = str(generated_pdf_temp_name)
-                else: last_conversion_error = f"Conversión (regen) OK, pero PDF no encontrado: {generated_pdf_temp_name}"
-            success = render_success and conversion_success
-        except FileNotFoundError as e: print(f"ERROR Regen Worker (FileNotFound): {e}"); self.after(0, lambda e=e: show_error_safe("Error Crítico (Regen)", f"Archivo no encontrado:\n{e}")); self._update_status(f"Error Regen: {e}", is_error=True)
-        except Exception as e: print(f"ERROR Regen Worker (General): {type(e).__name__} - {e}\n{traceback.format_exc()}"); self.after(0, lambda e=e: show_error_safe("Error Crítico (Regen)", f"Ocurrió un error:\n{type(e).__name__}: {e}")); self._update_status(f"Error crítico Regen: {e}", is_error=True)
-        finally:
-            end_time = time.time(); duration = end_time - start_time; print(f"--- HILO REGENERATE FINALIZADO (Dur: {duration:.2f}s, Éxito: {success}) ---")
-            self.after(0, self._finalize_regeneration, success, generated_pdf_final_path, duration)
-            print("Limpiando DOCX temporal (regen)...")
-            if temp_docx_path and temp_docx_path.exists():
-                try: temp_docx_path.unlink(); print(f"  - DOCX temp (regen) eliminado.")
-                except Exception as clean_err: print(f"WARN: No eliminar DOCX temp (regen): {clean_err}")
-
-    def _finalize_regeneration(self, success, final_pdf_path, duration):
+        try: result = regenerate_report(data, output_pdf_path_str, self.config, progress_cb=self.progress)
+        except Exception as e: print(f"ERROR Regen Worker: {type(e).__name__} - {e}\n{traceback.format_exc()}"); result = {'ok': False, 'pdf': None, 'error': f"{type(e).__name__}: {e}", 'images': 0, 'duration': 0.0}
+        self.after(0, self._finalize_regeneration, result)
+
+    def _finalize_regeneration(self, result):
         """Actualiza GUI al finalizar regeneración."""
-        print("Finalizando regeneración en GUI...")
-        fail_reason = ""
-        if not success:
-             if last_conversion_error: fail_reason = f"Conversión PDF: {last_conversion_error}"
-             else: fail_reason = "Causa desconocida (ver consola)."
-        if success:
+        print("Finalizando regeneración en GUI..."); self._stop_progress()
+        duration = result['duration']; final_pdf_path = result['pdf']; image_count = result['images']
+        if result['ok']:
             final_msg = f"Regeneración OK ({duration:.1f}s): {Path(final_pdf_path).name}"
-            self._update_status(final_msg); self.after(0, lambda p=final_pdf_path: show_info_safe("Regeneración Completada", f"PDF Regenerado:\n{Path(p).name}\n(Sin imágenes originales)"))
+            self._update_status(final_msg); self.after(0, lambda p=final_pdf_path: show_info_safe("Regeneración Completada", f"PDF Regenerado:\n{Path(p).name}\n" + (f"({image_count} imágenes originales)" if image_count else "(Sin imágenes originales)")))
             if self.winfo_exists(): self.last_generated_pdf_path = final_pdf_path; self.button_print.configure(state="normal"); self.button_email.configure(state="normal")
         else:
             final_msg = f"Regeneración Fallida ({duration:.1f}s)."
-            error_display = f"Falló la regeneración.\n\nMotivo: {fail_reason}"
+            error_display = f"Falló la regeneración.\n\nMotivo: {result['error'] or 'Causa desconocida (ver consola).'}"
             self.after(0, lambda ed=error_display: show_error_safe("Error de Regeneración", ed))
             self._update_status(f"Regeneración fallida ({duration:.1f}s).", is_error=True);
             if self.winfo_exists(): self.last_generated_pdf_path = None; self.button_print.configure(state="disabled"); self.button_email.configure(state="disabled")
 
     # --- Otros métodos ---
+    def _suggestion_combos(self):
+        return { self.combo_medico: 'medico', self.combo_cliente: 'cliente', self.combo_tecnico: 'tecnico', self.combo_tipo_cirugia: 'tipo_cirugia', self.combo_lugar: 'lugar', self.combo_enc_prep: 'encargado_preparacion', self.combo_enc_log: 'encargado_logistica', self.combo_coord_cx: 'coordinador_cx' }
+
     def update_suggestions(self):
         """Actualiza las listas de sugerencias en los Combobox."""
-        print("Actualizando sugerencias...")
-        suggestion_map = { self.combo_medico: 'medico', self.combo_cliente: 'cliente', self.combo_tecnico: 'tecnico', self.combo_tipo_cirugia: 'tipo_cirugia', self.combo_lugar: 'lugar', self.combo_enc_prep: 'encargado_preparacion', self.combo_enc_log: 'encargado_logistica', self.combo_coord_cx: 'coordinador_cx' }
-        for combo, field in suggestion_map.items():
-            current = combo.get(); suggestions = get_suggestions(field); combo.configure(values=suggestions)
-            if current in suggestions or (current and current not in combo.cget('values')): combo.set(current)
-            else: combo.set("")
-        print("Sugerencias OK.")
+        if not get_suggestion_index().ready.is_set(): return # Se rellenarán al terminar la carga
+        for combo, field in self._suggestion_combos().items():
+            current = combo.get(); combo.configure(values=get_suggestions(field, prefix=current)); combo.set(current)
+
+    def _filter_suggestions(self, event, combo, field):
+        """Filtra la lista del Combobox con lo escrito hasta ahora."""
+        if event.keysym in ("Up", "Down", "Left", "Right", "Return", "Escape", "Tab", "Shift_L", "Shift_R", "Control_L", "Control_R"): return
+        if get_suggestion_index().ready.is_set(): combo.configure(values=get_suggestions(field, prefix=combo.get()))
 
     def print_last_pdf(self):
         """Abre el último PDF generado para imprimir."""
@@ -637,6 +2801,7 @@ class App(ctk.CTk):
 
     def show_stats_window(self):
         """Muestra la ventana de estadísticas."""
+        if not self.db_ready.is_set(): self._update_status("Preparando base de datos..."); self.after(100, self.show_stats_window); return
         if self.stats_window and self.stats_window.winfo_exists(): self.stats_window.lift(); self.stats_window.focus()
         else: self.stats_window = StatsWindow(self); self.stats_window.focus()
 
@@ -654,7 +2819,7 @@ class App(ctk.CTk):
 
     def on_closing(self):
         """Acciones al cerrar la ventana principal."""
-        print("Cerrando aplicación..."); self._cleanup_temp_images()
+        print("Cerrando aplicación..."); self._cleanup_temp_images(); self.job_queue.stop(); stop_office_daemon(); shutdown_image_pool(); close_db()
         if self.stats_window and self.stats_window.winfo_exists(): self.stats_window.destroy()
         if self.settings_window and self.settings_window.winfo_exists(): self.settings_window.destroy()
         self.destroy()
@@ -667,6 +2832,7 @@ class StatsWindow(ctk.CTkToplevel):
         self.transient(master); self.grab_set(); self.protocol("WM_DELETE_WINDOW", self.on_closing)
         container = ctk.CTkFrame(self); container.pack(pady=10, padx=10, fill="both", expand=True)
         self._create_filter_widgets(container); self._create_results_widgets(container); self._create_bottom_widgets(container)
+        self._load_gen = 0; self._next_key = None; self._loading = False; self._filters = None; self._search = ""; self._sort_col = None; self._sort_desc = True
         self.load_stats()
 
     def _create_filter_widgets(self, parent):
@@ -676,53 +2842,43 @@ class StatsWindow(ctk.CTkToplevel):
         ctk.CTkLabel(filter_frame, text="Desde:").grid(row=0, column=0, padx=(10,5), pady=5, sticky="w"); self.date_from = DateEntry(filter_frame, width=12, date_pattern='yyyy-mm-dd', state='readonly', locale='es_ES'); self.date_from.grid(row=0, column=1, padx=5, pady=5, sticky="w"); self.date_from.set_date(None)
         ctk.CTkLabel(filter_frame, text="Hasta:").grid(row=0, column=2, padx=(10,5), pady=5, sticky="w"); self.date_to = DateEntry(filter_frame, width=12, date_pattern='yyyy-mm-dd', state='readonly', locale='es_ES'); self.date_to.grid(row=0, column=3, padx=5, pady=5, sticky="w"); self.date_to.set_date(None)
         ctk.CTkButton(filter_frame, text="Limpiar Fechas", width=100, command=self._clear_dates, fg_color="grey").grid(row=0, column=4, padx=(10, 5), pady=5)
+        self.date_column_var = tk.StringVar(value='Generado'); ctk.CTkOptionMenu(filter_frame, values=list(DATE_FILTER_COLUMNS), variable=self.date_column_var, width=110).grid(row=0, column=5, padx=(5, 10), pady=5)
         ctk.CTkLabel(filter_frame, text="Médico:").grid(row=1, column=0, padx=(10,5), pady=5, sticky="w"); self.medico_filter = ctk.CTkEntry(filter_frame, placeholder_text="Buscar...", width=200); self.medico_filter.grid(row=1, column=1, padx=5, pady=5, sticky="ew")
         ctk.CTkLabel(filter_frame, text="Paciente:").grid(row=1, column=2, padx=(10,5), pady=5, sticky="w"); self.paciente_filter = ctk.CTkEntry(filter_frame, placeholder_text="Buscar...", width=200); self.paciente_filter.grid(row=1, column=3, padx=5, pady=5, sticky="ew")
         ctk.CTkLabel(filter_frame, text="Cliente:").grid(row=2, column=0, padx=(10,5), pady=5, sticky="w"); self.cliente_filter = ctk.CTkEntry(filter_frame, placeholder_text="Buscar...", width=200); self.cliente_filter.grid(row=2, column=1, padx=5, pady=5, sticky="ew")
         ctk.CTkLabel(filter_frame, text="ID QR:").grid(row=2, column=2, padx=(10,5), pady=5, sticky="w"); self.unique_id_filter = ctk.CTkEntry(filter_frame, placeholder_text="ID exacto...", width=200); self.unique_id_filter.grid(row=2, column=3, padx=5, pady=5, sticky="ew")
-        b_sub = ctk.CTkFrame(filter_frame, fg_color="transparent"); b_sub.grid(row=3, column=0, columnspan=5, padx=10, pady=10)
+        ctk.CTkLabel(filter_frame, text="Texto:").grid(row=3, column=0, padx=(10,5), pady=5, sticky="w"); self.search_entry = ctk.CTkEntry(filter_frame, placeholder_text="Paciente, médico, cliente, observaciones... (Enter para buscar)"); self.search_entry.grid(row=3, column=1, columnspan=3, padx=5, pady=5, sticky="ew"); self.search_entry.bind("<Return>", lambda e: self.load_stats())
+        b_sub = ctk.CTkFrame(filter_frame, fg_color="transparent"); b_sub.grid(row=4, column=0, columnspan=5, padx=10, pady=10)
         ctk.CTkButton(b_sub, text="Buscar", command=self.load_stats).pack(side="left", padx=5); ctk.CTkButton(b_sub, text="Limpiar Filtros", command=self._clear_filters, fg_color="grey").pack(side="left", padx=5)
 
     def _clear_dates(self): self.date_from.set_date(None); self.date_to.set_date(None)
-    def _clear_filters(self): self._clear_dates(); self.medico_filter.delete(0, "end"); self.paciente_filter.delete(0, "end"); self.cliente_filter.delete(0, "end"); self.unique_id_filter.delete(0, "end"); self.load_stats()
+    def _clear_filters(self): self._clear_dates(); self.medico_filter.delete(0, "end"); self.paciente_filter.delete(0, "end"); self.cliente_filter.delete(0, "end"); self.unique_id_filter.delete(0, "end"); self.search_entry.delete(0, "end"); self.load_stats()
 
     def _create_results_widgets(self, parent):
         """Crea la tabla Treeview para mostrar resultados."""
         results_frame = ctk.CTkFrame(parent); results_frame.pack(pady=10, padx=10, fill="both", expand=True); style = ttk.Style(self); style.theme_use("clam")
         cols = ('fecha_gen', 'fecha_cx', 'paciente', 'medico', 'tipo', 'lugar', 'enc_prep', 'unique_id_col'); self.tree = ttk.Treeview(results_frame, columns=cols, show='headings')
-        h = self.tree.heading; s = self._sort_column; c = self.tree.column # Alias
-        h('fecha_gen', text='Generado', command=lambda: s('fecha_gen',False)); c('fecha_gen', width=130, anchor='w')
-        h('fecha_cx', text='Fecha Cx', command=lambda: s('fecha_cx',False)); c('fecha_cx', width=90, anchor='c')
-        h('paciente', text='Paciente', command=lambda: s('paciente',False)); c('paciente', width=180, anchor='w')
-        h('medico', text='Médico', command=lambda: s('medico',False)); c('medico', width=180, anchor='w')
-        h('tipo', text='Tipo Cx', command=lambda: s('tipo',False)); c('tipo', width=150, anchor='w')
-        h('lugar', text='Lugar', command=lambda: s('lugar',False)); c('lugar', width=150, anchor='w')
-        h('enc_prep', text='Enc Prep', command=lambda: s('enc_prep',False)); c('enc_prep', width=130, anchor='w')
-        h('unique_id_col', text='ID QR', command=lambda: s('unique_id_col',False)); c('unique_id_col', width=100, anchor='w')
-        vsb = ttk.Scrollbar(results_frame, orient="vertical", command=self.tree.yview); hsb = ttk.Scrollbar(results_frame, orient="horizontal", command=self.tree.xview); self.tree.configure(yscrollcommand=vsb.set, xscrollcommand=hsb.set); vsb.pack(side='right', fill='y'); hsb.pack(side='bottom', fill='x'); self.tree.pack(side='left', fill='both', expand=True)
-        self.tree.bind('<<TreeviewSelect>>', self.on_tree_select); self.tree.bind('<Double-1>', self.on_double_click); self.tree_data = {}
-
-    def _sort_column(self, col, reverse):
-        """Ordena la tabla por columna."""
-        try:
-            data = [(self.tree.set(item_id, col), item_id) for item_id in self.tree.get_children('')]
-            def sort_key(item):
-                v = item[0]
-                if v is None: return ""
-                try:
-                    if isinstance(v, str) and ('-' in v or '/' in v):
-                        date_part = v.split(' ')[0]
-                        if len(date_part) == 10 and date_part.count('-') == 2: return datetime.strptime(date_part, '%Y-%m-%d')
-                        return str(v).lower()
-                    return float(v)
-                except (ValueError, TypeError): return str(v).lower()
-            data.sort(key=sort_key, reverse=reverse); [self.tree.move(item_id, '', index) for index, (val, item_id) in enumerate(data)]; self.tree.heading(col, command=lambda: self._sort_column(col, not reverse))
-        except Exception as e: print(f"Error sort '{col}': {e}")
+        self._heading_texts = {'fecha_gen': 'Generado', 'fecha_cx': 'Fecha Cx', 'paciente': 'Paciente', 'medico': 'Médico', 'tipo': 'Tipo Cx', 'lugar': 'Lugar', 'enc_prep': 'Enc Prep', 'unique_id_col': 'ID QR'}
+        for col, text in self._heading_texts.items(): self.tree.heading(col, text=text, command=lambda col=col: self._sort_column(col))
+        c = self.tree.column # Alias
+        c('fecha_gen', width=130, anchor='w'); c('fecha_cx', width=90, anchor='c'); c('paciente', width=180, anchor='w'); c('medico', width=180, anchor='w')
+        c('tipo', width=150, anchor='w'); c('lugar', width=150, anchor='w'); c('enc_prep', width=130, anchor='w'); c('unique_id_col', width=100, anchor='w')
+        self.results_label = ctk.CTkLabel(results_frame, text="", anchor="w"); self.results_label.pack(side='bottom', fill='x', padx=5)
+        self.vsb = ttk.Scrollbar(results_frame, orient="vertical", command=self.tree.yview); hsb = ttk.Scrollbar(results_frame, orient="horizontal", command=self.tree.xview); self.tree.configure(yscrollcommand=self._on_tree_scroll, xscrollcommand=hsb.set); self.vsb.pack(side='right', fill='y'); hsb.pack(side='bottom', fill='x'); self.tree.pack(side='left', fill='both', expand=True)
+        self.tree.bind('<<TreeviewSelect>>', self.on_tree_select); self.tree.bind('<Double-1>', self.on_double_click); self.tree_data = {} # item -> id del registro
+
+    def _sort_column(self, col):
+        """Ordena por columna en la BD (clic repetido invierte el sentido) y recarga desde la primera página."""
+        default_desc = RECORD_SORT_COLUMNS[col][1]
+        descending = (not self._sort_desc) if col == self._sort_col else default_desc
+        self._sort_col = col; self._sort_desc = descending
+        for c, text in self._heading_texts.items(): self.tree.heading(c, text=text + ((" ▼" if descending else " ▲") if c == col else ""))
+        self.load_stats()
 
     def _create_bottom_widgets(self, parent):
         """Crea widgets inferiores (stats, botones)."""
         bottom_frame = ctk.CTkFrame(parent); bottom_frame.pack(pady=(10, 0), padx=10, fill="x")
-        stats_frame = ctk.CTkFrame(bottom_frame); stats_frame.pack(side="left", padx=(0, 10), pady=5, fill="x", expand=True); ctk.CTkLabel(stats_frame, text="Registros por Enc. Preparación:").pack(side="top", anchor="w", padx=5, pady=(5,0)); self.stats_text = ctk.CTkTextbox(stats_frame, height=80, width=350, state="disabled", wrap="word"); self.stats_text.pack(side="bottom", fill="x", expand=True, padx=5, pady=(0,5))
+        stats_frame = ctk.CTkFrame(bottom_frame); stats_frame.pack(side="left", padx=(0, 10), pady=5, fill="x", expand=True); dim_row = ctk.CTkFrame(stats_frame, fg_color="transparent"); dim_row.pack(side="top", fill="x", padx=5, pady=(5,0)); ctk.CTkLabel(dim_row, text="Registros por:").pack(side="left"); self.stats_dimension_var = tk.StringVar(value='Enc. Preparación'); ctk.CTkOptionMenu(dim_row, values=list(STATS_DIMENSIONS), variable=self.stats_dimension_var, command=lambda _: self._show_counts(get_counts_by_dimension(STATS_DIMENSIONS[self.stats_dimension_var.get()])), width=150).pack(side="left", padx=5); self.stats_text = ctk.CTkTextbox(stats_frame, height=80, width=350, state="disabled", wrap="word"); self.stats_text.pack(side="bottom", fill="x", expand=True, padx=5, pady=(0,5))
         action_frame = ctk.CTkFrame(bottom_frame, fg_color="transparent"); action_frame.pack(side="right", padx=(10, 0), pady=5)
         self.import_button = ctk.CTkButton(action_frame, text="Importar Datos\n(Doble Clic)", command=self.import_selected_record, state="disabled", width=120); self.import_button.pack(side="top", anchor="e", padx=5, pady=5)
         self.regenerate_button = ctk.CTkButton(action_frame, text="Regenerar PDF", command=self.initiate_regenerate, state="disabled", width=120); self.regenerate_button.pack(side="top", anchor="e", padx=5, pady=5)
@@ -731,8 +2887,8 @@ class StatsWindow(ctk.CTkToplevel):
 
     def on_tree_select(self, event=None):
         """Actualiza estado de botones al seleccionar."""
-        sel = self.tree.selection(); one = len(sel) == 1; state = "normal" if one else "disabled"; self.import_button.configure(state=state); self.regenerate_button.configure(state=state)
-        if one: item_id = sel[0]; data = self.tree_data.get(item_id); pdf_p = Path(data['archivo_pdf']) if data and data.get('archivo_pdf') else None; self.open_pdf_button.configure(state="normal" if pdf_p and pdf_p.exists() else "disabled")
+        sel = self.tree.selection(); one = len(sel) == 1; state = "normal" if one else "disabled"; self.import_button.configure(state=state); self.regenerate_button.configure(state="normal" if sel else "disabled", text=f"Regenerar {len(sel)} PDF" if len(sel) > 1 else "Regenerar PDF")
+        if one: data = self.get_selected_record_data(); pdf_p = Path(data['archivo_pdf']) if data and data.get('archivo_pdf') else None; self.open_pdf_button.configure(state="normal" if pdf_p and pdf_p.exists() else "disabled")
         else: self.open_pdf_button.configure(state="disabled")
 
     def on_double_click(self, event=None):
@@ -740,7 +2896,7 @@ class StatsWindow(ctk.CTkToplevel):
         if len(self.tree.selection()) == 1: self.import_selected_record()
 
     def load_stats(self):
-        """Carga registros y estadísticas en la tabla."""
+        """Carga registros (primera página, en segundo plano) y estadísticas en la tabla."""
         print("Cargando stats...");
         self.tree.delete(*self.tree.get_children()); self.tree_data = {}
         self.stats_text.configure(state="normal"); self.stats_text.delete("1.0", "end"); self.stats_text.configure(state="disabled")
@@ -754,85 +2910,165 @@ class StatsWindow(ctk.CTkToplevel):
         except Exception as e: print(f"WARN: Error fecha 'Hasta': {e}")
 
         med=self.medico_filter.get().strip() or None; pac=self.paciente_filter.get().strip() or None; cli=self.cliente_filter.get().strip() or None; uid=self.unique_id_filter.get().strip() or None
-
-        sql = "SELECT * FROM cirugias WHERE 1=1"; params = []
-        if d_from: sql += " AND date(fecha_generacion) >= date(?)"; params.append(d_from)
-        if d_to: sql += " AND date(fecha_generacion) <= date(?)"; params.append(d_to)
-        if med: sql += " AND medico LIKE ? COLLATE NOCASE"; params.append(f"%{med}%")
-        if pac: sql += " AND paciente LIKE ? COLLATE NOCASE"; params.append(f"%{pac}%")
-        if cli: sql += " AND cliente LIKE ? COLLATE NOCASE"; params.append(f"%{cli}%")
-        if uid: sql += " AND unique_id = ?"; params.append(uid)
-        sql += " ORDER BY fecha_generacion DESC"; conn = None; results = []
-        try:
-            conn=sqlite3.connect(DB_FILENAME, timeout=10); conn.row_factory=sqlite3.Row; cursor=conn.cursor()
-            print(f"Ejecutando SQL: {sql} con params: {params}")
-            cursor.execute(sql, params); results=cursor.fetchall(); print(f"{len(results)} regs found.")
-        except sqlite3.Error as e:
-            print(f"DB load err: {e}")
-            if self.master_app and self.master_app.winfo_exists(): self.master_app.after(0, lambda e=e: show_error_safe("Error DB", f"Error consulta:\n{e}"))
-        finally:
-             if conn: conn.close()
-
-        if results:
-             for row in results:
-                 rec=dict(row)
-                 dt_gen=rec.get('fecha_generacion','')
-                 disp_dt=''
-                 if dt_gen:
-                     try: disp_dt=datetime.fromisoformat(dt_gen).strftime('%Y-%m-%d %H:%M')
-                     except (ValueError, TypeError): print(f"WARN: No se pudo formatear fecha_generacion: {dt_gen}"); disp_dt=dt_gen
-                 uid_f=rec.get('unique_id',''); disp_uid=uid_f[:8]+'...' if len(uid_f)>8 else uid_f
-                 disp_vals=(disp_dt, rec.get('fecha_cirugia',''), rec.get('paciente',''), rec.get('medico',''), rec.get('tipo_cirugia',''), rec.get('lugar',''), rec.get('encargado_preparacion',''), disp_uid)
-                 item_id=self.tree.insert("", tk.END, values=disp_vals)
-                 self.tree_data[item_id]=rec
-
-        counts=get_counts_by_preparador(); stats_txt="\n".join([f"- {n or 'N/A'}: {c}" for n,c in counts]) if counts else "No datos."; self.stats_text.configure(state="normal"); self.stats_text.delete("1.0", "end"); self.stats_text.insert("1.0", stats_txt); self.stats_text.configure(state="disabled")
+        self._filters = build_record_filters(d_from, d_to, med, pac, cli, uid, DATE_FILTER_COLUMNS[self.date_column_var.get()]); self._search = self.search_entry.get().strip(); print(f"Filtro SQL: {self._filters[0]} con params: {self._filters[1]} texto: '{self._search}'")
+        self._load_gen += 1; self._next_key = None; self._loading = False; self.results_label.configure(text="Cargando...")
+        self._fetch_page(first=True)
+
+    def _fetch_page(self, first=False):
+        """Pide la siguiente página a un hilo; el resultado vuelve al hilo de Tk con after()."""
+        if self._loading or (not first and self._next_key is None): return
+        self._loading = True; gen = self._load_gen; where_sql, params = self._filters; after = self._next_key; search = self._search; dimension = STATS_DIMENSIONS[self.stats_dimension_var.get()]
+        sort = (RECORD_SORT_COLUMNS[self._sort_col][0], self._sort_desc) if self._sort_col else None # None: fecha (lista) o relevancia (búsqueda)
+        def worker():
+            rows, next_key, counts, error = [], None, None, None
+            try:
+                if search and _search_terms(search): rows = search_records(search, where_sql, params, sort=sort) # Sin paginar
+                else: rows, next_key = get_records_page(where_sql, params, after, sort=sort or DEFAULT_RECORD_SORT)
+                if first: counts = get_counts_by_dimension(dimension)
+            except sqlite3.Error as e: error = e; print(f"DB load err: {e}")
+            if self.winfo_exists(): self.after(0, self._append_page, gen, rows, next_key, counts, error)
+        threading.Thread(target=worker, daemon=True).start()
+
+    def _append_page(self, gen, rows, next_key, counts, error):
+        """Inserta una página en la tabla (descarta resultados de búsquedas anteriores)."""
+        if gen != self._load_gen or not self.winfo_exists(): return
+        self._loading = False; self._next_key = next_key
+        if error: self.results_label.configure(text="Error al cargar registros."); show_error_safe("Error DB", f"Error consulta:\n{error}"); return
+        for rec in rows:
+            dt_gen=rec.get('fecha_generacion') or ''
+            disp_dt=''
+            if dt_gen:
+                try: disp_dt=datetime.fromisoformat(dt_gen).strftime('%Y-%m-%d %H:%M')
+                except (ValueError, TypeError): print(f"WARN: No se pudo formatear fecha_generacion: {dt_gen}"); disp_dt=dt_gen
+            uid_f=rec.get('unique_id') or ''; disp_uid=uid_f[:8]+'...' if len(uid_f)>8 else uid_f
+            disp_vals=(disp_dt, rec.get('fecha_cirugia') or '', rec.get('paciente') or '', rec.get('medico') or '', rec.get('tipo_cirugia') or '', rec.get('lugar') or '', rec.get('encargado_preparacion') or '', disp_uid)
+            item_id=self.tree.insert("", tk.END, values=disp_vals)
+            self.tree_data[item_id]=rec['id']
+        n = len(self.tree_data); self.results_label.configure(text=f"{n} registros" + (" (desplázate para cargar más)" if next_key else "."))
+        if counts is not None: self._show_counts(counts)
+
+    def _show_counts(self, counts):
+        """Muestra los conteos del desglose elegido."""
+        stats_txt="\n".join([f"- {n or 'N/A'}: {c}" for n,c in counts]) if counts else "No datos."; self.stats_text.configure(state="normal"); self.stats_text.delete("1.0", "end"); self.stats_text.insert("1.0", stats_txt); self.stats_text.configure(state="disabled")
+
+    def _on_tree_scroll(self, first, last):
+        """Sincroniza la barra y carga la siguiente página al acercarse al final."""
+        self.vsb.set(first, last)
+        if float(last) > 0.9 and self._next_key is not None and not self._loading: self._fetch_page()
 
     def get_selected_record_data(self):
         """Obtiene datos del registro seleccionado."""
         sel = self.tree.selection();
         if len(sel)!=1: return None
-        item_id = sel[0]; data = self.tree_data.get(item_id)
+        item_id = sel[0]; data = get_record_by_id(self.tree_data.get(item_id)) # Registro completo solo al usarlo
         if not data: print(f"ERR: No data for item {item_id}"); return None
         return data
 
     def import_selected_record(self):
         """Importa datos al formulario principal."""
         data = self.get_selected_record_data();
-        if not data: show_error("Error", "Selecciona registro."); return
+        if not data: show_error_safe("Error", "Selecciona registro."); return
         if self.master_app: self.master_app.load_data_into_form(data); self.on_closing()
-        else: show_error("Error", "No acceso a ventana principal.")
+        else: show_error_safe("Error", "No acceso a ventana principal.")
 
     def initiate_regenerate(self):
-        """Pide path y luego inicia hilo de regeneración."""
+        """Pide path y luego inicia hilo de regeneración (o la regeneración múltiple si hay varios seleccionados)."""
+        if len(self.tree.selection()) > 1: self.initiate_bulk_regenerate(); return
         data = self.get_selected_record_data()
-        if not data: show_error("Error", "Selecciona registro."); return
+        if not data: show_error_safe("Error", "Selecciona registro."); return
         s_p=self.master_app.sanitize_filename(data.get('paciente','P')); s_c=self.master_app.sanitize_filename(data.get('cliente','C')); s_f=self.master_app.sanitize_filename(data.get('fecha_cirugia',''))
         sugg = f"REPORTE_{s_p}_{s_c}_{s_f}_REGENERADO.pdf"
         if not self.master_app.select_save_path(suggested_filename=sugg):
-            show_info("Cancelado", "Regeneración cancelada."); return
+            show_info_safe("Cancelado", "Regeneración cancelada."); return
         if self.master_app: self.master_app.start_regenerate_thread(data, self.master_app.output_pdf_path_str)
-        else: show_error("Error", "No acceso a ventana principal.")
+        else: show_error_safe("Error", "No acceso a ventana principal.")
+
+    def initiate_bulk_regenerate(self):
+        """Pide una carpeta y regenera todos los registros seleccionados con nombres derivados de cada registro."""
+        record_ids = [self.tree_data[i] for i in self.tree.selection() if i in self.tree_data]
+        if not record_ids or not self.master_app: return
+        config = self.master_app.config; initial = config.get(CONFIG_KEY_OUTPUT_DIR) or str(Path.home())
+        out_dir = filedialog.askdirectory(title=f"Carpeta para {len(record_ids)} PDF regenerados", initialdir=initial, parent=self)
+        if not out_dir: return
+        if not messagebox.askyesno("Confirmar", f"Regenerar {len(record_ids)} reportes en:\n{out_dir}\n\n(Se reemplazan los PDF regenerados con el mismo nombre)", parent=self): return
+        BulkRegenerationWindow(self, record_ids, out_dir, config)
 
     def open_selected_pdf(self):
         """Abre el PDF del registro seleccionado."""
         data = self.get_selected_record_data();
-        if not data: show_error("Error", "Selecciona registro."); return; pdf_s = data.get('archivo_pdf')
-        if not pdf_s: show_error("Error", "Registro sin PDF."); return; pdf_p = Path(pdf_s)
-        if not pdf_p.exists(): show_error("Error", f"Archivo no encontrado:\n{pdf_p}"); self.open_pdf_button.configure(state="disabled"); return
+        if not data: show_error_safe("Error", "Selecciona registro."); return
+        pdf_s = data.get('archivo_pdf')
+        if not pdf_s: show_error_safe("Error", "Registro sin PDF."); return
+        pdf_p = Path(pdf_s)
+        if not pdf_p.exists(): show_error_safe("Error", f"Archivo no encontrado:\n{pdf_p}"); self.open_pdf_button.configure(state="disabled"); return
         try:
             if sys.platform == "win32": os.startfile(str(pdf_p))
             elif sys.platform == "darwin": subprocess.run(["open", str(pdf_p)], check=True)
             else: subprocess.run(["xdg-open", str(pdf_p)], check=True)
-        except Exception as e: show_error("Error", f"No abrir PDF:\n{e}")
+        except Exception as e: show_error_safe("Error", f"No abrir PDF:\n{e}")
 
     def on_closing(self):
         """Cierra la ventana de estadísticas."""
         print("Cerrando stats."); self.grab_release(); self.destroy();
         if self.master_app: self.master_app.stats_window = None
 
+# --- Clase Ventana de Regeneración Múltiple ---
+class BulkRegenerationWindow(ctk.CTkToplevel):
+    """Progreso de una regeneración múltiple: barra agregada, resultado por registro y cancelación."""
+    def __init__(self, master, record_ids, output_dir, config):
+        super().__init__(master); self.parent_window = master; self.title("Regeneración Múltiple"); self.geometry("700x450")
+        self.transient(master); self.grab_set(); self.protocol("WM_DELETE_WINDOW", self.on_closing)
+        self.record_ids = list(record_ids); self.output_dir = Path(output_dir); self.config = config
+        self.cancel_event = threading.Event(); self.running = True; self.ok_count = 0; self.fail_count = 0; self.cached_count = 0
+        frame = ctk.CTkFrame(self); frame.pack(pady=10, padx=10, fill="both", expand=True)
+        self.progress_label = ctk.CTkLabel(frame, text=f"0/{len(self.record_ids)} registros", anchor="w"); self.progress_label.pack(fill="x", padx=10, pady=(10, 5))
+        self.progress_bar = ctk.CTkProgressBar(frame); self.progress_bar.pack(fill="x", padx=10, pady=5); self.progress_bar.set(0)
+        self.log_text = ctk.CTkTextbox(frame, state="disabled", wrap="none"); self.log_text.pack(fill="both", expand=True, padx=10, pady=5)
+        self.action_button = ctk.CTkButton(frame, text="Cancelar", command=self.cancel, fg_color="tomato"); self.action_button.pack(pady=(5, 10))
+        threading.Thread(target=self._worker, daemon=True).start()
+
+    def _worker(self):
+        """Carga los registros y los regenera (hilo)."""
+        records = []
+        for record_id in self.record_ids:
+            record = get_record_by_id(record_id)
+            if record: records.append(record)
+            else: self.after(0, self._log, f"ERROR {record_id}: registro no encontrado.")
+        try: regenerate_records(records, self.output_dir, self.config, progress_cb=lambda done, total, res: self.after(0, self._on_progress, done, total, res), cancel_event=self.cancel_event)
+        except Exception as e: print(f"ERROR Regen múltiple: {type(e).__name__} - {e}\n{traceback.format_exc()}"); self.after(0, self._log, f"ERROR: {type(e).__name__}: {e}")
+        self.after(0, self._on_finished)
+
+    def _log(self, line):
+        if not self.winfo_exists(): return
+        self.log_text.configure(state="normal"); self.log_text.insert("end", line + "\n"); self.log_text.see("end"); self.log_text.configure(state="disabled")
+
+    def _on_progress(self, done, total, res):
+        """Actualiza barra y registro de resultados (hilo de Tk)."""
+        if not self.winfo_exists(): return
+        if res['ok']:
+            self.ok_count += 1; self.cached_count += bool(res.get('cached')); detail = "reutilizado" if res.get('cached') else f"{res['duration']:.1f}s"
+            self._log(f"OK    {Path(res['pdf']).name} ({res['images']} imágenes, {detail})")
+        else: self.fail_count += 1; self._log(f"ERROR {res.get('record_id') or '?'}: {res['error']}")
+        self.progress_bar.set(done / total if total else 1); self.progress_label.configure(text=f"{done}/{total} registros ({self.ok_count} OK, {self.fail_count} con error)")
+
+    def _on_finished(self):
+        if not self.winfo_exists(): return
+        self.running = False; self.action_button.configure(text="Cerrar", command=self.on_closing, fg_color=("#3B8ED0", "#1F6AA5"), state="normal")
+        self._log(f"Finalizado: {self.ok_count} OK ({self.cached_count} reutilizados sin convertir), {self.fail_count} con error. Carpeta: {self.output_dir}")
+
+    def cancel(self):
+        """Pide la cancelación; la tanda de conversión en curso termina antes de parar."""
+        self.cancel_event.set(); self.action_button.configure(text="Cancelando...", state="disabled"); self._log("Cancelando (se termina la tanda en curso)...")
+
+    def on_closing(self):
+        if self.running: self.cancel(); return
+        self.grab_release(); self.destroy()
+        if self.parent_window and self.parent_window.winfo_exists(): self.parent_window.grab_set()
+
 # --- Punto de Entrada ---
 if __name__ == "__main__":
+    multiprocessing.freeze_support() # Pool de compresión en ejecutables congelados (Windows)
+    if len(sys.argv) > 1: sys.exit(main_cli(sys.argv[1:])) # Modo consola (p.ej. 'lote manifiesto.jsonl')
     # Configuración DPI para Windows
     if sys.platform == "win32":
         try:
@@ -0,0 +1,50 @@
+"""Fixtures compartidas: BD, config, plantilla y fotos en un directorio temporal, con el conversor simulado."""
+import sys
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+
+import generador_app as g  # noqa: E402
+
+
+@pytest.fixture
+def app_env(tmp_path, monkeypatch):
+    """BD nueva y config por defecto en tmp_path; caché y archivo de imágenes también ahí. Devuelve el config."""
+    monkeypatch.setattr(g, "DB_FILENAME", str(tmp_path / "db.sqlite"))
+    monkeypatch.setattr(g, "CONFIG_FILENAME", str(tmp_path / "config.json"))
+    monkeypatch.setattr(g, "TEMPLATE_FILENAME", str(REPO_DIR / "template.docx"))
+    g.set_pdf_converter("simulado"); g.init_db()
+    config = g.load_config()
+    config.update({g.CONFIG_KEY_IMG_ARCHIVE_DIR: str(tmp_path / "archivo"), g.CONFIG_KEY_IMG_CACHE_DIR: str(tmp_path / "cache"),
+                   g.CONFIG_KEY_IMG_WORKERS: 1, g.CONFIG_KEY_OUTPUT_DIR: str(tmp_path / "out")})
+    yield config
+    g.close_db(); g.shutdown_image_pool(); g.set_pdf_converter("libreoffice")
+
+
+@pytest.fixture
+def photos(tmp_path):
+    """Cinco fotos PNG distintas."""
+    paths = []
+    for n in range(5):
+        path = tmp_path / f"foto{n}.png"; Image.new("RGB", (400 + 40 * n, 300), (40 * n, 90, 200 - 30 * n)).save(path); paths.append(path)
+    return paths
+
+
+def report_fields(**overrides):
+    """Campos de formulario completos con valores de prueba."""
+    fields = {key: "" for key in g.REPORT_FIELDS}
+    fields.update({"fecha_cirugia": "2026-03-14", "cliente": "Clínica Norte", "paciente": "José Pérez", "medico": "Dra. Núñez", "tecnico": "Ana", "tipo_cirugia": "Rodilla", "lugar": "Quirófano 2"})
+    fields.update(overrides)
+    return fields
+
+
+def insert_test_record(fecha_generacion="2026-03-14T10:00:00", **overrides):
+    """Inserta un registro en cirugias (sin generar PDF) con report_fields(**overrides). Devuelve el registro."""
+    record = dict(report_fields(**overrides), id=g.uuid.uuid4().hex, unique_id=g.uuid.uuid4().hex[:12], fecha_generacion=fecha_generacion)
+    ok, error = g.insert_record(record)
+    assert ok, error
+    return record
@@ -0,0 +1,39 @@
+"""Las fotos archivadas llegan al DOCX, también al regenerar (bucle image_rows de template.docx)."""
+import hashlib
+import io
+import zipfile
+
+import generador_app as g
+from conftest import report_fields
+
+
+def _docx_media_hashes(docx_bytes):
+    with zipfile.ZipFile(io.BytesIO(docx_bytes)) as docx:
+        return [hashlib.sha1(docx.read(name)).hexdigest() for name in docx.namelist() if name.startswith("word/media/")]
+
+
+def test_template_image_rows_groups_of_three():
+    rows = g.template_image_rows(list("abcde"))
+    assert rows == [("a", "b", "c"), ("d", "e", None)]
+    assert g.template_image_rows([]) == []
+
+
+def test_regenerated_docx_contains_archived_images(app_env, photos, tmp_path):
+    config = dict(app_env, **{g.CONFIG_KEY_RENDER_ENGINE: "docx", g.CONFIG_KEY_RENDER_CACHE_ENABLED: False})
+    result = g.generate_report(g.new_report_job(report_fields(), photos, tmp_path / "r.pdf"), config)
+    assert result["ok"], result["error"]
+    record = g.get_record_by_id(result["record_id"])
+    archived = [path.stem for path in g.get_record_images(record["id"], config)]
+    assert len(archived) == len(photos)
+
+    prepared = g.prepare_regeneration(record, config, tmp_path / "regen.pdf")
+    assert not prepared["result"]["error"]
+    media = _docx_media_hashes(prepared["docx_bytes"])
+    assert set(archived) <= set(media)
+
+
+def test_new_docx_contains_every_photo(app_env, photos, tmp_path):
+    config = dict(app_env, **{g.CONFIG_KEY_RENDER_ENGINE: "docx"})
+    plain = g.prepare_report(g.new_report_job(report_fields(), [], tmp_path / "a.pdf"), config)
+    with_photos = g.prepare_report(g.new_report_job(report_fields(), photos, tmp_path / "b.pdf"), config)
+    assert len(_docx_media_hashes(with_photos["docx_bytes"])) - len(_docx_media_hashes(plain["docx_bytes"])) == len(photos)
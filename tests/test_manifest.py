@@ -0,0 +1,60 @@
+"""Lotes desde manifiesto: filas mal formadas se anotan como fallidas y el resto del lote sigue."""
+import csv
+import json
+
+import pytest
+
+import generador_app as g
+from conftest import report_fields
+
+
+def _state(manifest):
+    with open(f"{manifest}.estado.jsonl", encoding="utf-8") as f: return [json.loads(line) for line in f]
+
+
+def test_load_manifest_jsonl_tags_bad_lines(tmp_path):
+    manifest = tmp_path / "lote.jsonl"
+    manifest.write_text("\n".join([json.dumps(report_fields(imagenes="a.jpg; b.jpg")), "{roto", "", "[1, 2]", json.dumps(report_fields(job_id="fijo"))]) + "\n", encoding="utf-8")
+    rows = g.load_manifest(manifest)
+    assert [row["_linea"] for _, row in rows] == [1, 2, 4, 5]
+    assert rows[0][1]["imagenes"] == ["a.jpg", "b.jpg"] and not rows[0][1].get("_error")
+    assert rows[1][1]["_error"].startswith("JSON inválido") and rows[1][1]["_crudo"] == "{roto"
+    assert rows[2][1]["_error"] == "La línea no es un objeto JSON."
+    assert rows[3][0] == "fijo"
+    assert len({job_id for job_id, _ in rows}) == len(rows)
+
+
+def test_load_manifest_csv(tmp_path):
+    manifest = tmp_path / "lote.csv"
+    with open(manifest, "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["paciente", "medico", "imagenes"]); writer.writeheader()
+        writer.writerow({"paciente": "Ana", "medico": "Dr. Ruiz", "imagenes": "x.jpg;y.jpg"}); writer.writerow({"paciente": "Luis", "medico": "", "imagenes": ""})
+    rows = g.load_manifest(manifest)
+    assert [row["_linea"] for _, row in rows] == [2, 3]
+    assert rows[0][1]["imagenes"] == ["x.jpg", "y.jpg"] and rows[1][1]["imagenes"] == []
+
+
+@pytest.mark.parametrize("engine", ["nativo", "docx"])
+def test_run_batch_reports_bad_rows_and_continues(app_env, photos, tmp_path, engine):
+    config = dict(app_env, **{g.CONFIG_KEY_RENDER_ENGINE: engine})
+    manifest = tmp_path / "lote.jsonl"
+    lines = [json.dumps(report_fields(paciente="Uno", imagenes=[str(p) for p in photos[:2]])), "{roto",
+             json.dumps(report_fields(paciente="Dos", calidad="alta")), json.dumps(report_fields(paciente="Tres", calidad=500)),
+             json.dumps(report_fields(paciente="Cuatro", imagenes=7)), json.dumps(report_fields(paciente="Cinco"))]
+    manifest.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    assert g.run_batch(manifest, tmp_path / "pdfs", workers=2, config=config) == (2, 4)
+    state = {entry["linea"]: entry for entry in _state(manifest)}
+    assert state[1]["ok"] and state[6]["ok"] and g.get_record_by_id(state[1]["record_id"])
+    assert "línea 2" in state[2]["error"] and "JSON inválido" in state[2]["error"]
+    assert "'calidad' no es un número" in state[3]["error"]
+    assert "fuera de rango" in state[4]["error"]
+    assert "'imagenes' debe ser una lista" in state[5]["error"]
+
+
+def test_run_batch_resume_skips_completed(app_env, tmp_path):
+    config = dict(app_env, **{g.CONFIG_KEY_RENDER_ENGINE: "nativo"})
+    manifest = tmp_path / "lote.jsonl"
+    manifest.write_text("\n".join([json.dumps(report_fields(paciente="Uno")), "{roto"]) + "\n", encoding="utf-8")
+    assert g.run_batch(manifest, tmp_path / "pdfs", config=config) == (1, 1)
+    assert g.run_batch(manifest, tmp_path / "pdfs", resume=True, config=config) == (0, 1)
+    assert [entry["ok"] for entry in _state(manifest)] == [True, False, False]
@@ -0,0 +1,113 @@
+"""Motor nativo: PDF válido con las fotos JPEG incrustadas tal cual, y comprobación de paridad con el motor docx."""
+import io
+import re
+import sys
+import zipfile
+import zlib
+
+import pytest
+from PIL import Image
+
+import generador_app as g
+from conftest import report_fields
+
+
+def _jpeg(size, color):
+    buffer = io.BytesIO(); Image.new("RGB", size, color).save(buffer, "JPEG", quality=80); return buffer.getvalue()
+
+
+def _context(jpegs):
+    return dict(report_fields(observaciones_generales="Línea uno\nLínea dos"), unique_id="ABC-123", fecha_emision_corta="14/03/2026", image_rows=g.template_image_rows(jpegs))
+
+
+def test_native_pdf_structure_is_valid():
+    data = g.render_native_pdf(_context([_jpeg((640, 480), (200, 30, 30)), _jpeg((480, 640), (30, 200, 30))]))
+    assert data.startswith(b"%PDF-1.4\n") and data.endswith(b"%%EOF\n")
+    xref_offset = int(re.search(rb"startxref\n(\d+)\n%%EOF\n$", data).group(1))
+    assert data[xref_offset:xref_offset + 5] == b"xref\n"
+    count = int(re.match(rb"xref\n0 (\d+)\n", data[xref_offset:]).group(1))
+    offsets = re.findall(rb"(\d{10}) 00000 n \n", data[xref_offset:])
+    assert len(offsets) == count - 1
+    for n, offset in enumerate(offsets, start=1): assert data[int(offset):].startswith(b"%d 0 obj\n" % n)
+
+
+def test_native_pdf_embeds_jpeg_bytes_unchanged():
+    jpegs = [_jpeg((640 + 10 * n, 480), (40 * n, 90, 120)) for n in range(4)]
+    data = g.render_native_pdf(_context(jpegs + [jpegs[0]]))  # Una foto repetida se incrusta una sola vez
+    assert all(data.count(jpeg) == 1 for jpeg in jpegs)
+    assert len(re.findall(rb"/Subtype /Image", data)) == len(jpegs)
+
+
+def test_native_pdf_readable_by_pypdf():
+    pypdf = pytest.importorskip("pypdf")
+    jpegs = [_jpeg((800, 600), (10 * n, 100, 100)) for n in range(7)]
+    reader = pypdf.PdfReader(io.BytesIO(g.render_native_pdf(_context(jpegs))))
+    assert len(reader.pages) >= 2
+    text = "".join(page.extract_text() for page in reader.pages)
+    assert "José Pérez" in text and "ABC-123" in text
+
+
+def test_native_pdf_images_extract_identical_with_pymupdf():
+    fitz = pytest.importorskip("fitz")
+    jpegs = [_jpeg((800, 600), (10 * n, 100, 100)) for n in range(3)]
+    with fitz.open(stream=g.render_native_pdf(_context(jpegs)), filetype="pdf") as doc:
+        extracted = [doc.extract_image(xref)["image"] for page in doc for xref, *_ in page.get_images(full=True)]
+    assert extracted == jpegs
+
+
+def _placements(data):
+    """[(página, x, y, ancho, alto)] de cada foto, en puntos con y desde arriba, leídos de los content streams."""
+    pages = [zlib.decompress(stream) for stream in re.findall(rb"/Filter /FlateDecode >>\nstream\n(.*?)\nendstream", data, re.S)]
+    return [(n, float(x), g.PDF_PAGE_H - float(y) - float(h), float(w), float(h))
+            for n, ops in enumerate(pages) for w, h, x, y in re.findall(rb"q ([\d.]+) 0 0 ([\d.]+) ([\d.]+) ([\d.]+) cm /Im\d+ Do Q", ops)]
+
+
+def test_native_photos_follow_template_layout():
+    jpegs = [_jpeg((800, 600), (20 * n, 100, 100)) for n in range(7)]
+    placed = _placements(g.render_native_pdf(_context(jpegs)))
+    assert len(placed) == len(jpegs)
+    for _, x, _, w, h in placed:  # Una por fila, centrada y al ancho de la plantilla
+        assert abs(w - g.LAYOUT_2_PER_ROW_WIDTH_MM * g.MM_TO_PT) < 0.1 and abs(h - w * 600 / 800) < 0.1
+        assert abs(x + w / 2 - g.PDF_PAGE_W / 2) < 0.1
+    for (page_a, _, y_a, _, h_a), (page_b, _, y_b, _, _) in zip(placed, placed[1:]):  # En orden, sin solaparse
+        assert (page_a, y_a) < (page_b, y_b) and (page_a != page_b or y_b >= y_a + h_a)
+    assert all(y + h <= g.PDF_PAGE_H - g.PDF_MARGIN + 0.1 for _, _, y, _, h in placed)
+    gaps = [placed[n + 1][2] - placed[n][2] - placed[n][4] for n in range(len(placed) - 1) if placed[n][0] == placed[n + 1][0]]
+    assert max(gaps) > min(gaps)  # Separación extra entre grupos de IMAGES_PER_TEMPLATE_ROW
+
+
+def test_hybrid_photo_pages_match_native_layout():
+    jpegs = [_jpeg((600, 800), (20 * n, 60, 100)) for n in range(4)]
+    rows = g.template_image_rows(jpegs)
+    assert [(x, w, h) for _, x, _, w, h in _placements(g.render_photo_pages(rows))] == [(x, w, h) for _, x, _, w, h in _placements(g.render_native_pdf(_context(jpegs)))]
+
+
+def _convert_with_photos(docx_path, pdf_path, timeout_duration=g.CONVERT_TIMEOUT):
+    """Conversor de prueba que solo coloca los JPEG del DOCX (como haría LibreOffice, sin recomprimir)."""
+    with zipfile.ZipFile(docx_path) as docx:
+        media = [docx.read(name) for name in sorted(docx.namelist()) if name.startswith("word/media/")]
+    pdf = g.NativePdf()
+    for n, jpeg in enumerate(m for m in media if m[:2] == b"\xff\xd8"): pdf.image(jpeg, 40, 40 + 10 * n, 100, 75)
+    g.Path(pdf_path).write_bytes(pdf.to_bytes()); return True, ""
+
+
+def _native_record(config, photos, tmp_path):
+    result = g.generate_report(g.new_report_job(report_fields(), photos, tmp_path / "r.pdf", engine="nativo"), config)
+    assert result["ok"], result["error"]
+    return result["record_id"]
+
+
+def test_parity_fails_when_docx_pdf_has_no_photos(app_env, photos, tmp_path, monkeypatch):
+    monkeypatch.setitem(sys.modules, "fitz", None)  # La comprobación no depende de PyMuPDF
+    record_id = _native_record(app_env, photos, tmp_path)
+    report = g.check_render_parity(record_id, tmp_path / "paridad", app_env)  # El conversor simulado no coloca las fotos
+    assert not report["ok"]
+    assert "docx" in report["error"] and str(len(photos)) in report["error"]
+
+
+def test_parity_passes_when_docx_pdf_has_the_photos(app_env, photos, tmp_path, monkeypatch):
+    monkeypatch.setitem(sys.modules, "fitz", None)
+    g.register_pdf_converter("solo_fotos", _convert_with_photos); g.set_pdf_converter("solo_fotos")
+    record_id = _native_record(app_env, photos, tmp_path)
+    report = g.check_render_parity(record_id, tmp_path / "paridad", app_env)
+    assert report["ok"], (report["error"], report["diferencias"])
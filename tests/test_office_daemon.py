@@ -0,0 +1,66 @@
+"""Conversor persistente: tras una caída, un cuelgue o una cancelación del puente UNO se reinicia y sigue convirtiendo.
+soffice y el puente se sustituyen por procesos Python falsos (no hace falta LibreOffice)."""
+import sys
+import threading
+import time
+
+import pytest
+
+import generador_app as g
+
+pytestmark = pytest.mark.skipif(sys.platform == "win32", reason="soffice falso como script ejecutable")
+
+FAKE_BRIDGE = '''import json, sys, time
+print(json.dumps({"ready": True}), flush=True)
+for line in sys.stdin:
+    req = json.loads(line)
+    if "caida" in req["src"]: sys.exit(3)
+    if "colgado" in req["src"]: time.sleep(60)
+    open(req["dst"], "w").write("%PDF-1.4 falso")
+    print(json.dumps({"ok": True}), flush=True)
+'''
+
+
+@pytest.fixture
+def daemon(tmp_path, monkeypatch):
+    soffice = tmp_path / "soffice"; soffice.write_text(f"#!{sys.executable}\nimport time\ntime.sleep(60)\n"); soffice.chmod(0o755)
+    monkeypatch.setattr(g, "_UNO_BRIDGE_SCRIPT", FAKE_BRIDGE)
+    daemon = g.OfficeConverterDaemon(str(soffice)); daemon.office_python = sys.executable; daemon.start()
+    yield daemon
+    daemon.stop()
+
+
+def _convert(daemon, tmp_path, name, **kwargs):
+    return daemon.convert(tmp_path / f"{name}.docx", tmp_path / f"{name}.pdf", **kwargs)
+
+
+def test_converts(daemon, tmp_path):
+    assert _convert(daemon, tmp_path, "a") == (True, "")
+    assert (tmp_path / "a.pdf").exists() and daemon.restarts == 0
+
+
+def test_restarts_after_bridge_crash(daemon, tmp_path):
+    ok, error = _convert(daemon, tmp_path, "caida")
+    assert not ok and "terminó inesperadamente" in error
+    assert _convert(daemon, tmp_path, "b") == (True, "")
+    assert daemon.restarts == 1 and daemon.is_alive()
+
+
+def test_restarts_after_hang(daemon, tmp_path):
+    ok, error = _convert(daemon, tmp_path, "colgado", timeout_duration=0.5)
+    assert not ok and error.startswith("Timeout")
+    assert _convert(daemon, tmp_path, "c") == (True, "")
+    assert daemon.restarts == 1
+
+
+def test_cancel_interrupts_and_restarts(daemon, tmp_path):
+    cancel = threading.Event(); threading.Timer(0.3, cancel.set).start(); start = time.monotonic()
+    assert _convert(daemon, tmp_path, "colgado", cancel_event=cancel) == (False, "Cancelado.")
+    assert time.monotonic() - start < 5
+    assert _convert(daemon, tmp_path, "d") == (True, "")
+
+
+def test_restarts_when_bridge_died_between_conversions(daemon, tmp_path):
+    daemon.bridge_proc.kill(); daemon.bridge_proc.wait()
+    assert _convert(daemon, tmp_path, "e") == (True, "")
+    assert daemon.restarts == 1
@@ -0,0 +1,44 @@
+"""Paginación por clave (keyset) de la ventana de registros: sin huecos ni repetidos con claves empatadas o nulas."""
+import pytest
+
+import generador_app as g
+from conftest import insert_test_record
+
+
+def _all_pages(sort, limit, where=("1=1", [])):
+    rows, after = [], None
+    while True:
+        page, after = g.get_records_page(*where, after=after, limit=limit, sort=sort)
+        rows.extend(page)
+        if after is None: return rows
+
+
+@pytest.fixture
+def records(app_env):
+    names = ["ana", "Bruno", "ana", None, "Carla", "bruno", "", "Ana", "Diego", None, "carla"]
+    return [insert_test_record(paciente=name, fecha_cirugia=f"2026-03-{1 + n % 4:02d}" if n % 3 else "", fecha_generacion=f"2026-03-{1 + n % 5:02d}T10:00:00")
+            for n, name in enumerate(names)]
+
+
+@pytest.mark.parametrize("key", sorted(g.RECORD_SORT_COLUMNS))
+@pytest.mark.parametrize("limit", [1, 3, 4, 50])
+def test_pages_match_full_sort(records, key, limit):
+    expr, descending = g.RECORD_SORT_COLUMNS[key]
+    expected = [row["id"] for row in g.get_db().query(f"SELECT id FROM cirugias ORDER BY {expr} {'DESC' if descending else 'ASC'}, rowid {'DESC' if descending else 'ASC'}")]
+    assert [row["id"] for row in _all_pages((expr, descending), limit)] == expected
+
+
+def test_pages_respect_filters(records):
+    where = g.build_record_filters("2026-03-02", "2026-03-03")
+    expected = {row["id"] for row in g.get_records_page(*where, limit=100)[0]}
+    assert expected and {row["id"] for row in _all_pages(g.RECORD_SORT_COLUMNS["paciente"], 2, where)} == expected
+
+
+def test_last_page_has_no_next_key(records):
+    assert g.get_records_page("1=1", [], limit=len(records) + 1)[1] is None
+    assert g.get_records_page("1=1", [], limit=2)[1] is not None
+
+
+def test_next_page_queries_use_sort_indexes(app_env):
+    plans = [(label, plan, ok) for label, _, plan, ok in g.check_query_plans() if label.startswith("Página")]
+    assert len(plans) == 2 and all(ok for *_, ok in plans), plans
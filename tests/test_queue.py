@@ -0,0 +1,83 @@
+"""Cola persistente: reclamo atómico, reclamo de trabajos abandonados, latido y fotos retenidas por hash."""
+import json
+import time
+
+import generador_app as g
+from conftest import report_fields
+
+
+def _job(photos, tmp_path, name="r.pdf"):
+    return g.new_report_job(report_fields(), photos, tmp_path / name)
+
+
+def _row(job_id):
+    return dict(g.get_db().query_one("SELECT * FROM generation_jobs WHERE id = ?", (job_id,)))
+
+
+def test_claim_marks_owner_and_is_exclusive(app_env, photos, tmp_path):
+    queue, other = g.GenerationQueue(app_env), g.GenerationQueue(app_env)
+    job_id = queue.submit(_job(photos, tmp_path))
+    claimed_id, job = queue._claim()
+    assert claimed_id == job_id and job["fields"]["paciente"] == "José Pérez"
+    row = _row(job_id)
+    assert row["estado"] == "en_curso" and row["propietario"] == queue.owner and row["intentos"] == 1
+    assert other._claim() is None
+
+
+def test_live_job_is_not_reclaimed(app_env, photos, tmp_path):
+    queue, other = g.GenerationQueue(app_env), g.GenerationQueue(app_env)
+    job_id = queue.submit(_job(photos, tmp_path)); queue._claim()
+    assert other.recover() == 0
+    assert _row(job_id)["propietario"] == queue.owner
+
+
+def test_stale_job_is_reclaimed(app_env, photos, tmp_path):
+    queue, other = g.GenerationQueue(app_env), g.GenerationQueue(app_env)
+    job_id = queue.submit(_job(photos, tmp_path)); queue._claim()
+    g.get_db().execute("UPDATE generation_jobs SET latido = ? WHERE id = ?", (time.time() - g.JOB_STALE_S - 1, job_id))
+    assert other.recover() == 1
+    assert _row(job_id)["estado"] == "pendiente"
+    assert other._claim()[0] == job_id and _row(job_id)["propietario"] == other.owner
+
+
+def test_stale_job_fails_after_max_attempts(app_env, photos, tmp_path):
+    queue, other = g.GenerationQueue(app_env), g.GenerationQueue(app_env)
+    job_id = queue.submit(_job(photos, tmp_path)); queue._claim()
+    g.get_db().execute("UPDATE generation_jobs SET latido = NULL, intentos = ? WHERE id = ?", (g.JOB_MAX_ATTEMPTS, job_id))
+    assert other.recover() == 0
+    assert _row(job_id)["estado"] == "fallido"
+
+
+def test_stolen_job_result_is_not_written(app_env, photos, tmp_path):
+    queue = g.GenerationQueue(app_env)
+    job_id = queue.submit(_job(photos, tmp_path)); claimed = queue._claim()
+    g.get_db().execute("UPDATE generation_jobs SET propietario = 'otra' WHERE id = ?", (job_id,))
+    queue._run(*claimed)
+    assert _row(job_id)["estado"] == "en_curso"
+
+
+def test_job_runs_after_source_photos_are_deleted(app_env, photos, tmp_path):
+    queue = g.GenerationQueue(app_env)
+    job_id = queue.submit(_job(photos, tmp_path))
+    digests = json.loads(_row(job_id)["trabajo"])["image_digests"]
+    assert len(digests) == len(photos) and all(digests)
+    for photo in photos: photo.unlink()
+    queue._run(*queue._claim())
+    row = _row(job_id)
+    assert row["estado"] == "completado", row["error"]
+    record_id = row["cirugia_id"]
+    assert len(g.get_record_images(record_id, app_env)) == len(photos)
+    archive = g.get_image_archive(app_env)
+    assert not any(archive.path_for(digest).exists() for digest in digests)  # Retenidas solo hasta completar
+
+
+def test_heartbeat_ignores_queue_events(app_env, photos, tmp_path):
+    queue = g.GenerationQueue(app_env)
+    job_id = queue.submit(_job(photos, tmp_path)); queue._claim()
+    queue.running[job_id] = {}; g.get_db().execute("UPDATE generation_jobs SET latido = 0 WHERE id = ?", (job_id,))
+    queue.start()
+    try:
+        for _ in range(20): queue._changed()
+        time.sleep(0.2)
+        assert _row(job_id)["latido"] == 0
+    finally: queue.running.clear(); queue.stop()
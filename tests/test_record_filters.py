@@ -0,0 +1,54 @@
+"""Filtros de la ventana de registros: rangos de fecha inclusivos sobre columnas ISO indexadas."""
+import pytest
+
+import generador_app as g
+from conftest import insert_test_record
+
+
+@pytest.mark.parametrize("text, expected", [("2026-03-14", "2026-03-14"), ("2026-03-14T23:59:59", "2026-03-14"), ("14/03/2026", "2026-03-14"),
+                                            ("14-03-2026", "2026-03-14"), ("2026/03/14", "2026-03-14"), ("14.03.2026", "2026-03-14"),
+                                            ("14/03/26", "2026-03-14"), ("14/03/2026 08:30", "2026-03-14"), ("", None), ("ayer", None), ("31/02/2026", None)])
+def test_normalize_date_iso(text, expected):
+    assert g.normalize_date_iso(text) == expected
+
+
+def test_date_range_is_inclusive_and_sargable():
+    sql, params = g.build_record_filters("2026-03-01", "2026-03-31")
+    assert sql == "1=1 AND fecha_generacion >= ? AND fecha_generacion < ?" and params == ["2026-03-01", "2026-04-01"]
+    with pytest.raises(ValueError): g.build_record_filters(date_column="fecha_cirugia")
+
+
+def _page_ids(where):
+    return {row["id"] for row in g.get_records_page(*where)[0]}
+
+
+def test_generation_date_range_includes_whole_last_day(app_env):
+    inside = [insert_test_record(fecha_generacion=f) for f in ("2026-03-01T00:00:00", "2026-03-31T23:59:59")]
+    insert_test_record(fecha_generacion="2026-02-28T23:59:59"); insert_test_record(fecha_generacion="2026-04-01T00:00:00")
+    assert _page_ids(g.build_record_filters("2026-03-01", "2026-03-31")) == {r["id"] for r in inside}
+    assert len(_page_ids(g.build_record_filters(d_from="2026-03-01"))) == 3 and len(_page_ids(g.build_record_filters(d_to="2026-03-31"))) == 3
+
+
+def test_surgery_date_range_uses_normalized_column(app_env):
+    march = [insert_test_record(fecha_cirugia=f) for f in ("05/03/2026", "2026-03-20", "31-03-26")]
+    insert_test_record(fecha_cirugia="01/04/2026"); insert_test_record(fecha_cirugia="sin fecha")
+    assert _page_ids(g.build_record_filters("2026-03-01", "2026-03-31", date_column="fecha_cirugia_iso")) == {r["id"] for r in march}
+
+
+def test_migration_backfills_surgery_dates(app_env):
+    record = insert_test_record(fecha_cirugia="07/03/2026")
+    g.get_db().execute("UPDATE cirugias SET fecha_cirugia_iso = NULL WHERE id = ?", (record["id"],))
+    with g.get_db().transaction() as db: g._migrate_fecha_cirugia_iso(db)
+    assert g.get_record_by_id(record["id"])["fecha_cirugia_iso"] == "2026-03-07"
+
+
+def test_text_filters_are_case_insensitive(app_env):
+    record = insert_test_record(medico="Dr. Gómez", paciente="Ana Ruiz", cliente="Clínica Sur")
+    insert_test_record(medico="Dr. Soto")
+    assert _page_ids(g.build_record_filters(medico="dr. g", paciente="RUIZ", cliente="sur")) == {record["id"]}
+    assert _page_ids(g.build_record_filters(unique_id=record["unique_id"])) == {record["id"]}
+
+
+def test_date_filters_use_their_index(app_env):
+    plans = [(label, plan, ok) for label, _, plan, ok in g.check_query_plans() if label.startswith("Rango")]
+    assert len(plans) == 2 and all(ok for *_, ok in plans), plans
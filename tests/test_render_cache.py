@@ -0,0 +1,63 @@
+"""Huella de render: cuándo se reutiliza un PDF ya producido y cuándo no."""
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+
+import generador_app as g
+from conftest import report_fields
+
+
+def _context(**overrides):
+    context = dict(report_fields(), unique_id="qr-1", fecha_emision="14/03/2026 10:00:00", fecha_emision_corta="14/03/2026")
+    context.update(overrides)
+    return context
+
+
+def test_fingerprint_stable_for_identical_input(app_env):
+    assert g.render_fingerprint(_context(), ["a", "b"], app_env) == g.render_fingerprint(_context(), ["a", "b"], app_env)
+    assert g.render_fingerprint(_context(paciente="  José Pérez "), ["a", "b"], app_env) == g.render_fingerprint(_context(), ["a", "b"], app_env)
+    assert g.render_fingerprint(_context(fecha_emision="14/03/2026 18:30:00"), [], app_env) == g.render_fingerprint(_context(), [], app_env) # La hora no se imprime
+
+
+@pytest.mark.parametrize("change", [
+    {"context": {"paciente": "Otro"}},
+    {"context": {"unique_id": "qr-2"}},
+    {"context": {"fecha_emision_corta": "15/03/2026"}},
+    {"images": ["b", "a"]},
+    {"engine": "nativo"},
+])
+def test_fingerprint_changes_with_rendered_input(app_env, change):
+    base = g.render_fingerprint(_context(), ["a", "b"], app_env)
+    changed = g.render_fingerprint(_context(**change.get("context", {})), change.get("images", ["a", "b"]), app_env, change.get("engine", "docx"))
+    assert changed != base
+
+
+def test_fingerprint_disabled(app_env):
+    assert g.render_fingerprint(_context(), [], dict(app_env, **{g.CONFIG_KEY_RENDER_CACHE_ENABLED: False})) is None
+
+
+def test_regeneration_reuses_pdf_only_on_the_same_emission_day(app_env, photos, tmp_path, monkeypatch):
+    result = g.generate_report(g.new_report_job(report_fields(), photos, tmp_path / "r.pdf"), app_env)
+    assert result["ok"], result["error"]
+    record = g.get_record_by_id(result["record_id"])
+
+    same_day = g.regenerate_report(record, tmp_path / "hoy.pdf", app_env)
+    assert same_day["ok"] and same_day.get("cached")
+    assert Path(same_day["pdf"]).read_bytes() == Path(result["pdf"]).read_bytes()
+
+    class Tomorrow(datetime):
+        @classmethod
+        def now(cls, tz=None): return datetime.now(tz) + g.timedelta(days=1)
+    monkeypatch.setattr(g, "datetime", Tomorrow)
+    next_day = g.regenerate_report(record, tmp_path / "manana.pdf", app_env)
+    assert next_day["ok"] and not next_day.get("cached")
+    assert Tomorrow.now().strftime("%d/%m/%Y").encode() in Path(next_day["pdf"]).read_bytes()
+
+
+def test_cached_pdf_edited_on_disk_is_not_reused(app_env, photos, tmp_path):
+    result = g.generate_report(g.new_report_job(report_fields(), photos[:2], tmp_path / "r.pdf"), app_env)
+    record = g.get_record_by_id(result["record_id"])
+    Path(result["pdf"]).write_bytes(Path(result["pdf"]).read_bytes() + b"%editado\n")
+    again = g.regenerate_report(record, tmp_path / "otra.pdf", app_env)
+    assert again["ok"] and not again.get("cached")
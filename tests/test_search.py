@@ -0,0 +1,63 @@
+"""Búsqueda de texto (FTS5): sin tildes ni mayúsculas, por prefijo, todas las palabras y respetando los filtros."""
+import pytest
+
+import generador_app as g
+from conftest import insert_test_record
+
+
+@pytest.fixture
+def records(app_env):
+    assert g.fts_available
+    return {"perez": insert_test_record(paciente="José Pérez", medico="Dra. Núñez", fecha_generacion="2026-01-10T09:00:00"),
+            "ibanez": insert_test_record(paciente="María Ibáñez", medico="Dr. Gómez", cliente="Clínica Sur", fecha_generacion="2026-02-10T09:00:00"),
+            "perea": insert_test_record(paciente="Pedro Perea", medico="Dr. Gómez", observaciones_generales="Se usó el taladro Ñandú", fecha_generacion="2026-03-10T09:00:00")}
+
+
+def _ids(rows):
+    return {row["id"] for row in rows}
+
+
+@pytest.mark.parametrize("text, expected", [("perez", {"perez"}), ("PÉREZ", {"perez"}), ("ibanez", {"ibanez"}), ("Ibáñez", {"ibanez"}),
+                                            ("nunez", {"perez"}), ("gomez", {"ibanez", "perea"}), ("nandu", {"perea"}), ("jose perez", {"perez"})])
+def test_search_ignores_accents_and_case(records, text, expected):
+    assert _ids(g.search_records(text)) == {records[key]["id"] for key in expected}
+
+
+def test_search_matches_word_prefixes_and_requires_all_terms(records):
+    assert _ids(g.search_records("pe")) == {records["perez"]["id"], records["perea"]["id"]}
+    assert _ids(g.search_records("gomez maria")) == {records["ibanez"]["id"]}
+    assert g.search_records("gomez jose") == []
+
+
+def test_search_ignores_fts_syntax(records):
+    assert _ids(g.search_records('"perez*" ( -')) == {records["perez"]["id"]}
+    assert g.search_records("NEAR(") == []
+
+
+def test_search_ranks_patient_above_other_fields(records):
+    other = insert_test_record(paciente="Luis Soto", medico="Dr. Pérez", fecha_generacion="2026-04-10T09:00:00")
+    assert [row["id"] for row in g.search_records("perez")] == [records["perez"]["id"], other["id"]]
+
+
+def test_search_respects_record_filters(records):
+    where_sql, params = g.build_record_filters("2026-02-01", "2026-03-31")
+    assert _ids(g.search_records("gomez", where_sql, params)) == {records["ibanez"]["id"], records["perea"]["id"]}
+    where_sql, params = g.build_record_filters(cliente="sur")
+    assert _ids(g.search_records("gomez", where_sql, params)) == {records["ibanez"]["id"]}
+
+
+def test_search_index_follows_updates_and_deletes(records):
+    g.get_db().execute("UPDATE cirugias SET paciente = ? WHERE id = ?", ("José Álvarez", records["perez"]["id"]))
+    assert g.search_records("perez") == [] and _ids(g.search_records("alvarez")) == {records["perez"]["id"]}
+    g.get_db().execute("DELETE FROM cirugias WHERE id = ?", (records["perea"]["id"],))
+    assert g.search_records("nandu") == []
+
+
+def test_empty_search_lists_most_recent_first(records):
+    assert [row["id"] for row in g.search_records("  ")] == [records[key]["id"] for key in ("perea", "ibanez", "perez")]
+
+
+def test_like_fallback_without_fts(records, monkeypatch):
+    monkeypatch.setattr(g, "fts_available", False)
+    assert _ids(g.search_records("rodilla")) == _ids(records.values())
+    assert _ids(g.search_records("PEREA taladro")) == {records["perea"]["id"]}
@@ -0,0 +1,64 @@
+"""stats_mensuales: los triggers la mantienen igual a un recuento directo de cirugias tras INSERT, UPDATE y DELETE."""
+import generador_app as g
+from conftest import insert_test_record
+
+
+def _stats():
+    return {tuple(row) for row in g.get_db().query("SELECT dimension, valor, mes, cantidad FROM stats_mensuales")}
+
+
+def _recount():
+    rows = set()
+    for col in g.STATS_DIMENSIONS.values():
+        rows |= {tuple(row) for row in g.get_db().query(f"SELECT '{col}', TRIM({col}), substr(fecha_generacion, 1, 7), COUNT(*) FROM cirugias WHERE TRIM(COALESCE({col}, '')) != '' GROUP BY 2, 3")}
+    return rows
+
+
+def _seed():
+    return [insert_test_record(medico="Dr. Gómez", lugar="Sala 1", fecha_generacion="2026-01-05T10:00:00"),
+            insert_test_record(medico="Dr. Gómez ", lugar="Sala 2", fecha_generacion="2026-01-20T10:00:00"),
+            insert_test_record(medico="Dra. Núñez", lugar="Sala 1", encargado_preparacion="Eva", fecha_generacion="2026-02-03T10:00:00"),
+            insert_test_record(medico="", lugar="  ", fecha_generacion="2026-02-04T10:00:00")]
+
+
+def test_insert_keeps_stats_consistent(app_env):
+    _seed()
+    assert _stats() == _recount()
+    assert g.get_counts_by_dimension("medico") == [("Dr. Gómez", 2), ("Dra. Núñez", 1)]
+    assert g.get_counts_by_dimension("medico", "2026-02", "2026-02") == [("Dra. Núñez", 1)]
+    assert g.get_monthly_counts("lugar", "Sala 1") == [("2026-01", 1), ("2026-02", 1)]
+    assert g.get_counts_by_preparador() == [("Eva", 1)]
+
+
+def test_update_moves_counts(app_env):
+    records = _seed(); db = g.get_db()
+    db.execute("UPDATE cirugias SET medico = 'Dra. Núñez', fecha_generacion = '2026-03-01T10:00:00' WHERE id = ?", (records[0]["id"],))
+    db.execute("UPDATE cirugias SET lugar = '' WHERE id = ?", (records[1]["id"],))
+    db.execute("UPDATE cirugias SET encargado_preparacion = 'Eva' WHERE id = ?", (records[3]["id"],))
+    db.execute("UPDATE cirugias SET paciente = 'Otro' WHERE id = ?", (records[2]["id"],))  # Columna sin estadística
+    assert _stats() == _recount()
+    assert g.get_counts_by_dimension("medico") == [("Dra. Núñez", 2), ("Dr. Gómez", 1)]
+    assert g.get_counts_by_dimension("lugar") == [("Sala 1", 2)]
+
+
+def test_delete_removes_empty_rows(app_env):
+    records = _seed()
+    g.get_db().execute("DELETE FROM cirugias WHERE id IN (?, ?)", (records[2]["id"], records[3]["id"]))
+    assert _stats() == _recount()
+    assert not any(row[2] == "2026-02" for row in _stats())
+    assert all(row[3] > 0 for row in _stats())
+
+
+def test_counts_rolled_back_with_failed_insert(app_env):
+    record = _seed()[0]; before = _stats()
+    ok, _ = g.insert_record(dict(record, id="otro"))  # unique_id repetido
+    assert not ok and _stats() == before
+
+
+def test_table_created_from_existing_records(app_env):
+    _seed()
+    with g.get_db().transaction() as db:
+        db.execute("DROP TABLE stats_mensuales"); g._init_stats_tables(db)
+    assert _stats() == _recount()
+    insert_test_record(medico="Dr. Gómez", fecha_generacion="2026-01-30T10:00:00")
+    assert _stats() == _recount()